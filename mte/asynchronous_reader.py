@@ -1,23 +1,83 @@
 """@package mte.asynchronous_reader
 Used for asynchronously reading a command. Uses a virtual terminal for unbuffered, immediate output.
 """
-import queue
+import fcntl
+import os
+import pty
+import re
+import selectors
+import shlex
+import signal
+import subprocess
+import termios
 import threading
-import pexpect
+import time
+import tty
+
+# Number of bytes read from the terminal at once
+CHUNK_SIZE = 65536
+# Maximum number of bytes kept in the buffer, older output is dropped
+BUFFER_LIMIT = 16 * 1024 * 1024
+# Seconds given to the process to exit after each signal sent by terminate
+SIGNAL_DELAY = 0.1
 
 
 class Reader:
-    def __init__(self, cmd):
+    r"""
+    Reader of the output of a command.
+    >>> reader = Reader("sh -c 'printf start; sleep 0.5; echo; echo done'")
+    >>> reader.wait_for('start', 5)
+    5
+    >>> reader.read()
+    ''
+    >>> reader.wait_for(re.compile('d.ne'), 5)
+    10
+    >>> reader.read()
+    'start\ndone\n'
+    >>> reader.wait()
+    >>> reader.read_since(6), reader.read(), reader.wait_for('start', 0)
+    (('done\n', 11), '', None)
+    >>> reader.terminate()
+    >>> reader = Reader('seq 1000', limit=10)
+    >>> reader.wait()
+    >>> reader.start, reader.read_since(0), reader.wait_for('999\n', 0, 0)
+    (3883, ('\n999\n1000\n', 3893), 3888)
+    >>> reader.terminate()
+    """
+    def __init__(self, cmd, limit=BUFFER_LIMIT, use_pty=True):
         """
         Creates a virtual terminal for a command which can be read in realtime using the read method.
-        Output is stored in a queue which is filled in a separate thread.
+        Output is stored in a bounded buffer which is filled in a separate thread. Every byte of the output has an
+        offset counted from the start of the process, offsets stay valid even after older output is dropped.
         @param cmd: Command to be started and read
+        @param limit: Maximum number of bytes kept in the buffer
+        @param use_pty: If false, output is read from a pipe instead of a virtual terminal.
         @return: Reader object with running process
         """
         self.cmd = cmd
-        self.process = None
-        self.queue = queue.Queue()
-        self.process = pexpect.spawnu(cmd)
+        self.limit = limit
+        self.buffer = bytearray()
+        # Offset of the first byte in the buffer
+        self.start = 0
+        # Offset of the first byte not returned by the read method
+        self.position = 0
+        self.closed = False
+        self.terminated = False
+        self.condition = threading.Condition()
+        if use_pty:
+            master, slave = pty.openpty()
+            # Raw mode keeps the output as it is, without echo and \r\n line endings
+            tty.setraw(slave)
+            self.process = subprocess.Popen(shlex.split(cmd), stdin=slave, stdout=slave, stderr=slave,
+                                            start_new_session=True, preexec_fn=_controlling_terminal)
+            os.close(slave)
+        else:
+            master, slave = os.pipe()
+            self.process = subprocess.Popen(shlex.split(cmd), stdin=subprocess.DEVNULL, stdout=slave,
+                                            stderr=subprocess.STDOUT, start_new_session=True)
+            os.close(slave)
+        self.fd = master
+        self.wakeup_read, self.wakeup_write = os.pipe()
         self.thread = threading.Thread(name=cmd, target=self.__start)
         self.thread.start()
 
@@ -25,21 +85,146 @@ class Reader:
         """
         Function to be started in a separate thread for reading output of the command in real-time
         """
-        for line in iter(self.process.readline, ''):
-            self.queue.put(line)
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ)
+        selector.register(self.wakeup_read, selectors.EVENT_READ)
+        done = False
+        while not done:
+            for key, mask in selector.select():
+                if key.fileobj == self.wakeup_read:
+                    done = True
+                    break
+                try:
+                    data = os.read(self.fd, CHUNK_SIZE)
+                except OSError:
+                    # Terminal returns EIO after the last process holding it exits
+                    data = b''
+                if not data:
+                    done = True
+                    break
+                self.__add(data)
+        selector.close()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __add(self, data):
+        """
+        Appends output to the buffer and drops the oldest output over the limit.
+        @param data: Bytes read from the process
+        """
+        with self.condition:
+            self.buffer += data
+            excess = len(self.buffer) - self.limit
+            if excess > 0:
+                del self.buffer[:excess]
+                self.start += excess
+            self.condition.notify_all()
+
+    def offset(self):
+        """
+        @return: Offset after the last byte read from the process
+        """
+        with self.condition:
+            return self.start + len(self.buffer)
+
+    def read_since(self, offset):
+        """
+        Reads output of the process from an offset. Only whole lines are returned until the process exits, so
+        a line or a multibyte character is never split between two calls.
+        @param offset: Offset of the first byte, e.g. the end offset returned by a previous call.
+        Output which was already dropped from the buffer is skipped.
+        @return: Tuple of the output and the offset after it
+        """
+        with self.condition:
+            first = max(offset, self.start) - self.start
+            if self.closed:
+                last = len(self.buffer)
+            else:
+                last = max(self.buffer.rfind(b'\n', first) + 1, first)
+            return self.buffer[first:last].decode('utf-8', 'replace'), self.start + last
 
     def read(self):
         """
-        Reads queue that was filled by standard output of the process
+        Reads output that was not returned by the previous call
         @return: Unread output by the running process
         """
-        output = ''
-        while not self.queue.empty():
-            output += self.queue.get_nowait()
+        output, self.position = self.read_since(self.position)
         return output
 
-    def terminate(self):
+    def wait_for(self, pattern, timeout=None, offset=None):
         """
-        Terminates the running process
+        Waits until the output of the process matches a pattern. Only new output is searched after each wakeup, so
+        waiting doesn't get slower with the size of the buffer. Matches can't span lines.
+        @param pattern: String to be found or a compiled regular expression
+        @param timeout: Maximum number of seconds to wait. None means wait forever.
+        @param offset: Offset where the search starts. Position of the read method is used if it's None.
+        @return: Offset after the match or None if the pattern didn't appear in time
         """
-        self.process.terminate()
+        if isinstance(pattern, str):
+            regex = re.compile(re.escape(pattern.encode()))
+        else:
+            regex = re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE)
+        deadline = None if timeout is None else time.time() + timeout
+        if offset is None:
+            offset = self.position
+        with self.condition:
+            while True:
+                first = max(offset, self.start) - self.start
+                match = regex.search(self.buffer, first)
+                if match is not None:
+                    return self.start + match.end()
+                # Next search starts at the last incomplete line
+                offset = self.start + max(self.buffer.rfind(b'\n', first) + 1, first)
+                remaining = None if deadline is None else deadline - time.time()
+                if self.closed or (remaining is not None and remaining <= 0):
+                    return None
+                self.condition.wait(remaining)
+
+    def terminate(self, timeout=None):
+        """
+        Terminates the running process and waits until its whole output is read
+        @param timeout: Maximum number of seconds to wait for the output. None means wait forever. If the output
+        doesn't end in time (e.g. a child of the process keeps the terminal open), reading is stopped.
+        Calling it again does nothing.
+        """
+        if self.terminated:
+            return
+        self.terminated = True
+        for sig in (signal.SIGHUP, signal.SIGCONT, signal.SIGINT):
+            if self.process.poll() is not None:
+                break
+            try:
+                self.process.send_signal(sig)
+                self.process.wait(SIGNAL_DELAY)
+            except subprocess.TimeoutExpired:
+                pass
+            except ProcessLookupError:
+                break
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            os.write(self.wakeup_write, b'\0')
+            self.thread.join()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        os.close(self.fd)
+
+    def wait(self, timeout=None):
+        """
+        Waits until the whole output of the process is read (e.g. after it was terminated)
+        @param timeout: Maximum number of seconds to wait. None means wait forever.
+        """
+        self.thread.join(timeout)
+
+
+def _controlling_terminal():
+    """
+    Makes the virtual terminal on the standard input the controlling terminal of the new session, so programs like
+    sudo behave the same way as in a real terminal. Called in the child process before the command is executed.
+    """
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
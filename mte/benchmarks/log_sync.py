@@ -0,0 +1,85 @@
+"""@package mte.benchmarks.log_sync
+Measures latency of tests of the sequential suite with the fixed one second sleep after every command, which was used
+before the kernel log synchronization, and with the end marker of the testing module. Run it on the virtual machine
+from the folder of the testing scripts, optionally with names of tests (all tests which are not variants by default):
+python3 benchmarks/log_sync.py mkdir rename
+Constable is not started, so the commands in the restricted space are not denied, but they are synchronized the same
+way.
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import commons
+import config
+import testing
+from fixtures import Fixture
+from kernel_log import KernelLog
+
+# Seconds slept by the testing module after every command before the synchronization
+FIXED_SLEEP = 1
+
+
+def sleep_sync(start, expect):
+    """
+    Reads the kernel log after the fixed sleep like the testing module did.
+    @param start: Sequence number of the first record of the test
+    @param expect: Expected message, it's not used.
+    @return: Kernel log of the test
+    """
+    time.sleep(FIXED_SLEEP)
+    return testing.kernel_log.text(start)
+
+
+def measure(tests, sync):
+    """
+    Executes commands of the tests and synchronizes with the kernel log after each of them.
+    @param tests: List of tests
+    @param sync: Function which waits for the kernel log of a command, see sleep_sync and testing.read_system_log
+    @return: Dictionary of latencies of the tests in seconds and number of tests whose expected messages were found
+    """
+    latencies = {}
+    found = 0
+    for test in tests:
+        start = time.time()
+        for suffix in ('', '_denied'):
+            if 'command' + suffix not in config.tests[test]:
+                continue
+            log_start = testing.kernel_log.sequence()
+            testing.run_command(test, suffix)
+            found += config.tests[test]['dmesg_expect' + suffix] in sync(log_start,
+                                                                        config.tests[test]['dmesg_expect' + suffix])
+        latencies[test] = time.time() - start
+        testing.kernel_log.discard(testing.kernel_log.sequence())
+    return latencies, found
+
+
+def main(tests):
+    """
+    Measures the tests with both synchronizations and prints the latencies.
+    @param tests: List of tests
+    """
+    testing.kernel_log = KernelLog()
+    fixture = Fixture(tests)
+    fixture.build()
+    os.chdir(commons.TESTING_PATH)
+    results = {}
+    for name, sync in (('sleep', sleep_sync), ('marker', testing.read_system_log)):
+        fixture.restore()
+        results[name] = measure(tests, sync)
+    fixture.clear()
+    testing.kernel_log.close()
+    print('%-20s %10s %10s' % ('test', 'sleep', 'marker'))
+    for test in tests:
+        print('%-20s %9.3fs %9.3fs' % (test, results['sleep'][0][test], results['marker'][0][test]))
+    for name in ('sleep', 'marker'):
+        latencies, found = results[name]
+        print('%s: median %.3f s per test, total %.2f s, %d expected messages found' %
+              (name, statistics.median(latencies.values()), sum(latencies.values()), found))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or [test for test in config.tests if config.split_name(test)[1] is None])
@@ -0,0 +1,64 @@
+"""@package mte.benchmarks.reader
+Measures throughput of asynchronous_reader.Reader with synthetic Constable output. A generated process prints the given
+number of megabytes (300 by default) of log lines and an end line, which is waited for with read:
+python3 benchmarks/reader.py 300
+"""
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asynchronous_reader import Reader
+
+# Last line printed by the generated process
+END = 'mte-benchmark-end'
+# Line of the generated output
+LINE = '0: vs_access denied-link[/home/user/medusa/testing/a -> b] pid=1234 uid=0 some padding text'
+# Number of lines the generated process writes at once
+BLOCK_LINES = 10000
+# Generated process, it's formatted with the number of blocks
+GENERATOR = """python3 -c '
+import sys
+block = b"%s\\n" * %d
+for i in range(%%d):
+    sys.stdout.buffer.write(block)
+sys.stdout.buffer.write(b"%s\\n")
+'""" % (LINE, BLOCK_LINES, END)
+# Seconds between reads, like the testing module reading Constable between tests
+POLL_DELAY = 0.01
+
+
+def measure(megabytes, use_pty):
+    """
+    Reads all output of the generated process.
+    @param megabytes: Size of the generated output
+    @param use_pty: Passed to the Reader
+    @return: Tuple of the duration in seconds, the number of read characters and the number of generated ones. Reader
+    drops the oldest output if it's not read before its buffer is full.
+    """
+    block = (len(LINE) + 1) * BLOCK_LINES
+    blocks = megabytes * 2 ** 20 // block
+    start = time.time()
+    reader = Reader(GENERATOR % blocks, use_pty=use_pty)
+    size = 0
+    while True:
+        output = reader.read()
+        size += len(output)
+        if END in output:
+            break
+        time.sleep(POLL_DELAY)
+    duration = time.time() - start
+    reader.terminate()
+    return duration, size, blocks * block + len(END) + 1
+
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    for use_pty in (False, True):
+        duration, size, generated = measure(megabytes, use_pty)
+        print('%s: %.2f s, %.0f MB/s, %d of %d MB read' % ('pty' if use_pty else 'pipe', duration,
+                                                           generated / 2 ** 20 / duration, size // 2 ** 20,
+                                                           generated // 2 ** 20))
+    print('Peak RSS %d MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
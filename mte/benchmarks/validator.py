@@ -0,0 +1,85 @@
+"""@package mte.benchmarks.validator
+Measures how long it takes to find expected messages of the concurrent suite in a large synthetic kernel log. The log
+has the given number of megabytes (100 by default) of log_proc lines with expected messages of some tests planted in
+it. Searching the whole log for the message of every output, as the validator did before, is compared with one scan
+by LogMatcher:
+python3 benchmarks/validator.py 100
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from validator import LogMatcher
+
+# Line of the synthetic log, it's formatted with the time, the message and the pid
+LINE = '[%5d.%06d] %s pid=%d domain=domain/init uid=1000 luid=1000 euid=1000 suid=1000 pcap=0 icap=0 ecap=0 ' \
+       'med_sact=0 vs=[all_domains] vsr=[all_domains] vsw=[all_domains] vss=[all_domains] cmdline=/usr/bin/python3\n'
+# Every PLANT_INTERVAL-th line has an expected message instead of getprocess
+PLANT_INTERVAL = 50000
+# Number of outputs of each command, like the repetitions of the concurrent suite
+REPETITIONS = 4
+
+
+def outputs(tests):
+    """
+    @param tests: List of tests
+    @return: List of pairs of the test and the suffix of its keys for every output of the concurrent suite
+    """
+    return [(test, suffix) for test in tests for suffix in ('', '_denied') for i in range(REPETITIONS)
+            if 'dmesg_expect' + suffix in config.tests[test]]
+
+
+def synthetic_log(tests, megabytes):
+    """
+    @param tests: List of tests whose messages are planted
+    @param megabytes: Size of the log
+    @return: Text of the log
+    """
+    messages = sorted(set(config.tests[test]['dmesg_expect' + suffix] for test, suffix in outputs(tests)))
+    generator = random.Random(1)
+    lines = []
+    size = 0
+    while size < megabytes * 2 ** 20:
+        number = len(lines)
+        message = generator.choice(messages) if number % PLANT_INTERVAL == 0 else 'getprocess'
+        lines.append(LINE % (number // 1000, number % 1000000, message, number % 30000))
+        size += len(lines[-1])
+    return ''.join(lines)
+
+
+def search_each(log, tests):
+    """
+    Searches the whole log for the expected message of every output.
+    @param log: Text of the log
+    @param tests: List of tests
+    @return: List of verdicts of the outputs
+    """
+    return [config.tests[test]['dmesg_expect' + suffix] in log for test, suffix in outputs(tests)]
+
+
+def scan_once(log, tests):
+    """
+    Scans the log once for the expected messages of all outputs.
+    @param log: Text of the log
+    @param tests: List of tests
+    @return: List of verdicts of the outputs
+    """
+    index = LogMatcher(config.tests[test]['dmesg_expect' + suffix] for test, suffix in outputs(tests)).index(log)
+    return [bool(index.get(config.tests[test]['dmesg_expect' + suffix])) for test, suffix in outputs(tests)]
+
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tests = [test for test in config.tests if config.split_name(test)[1] is None]
+    log = synthetic_log(tests, megabytes)
+    print('%.1f MB log, %d outputs' % (len(log) / 2 ** 20, len(outputs(tests))))
+    verdicts = {}
+    for search in (search_each, scan_once):
+        start = time.time()
+        verdicts[search] = search(log, tests)
+        print('%s: %.2f s, %d messages found' % (search.__name__, time.time() - start, sum(verdicts[search])))
+    print('Same verdicts' if verdicts[search_each] == verdicts[scan_once] else 'Verdicts differ')
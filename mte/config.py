@@ -1,243 +1,227 @@
 # -*- coding: utf-8 -*-
-"""@package mte.commons
+"""@package mte.config
 Contains definitions of tests and contents of a config file which is used for Constable when testing.
 """
-import commons
+import collections
+import hashlib
+import io
+import itertools
+import json
 import locale
+import os
+import string
+
+import commons
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 # Definitions of tests
-testing_suites = {'Sequential test': 'do_tests', 'Concurrent test': 'do_concurrent_tests'}
+testing_suites = {'Sequential test': 'do_tests', 'Concurrent test': 'do_concurrent_tests',
+                  'Stress test': 'do_stress_tests', 'Benchmark': 'do_benchmark_tests'}
 inv_testing_suites = {v: k for k, v in testing_suites.items()}
-tests = {}
-tests['symlink'] = {
-    "config": """\
-all_domains symlink allowed {
-    log_proc("allowed-symlink['"+oldname+"' --> '"+filename+"']");
-    return ALLOW;
-}
-all_domains symlink restricted {
-    log_proc("denied-symlink['"+oldname+"' --> '"+filename+"']");
-    return DENY;
-}
-    """,
-    "command": "ln -s test.txt link.ln",
-    "command_denied": "ln -s restricted/test.txt restricted/link.ln",
-    "before_async": False,
-    "before": None,
-    "after": "rm link.ln",
-    "output_expect": None,
-    "dmesg_expect": "allowed-symlink['test.txt' --> 'link.ln']",
-    "output_expect_denied_sk": "ln: failed to create symbolic link 'restricted/link.ln': Operácia nie je povolená",
-    "output_expect_denied_en": "ln: failed to create symbolic link 'restricted/link.ln': Operation not permitted",
-    "dmesg_expect_denied": "denied-symlink['restricted/test.txt' --> 'link.ln']"
-}
-tests['link'] = {
-    "config": """\
-all_domains link allowed {
-    log_proc("allowed-link['"+filename+"' --> '"+newname+"']");
-    return ALLOW;
-}
-all_domains link restricted {
-    log_proc("denied-link['"+filename+"' --> '"+newname+"']");
-    return DENY;
-}
-    """,
-    "command": "ln test2.txt link2.ln",
-    "command_denied": "ln restricted/test2.txt restricted/link2.ln",
-    "before_async": False,
-    "before": "touch test2.txt restricted/test2.txt",
-    "after": "rm link2.ln test2.txt restricted/test2.txt",
-    "output_expect": None,
-    "dmesg_expect": "link['test2.txt' --> 'link2.ln']",
-    "output_expect_denied_sk": "ln: failed to create hard link 'restricted/link2.ln' => 'restricted/test2.txt': Operácia nie je povolená",
-    "output_expect_denied_en": "ln: failed to create hard link 'restricted/link2.ln' => 'restricted/test2.txt': Operation not permitted",
-    "dmesg_expect_denied": "denied-link['test2.txt' --> 'link2.ln']"
-}
-tests['readlink'] = {
-    "config": """\
-all_domains readlink allowed {
-    log_proc("allowed-readlink['"+filename+"' --> '"+newname+"']");
-    return ALLOW;
-}
-all_domains readlink restricted {
-    log_proc("denied-readlink['"+filename+"' --> '"+newname+"']");
-    return DENY;
-}
-    """,
-    "command": "ls",
-    "command_denied": "ls restricted",
-    "before_async": False,
-    "before": ["touch test3.txt restricted/test3.txt", "ln -s test3.txt link3.txt",
-               "ln -s restricted/test3.txt restricted/link3.txt"],
-    "after": "rm test3.txt link3.txt restricted/test3.txt restricted/link3.txt",
-    "output_expect": "***",
-    "dmesg_expect": "allowed-readlink['test3.txt' --> 'link3.txt']",
-    "output_expect_denied_sk": "***",
-    "output_expect_denied_en": "***",
-    "dmesg_expect_denied": "denied-readlink['restricted/test3.txt' --> 'restricted/link3.txt']"
-}
+# Tests are defined by JSON files in the tests folder, one file per test named after the test. Files are parsed only
+# when a test is requested and parsed tests are cached until their files are modified, so the number of tests doesn't
+# affect the startup. The config key is a list of lines of the Constable configuration of the test. ${TESTING_PATH}
+# and ${VM_MTE_PATH} in strings are replaced with the paths from the commons module. Output expected from a command
+# in the restricted space is given for each locale by output_expect_denied_<locale> keys, output_expect_denied is set
+# from the key of the current locale.
+# Optional operation and operation_denied keys describe the command as a call for the syscalls module. They are used
+# instead of the commands if DIRECT_SYSCALLS is set in the commons module.
+# Optional command_undo (and operation_undo) reverts the effect of the command, so it can be repeated by the concurrent
+# suite. None means that the command can be repeated without reverting. Tests without it are executed only once.
+# Files with TEMPLATE_EXTENSION are templates of tests. Their matrix key maps names of parameters to lists of their
+# values (numbers or strings) and every combination of the values is a variant, a test named like
+# mkdir-tree[depth=8,length=255]. Parameters and values derived from them (see variant_values) are used as
+# placeholders in strings of the template, the parameters are stored under the parameters key of the test.
 # TODO preview config in html
-tests['mkdir'] = {
-    "config": """\
-all_domains mkdir allowed {
-    log_proc("allowed-mkdir['"+filename+"']");
-    return ALLOW;
-}
-all_domains mkdir restricted {
-    log_proc("denied-mkdir['"+filename+"']");
-    return DENY;
-}
-    """,
-    "command": "mkdir test",
-    "command_denied": "mkdir restricted/test",
-    "before_async": False,
-    "before": None,
-    "after": "rmdir test",
-    "output_expect": None,
-    "dmesg_expect": "allowed-mkdir['test']",
-    "output_expect_denied_sk": "mkdir: nie je možné vytvoriť adresár `restricted/test': Operácia nie je povolená",
-    "output_expect_denied_en": "mkdir: cannot create directory ‘restricted/test’: Operation not permitted",
-    "dmesg_expect_denied": "denied-mkdir['test']"
-}
-tests['rmdir'] = {
-    "config": """\
-all_domains rmdir allowed {
-    log_proc("allowed-rmdir['"+filename+"']");
-    return ALLOW;
-}
-all_domains rmdir restricted {
-    log_proc("denied-rmdir['"+filename+"']");
-    return DENY;
-}
-    """,
-    "command": "rmdir folder",
-    "command_denied": "rmdir restricted/folder",
-    "before_async": False,
-    "before": "mkdir folder restricted/folder",
-    "after": "rmdir restricted/folder",
-    "output_expect": None,
-    "dmesg_expect": "allowed-rmdir['folder']",
-    "output_expect_denied_sk": "rmdir: nepodarilo sa odstrániť 'restricted/folder': Operácia nie je povolená",
-    "output_expect_denied_en": "rmdir: failed to remove 'restricted/folder': Operation not permitted",
-    "dmesg_expect_denied": "denied-rmdir['folder']"
-}
-tests['unlink'] = {
-    "config": """\
-all_domains unlink allowed {
-    log_proc("allowed-unlink['"+filename+"']");
-    return ALLOW;
-}
-all_domains unlink restricted {
-    log_proc("denied-unlink['"+filename+"']");
-    return DENY;
-}
-    """,
-    "command": "unlink file.txt",
-    "command_denied": "unlink restricted/file.txt",
-    "before_async": False,
-    "before": "touch file.txt restricted/file.txt",
-    "after": "rm restricted/file.txt",
-    "output_expect": None,
-    "dmesg_expect": "allowed-unlink['file.txt']",
-    "output_expect_denied_sk": "unlink: nie je možné odpojiť (unlink) 'restricted/file.txt': Operácia nie je povolená",
-    "output_expect_denied_en": "unlink: cannot unlink 'restricted/file.txt': Operation not permitted",
-    "dmesg_expect_denied": "denied-unlink['file.txt']"
-}
-tests['rename'] = {
-    "config": """\
-all_domains rename allowed {
-    log_proc("allowed-rename['"+filename+"' --> '"+newname+"']");
-    return ALLOW;
-}
-all_domains rename restricted {
-    log_proc("denied-rename['"+filename+"' --> '"+newname+"']");
-    return DENY;
-}
-    """,
-    "command": "mv rename_me renamed",
-    "command_denied": "mv restricted/rename_me restricted/renamed",
-    "before_async": False,
-    "before": "touch rename_me restricted/rename_me",
-    "after": "rm renamed restricted/rename_me",
-    "output_expect": None,
-    "dmesg_expect": "allowed-rename['rename_me' --> 'renamed']",
-    "output_expect_denied_sk": "mv: cannot move 'restricted/rename_me' to 'restricted/renamed': Operácia nie je povolená",
-    "output_expect_denied_en": "mv: cannot move 'restricted/rename_me' to 'restricted/renamed': Operation not permitted",
-    "dmesg_expect_denied": "denied-rename['rename_me' --> 'renamed']"
-}
-tests['create'] = {
-    "config": """\
-all_domains create allowed {
-    log_proc("allowed-create['" + filename + " " + mode + "']");
-    return ALLOW;
-}
-all_domains create restricted {
-    log_proc("denied-create['" + filename + " " + mode + "']");
-    return DENY;
-}
-    """,
-    "command": "touch hello.c",
-    "command_denied": "touch restricted/hello.c",
-    "before_async": False,
-    "before": None,
-    "after": "rm hello.c",
-    "output_expect": None,
-    "dmesg_expect": "allowed-create['hello.c 0000ffff']",
-    "output_expect_denied_sk": "touch: nie je možné vykonať touch 'restricted/hello.c': Prístup odmietnutý",
-    "output_expect_denied_en": "touch: cannot touch 'restricted/hello.c': Permission denied",
-    "dmesg_expect_denied": "denied-create['hello.c 0000ffff']"
-}
-tests['mknod'] = {
-    "config": """\
-all_domains mknod allowed {
-    log_proc("allowed-mknod['"+filename+" "+uid+" "+gid+"']");
-    return ALLOW;
-}
-all_domains mknod restricted {
-    log_proc("denied-mknod['"+filename+" "+uid+" "+gid+"']");
-    return DENY;
-}
-    """,
-    "command": "mknod fifo p",
-    "command_denied": "mknod restricted/fifo p",
-    "before_async": False,
-    "before": None,
-    "after": "rm fifo",
-    "output_expect": None,
-    "dmesg_expect": "allowed-mknod['fifo 0 0']",
-    "output_expect_denied_sk": "mknod: restricted/fifo: Operácia nie je povolená",
-    "output_expect_denied_en": "mknod: restricted/fifo: Operation not permitted",
-    "dmesg_expect_denied": "denied-mknod['fifo 0 0']"
-}
-tests['fork'] = {
-    "config": """\
-all_domains fork {
-    log("fork");
-    return ALLOW;
-}
-    """,
-    "command": "./fork",
-    "before_async": False,
-    'before': ['sudo cp ' + commons.VM_MTE_PATH + '/fork ' + commons.TESTING_PATH, 'sudo chmod +x ' +
-               commons.TESTING_PATH + '/fork'],
-    "after": "rm fork",
-    "output_expect": ['Detsky proces, pid =', 'Rodicovsky proces, pid dietata ='],
-    "dmesg_expect": "fork"
-}
-tests['kill'] = {
-    "config": """\
-all_domains kill all_domains {
-    log("kill");
-    return ALLOW;
-}
-    """,
-    "command": "killall top",
-    "before_async": True,
-    "before": "top",
-    "after": None,
-    "output_expect": None,
-    "dmesg_expect": "kill"
-}
+TESTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+TEST_EXTENSION = '.json'
+TEMPLATE_EXTENSION = '.template.json'
+# Characters of generated file names by the charset parameter of a variant, they are repeated to fill the name
+CHARSETS = {'ascii': u'abcdefghijklmnopqrstuvwxyz0123456789', 'unicode': u'žluťoučkýkůň語'}
+# Language of the default locale, it is detected by current_locale when it's needed for the first time
+_locale = None
+
+
+class Catalogue(Mapping):
+    """
+    Dictionary of definitions of tests by their names, which loads the files of the tests lazily.
+    """
+    def __init__(self, path=TESTS_PATH):
+        """
+        @param path: Folder with files of the tests
+        """
+        self.path = path
+        # Name of the file: (modification time of the file, its parsed content)
+        self.files = {}
+        # Name of the test: (modification time of its file, definition)
+        self.cache = {}
+
+    def __getitem__(self, name):
+        template, parameters = split_name(name)
+        if parameters is None:
+            mtime, definition = self.__read(template + TEST_EXTENSION, name)
+        else:
+            mtime, definition = self.__read(template + TEMPLATE_EXTENSION, name)
+            matrix = definition['matrix']
+            if set(parameters) != set(matrix) or any(value not in matrix[key] for key, value in parameters.items()):
+                raise KeyError(name)
+        cached = self.cache.get(name)
+        if cached is None or cached[0] != mtime:
+            values = variant_values(template, parameters) if parameters is not None else {}
+            cached = self.cache[name] = (mtime, make_test(definition, values, parameters))
+        return cached[1]
+
+    def __iter__(self):
+        for f in sorted(os.listdir(self.path)):
+            if f.endswith(TEMPLATE_EXTENSION):
+                template = f[:-len(TEMPLATE_EXTENSION)]
+                matrix = self.__read(f, template)[1]['matrix']
+                for values in itertools.product(*matrix.values()):
+                    yield variant_name(template, zip(matrix, values))
+            elif f.endswith(TEST_EXTENSION):
+                yield f[:-len(TEST_EXTENSION)]
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __read(self, f, name):
+        """
+        @param f: Name of the file in the folder of the catalogue
+        @param name: Name of the test which is raised as KeyError if the file doesn't exist
+        @return: Tuple of the modification time of the file and its parsed content
+        """
+        path = os.path.join(self.path, f)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            raise KeyError(name)
+        cached = self.files.get(f)
+        if cached is None or cached[0] != mtime:
+            with io.open(path, encoding='utf-8') as content:
+                # Order of the matrix is kept for names of the variants
+                cached = self.files[f] = (mtime, json.load(content, object_pairs_hook=collections.OrderedDict))
+        return cached
+
+
+def make_test(definition, values=None, parameters=None):
+    """
+    Creates a test from the content of its file.
+    @param definition: Parsed file of the test or of its template
+    @param values: Dictionary of values of placeholders of a variant, see variant_values.
+    @param parameters: Parameters of the variant, they are stored in the test.
+    @return: Dictionary with the definition of the test
+    """
+    values = dict(values or {}, TESTING_PATH=commons.TESTING_PATH, VM_MTE_PATH=commons.VM_MTE_PATH)
+    test = {}
+    for key, value in definition.items():
+        if isinstance(value, list):
+            value = [string.Template(item).safe_substitute(values) if isinstance(item, type(u'')) else item
+                     for item in value]
+        elif isinstance(value, type(u'')):
+            value = string.Template(value).safe_substitute(values)
+        test[key] = value
+    test.pop('matrix', None)
+    test['config'] = '\n'.join(test['config']) + '\n'
+    if 'command_denied' in test:
+        test['output_expect_denied'] = test['output_expect_denied_' + current_locale()]
+    if parameters is not None:
+        test['parameters'] = dict(parameters)
+    return test
+
+
+def split_name(name):
+    """
+    @param name: Name of a test
+    @return: Tuple of the name of the template and the dictionary of parameters of the variant. Parameters are None
+    if the test is not a variant.
+    """
+    if not name.endswith(']') or '[' not in name:
+        return name, None
+    template, label = name[:-1].split('[', 1)
+    parameters = {}
+    for item in label.split(','):
+        key, _, value = item.partition('=')
+        parameters[key] = int(value) if value.lstrip('-').isdigit() else value
+    return template, parameters
+
+
+def variant_name(template, parameters):
+    """
+    @param template: Name of the template
+    @param parameters: Iterable of pairs of names and values of the parameters in the order of the matrix
+    @return: Name of the variant
+    """
+    return template + '[' + ','.join(key + '=' + str(value) for key, value in parameters) + ']'
+
+
+def variant_values(template, parameters):
+    """
+    Computes values of placeholders of a variant. Parameters are available by their names and these values are
+    derived from them:
+     dir - folder of the variant relative to a space. It's nested depth times (0 by default) in a folder which is
+     unique to the variant.
+     name - name of a file, which is length bytes long in UTF-8 (8 by default) and made of characters of the charset
+     (ascii by default, see CHARSETS)
+     name_log - the name as it's printed in the kernel log, which escapes bytes out of printable ASCII
+     sibling_files - paths of siblings (0 by default) files in the folder of the variant in both spaces
+    @param template: Name of the template
+    @param parameters: Dictionary of parameters of the variant
+    @return: Dictionary of values of the placeholders
+    """
+    label = variant_name(template, sorted(parameters.items()))
+    folder = template + '-' + hashlib.md5(label.encode('utf-8')).hexdigest()[:8]
+    folder += '/d' * parameters.get('depth', 0)
+    name = file_name(parameters.get('length', 8), parameters.get('charset', 'ascii'))
+    siblings = ['s' + str(i) for i in range(parameters.get('siblings', 0))]
+    values = dict((key, str(value)) for key, value in parameters.items())
+    values.update({
+        'dir': folder,
+        'name': name,
+        'name_log': ''.join(chr(c) if 32 <= c < 127 and c != ord('\\') else '\\x%02x' % c
+                            for c in bytearray(name.encode('utf-8'))),
+        'sibling_files': ' '.join(space + folder + '/' + sibling for space in ('', 'restricted/')
+                                  for sibling in siblings)
+    })
+    return values
+
+
+def file_name(length, charset):
+    """
+    @param length: Length of the name in bytes of UTF-8
+    @param charset: Key of CHARSETS
+    @return: Name made of the characters of the charset. The end is padded with x if the next character doesn't fit.
+    """
+    name = u''
+    size = 0
+    for character in itertools.cycle(CHARSETS[charset]):
+        width = len(character.encode('utf-8'))
+        if size + width > length:
+            break
+        name += character
+        size += width
+    return name + u'x' * (length - size)
+
+
+def current_locale():
+    """
+    @return: Language of the default locale, e.g. 'en'. It's used for outputs expected from commands.
+    """
+    global _locale
+    if _locale is None:
+        _locale = locale.getdefaultlocale()[0][:2]
+        print('Using ' + _locale + ' locale for outputs')
+    return _locale
+
+
+tests = Catalogue()
+
+# Message printed to the kernel log by Constable when it's initialized
+constable_ready = 'mte-constable-ready'
+# Beginning of the configuration file, paths of the spaces are filled in by make_config
 beginning = """\
 tree	"fs" clone of file by getfile getfile.filename;
 primary tree "fs";
@@ -276,16 +260,18 @@ function log_proc {
     log_proc("getprocess");
     return OK;
 }
-function _init {}
-""" % {'allowed': commons.TESTING_PATH, 'restricted': commons.TESTING_PATH + '/restricted'}
+function _init {
+    log("%(ready)s");
+}
+"""
+
 
-constable_config = 'config "' + commons.TESTING_PATH + '/medusa.conf";' + '\n"test" file "/dev/medusa";'
+def constable_config():
+    """
+    @return: Configuration of Constable which points it to the configuration file created by make_config
+    """
+    return 'config "' + commons.TESTING_PATH + '/medusa.conf";' + '\n"test" file "/dev/medusa";'
 
-current_locale = locale.getdefaultlocale()[0][:2]
-print('Using ' + current_locale + ' locale for outputs')
-for key, value in tests.items():
-    if 'command_denied' in value:
-        tests[key]['output_expect_denied'] = value['output_expect_denied_' + current_locale]
 
 def make_config(list_of_tests):
     """
@@ -293,8 +279,13 @@ def make_config(list_of_tests):
     @param list_of_tests: List of selected tests to be run
     @return: Configuration file to be written on the hard drive
     """
-    config = ""
-    config += beginning
+    config = beginning % {'allowed': commons.TESTING_PATH, 'restricted': commons.TESTING_PATH + '/restricted',
+                          'ready': constable_ready}
+    # Variants of a template (and tests of the same hook) share their handlers, each one is written only once
+    blocks = set()
     for test in list_of_tests:
-        config += tests[test]['config']
+        block = tests[test]['config']
+        if block not in blocks:
+            blocks.add(block)
+            config += block
     return config
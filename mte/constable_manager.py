@@ -0,0 +1,149 @@
+"""@package mte.constable_manager
+Keeps one Constable running across testing suites. Constable is restarted only when its configuration changes.
+"""
+import hashlib
+import os
+import re
+import time
+
+import commons
+import config
+from asynchronous_reader import Reader
+
+# Maximum number of seconds to wait for output of Constable at once while waiting for readiness
+READY_POLL = 0.05
+
+
+class ConstableManager:
+    r"""
+    Starts Constable and keeps it running while its configuration stays the same.
+    >>> import shutil, sys, tempfile
+    >>> commons.TESTING_PATH = tempfile.mkdtemp()
+    >>> stub = sys.executable + " -c 'import time; print(\"mte-constable-ready\", end=\"\", flush=True); " \
+    ...     "time.sleep(0.2); print(flush=True); time.sleep(0.2); print(\"mte-decision\", flush=True); time.sleep(60)'"
+    >>> manager = ConstableManager(command=stub)
+    >>> manager.start('first configuration', 5)
+    Starting Constable
+    True
+    >>> manager.start('first configuration', 5)
+    False
+    >>> manager.start('second configuration', 5)
+    Terminating Constable
+    Starting Constable
+    True
+    >>> output = manager.read('mte-decision')
+    >>> output.count('mte-constable-ready'), 'mte-decision' in output
+    (2, True)
+    >>> manager.stop()
+    Terminating Constable
+    >>> shutil.rmtree(commons.TESTING_PATH)
+    """
+    def __init__(self, ready=config.constable_ready, command='sudo constable', kernel_log=None):
+        """
+        @param ready: Message printed by Constable (to its output or to the kernel log) when it's initialized
+        @param command: Command that starts Constable, path to its configuration file is appended to it.
+        @param kernel_log: KernelLog object searched for the ready message. Only the output is searched if it's None.
+        """
+        self.ready = ready
+        # Output is read by whole lines, Constable isn't ready until the line with the message is complete
+        self.ready_line = re.compile(re.escape(ready) + '.*\n')
+        self.command = command
+        self.kernel_log = kernel_log
+        self.reader = None
+        self.digest = None
+        # Configuration of the last started Constable
+        self.configuration = None
+        # True if Constable prints its log messages to its output, the ready message was found there
+        self.echoes = False
+        # Output of the previous Constable which was not read before it was restarted
+        self.unread = ''
+
+    def running(self):
+        """
+        @return: True if Constable was started and it has neither been stopped nor exited
+        """
+        return self.reader is not None and not self.reader.terminated and self.reader.process.poll() is None
+
+    def start(self, configuration, timeout=None):
+        """
+        Starts Constable with the configuration unless it's already running with the same one. Configuration files
+        are written only when Constable is (re)started.
+        @param configuration: Contents of medusa.conf, see make_config in the config module.
+        @param timeout: Maximum number of seconds to wait for readiness. SYNC_TIMEOUT from the commons module is used
+        if it's None.
+        @return: True if Constable was (re)started, False if the running one was kept.
+        """
+        if timeout is None:
+            timeout = commons.SYNC_TIMEOUT
+        digest = hashlib.md5(configuration.encode('utf-8')).hexdigest()
+        if self.running() and digest == self.digest:
+            return False
+        self.stop()
+        # Output of the stopped Constable is returned by the next read with the output of the new one
+        self.unread = self.read()
+        with open(os.path.join(commons.TESTING_PATH, 'medusa.conf'), 'w') as f:
+            f.write(configuration)
+        with open(os.path.join(commons.TESTING_PATH, 'constable.conf'), 'w') as f:
+            f.write(config.constable_config())
+        log_start = self.kernel_log.sequence() if self.kernel_log is not None else None
+        print('Starting Constable')
+        self.reader = Reader(self.command + ' ' + os.path.join(commons.TESTING_PATH, 'constable.conf'))
+        self.digest = digest
+        self.configuration = configuration
+        self.echoes = False
+        if not self.wait_ready(log_start, timeout):
+            print('Constable is not ready after ' + str(timeout) + ' seconds, starting anyway')
+        return True
+
+    def wait_ready(self, log_start, timeout):
+        """
+        Waits until a whole line with the ready message appears in the output of Constable or the message appears in
+        the kernel log. If it's found in the output, later reads wait for the expected messages there too.
+        @param log_start: Sequence number of the kernel log before Constable was started
+        @param timeout: Maximum number of seconds to wait
+        @return: True if Constable is ready, False if the time ran out or Constable exited.
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self.reader.wait_for(self.ready_line, min(READY_POLL, max(deadline - time.time(), 0)), 0) is not None:
+                self.echoes = True
+                return True
+            if self.kernel_log is not None and self.kernel_log.wait_for(self.ready, log_start, 0) is not None:
+                return True
+            if self.reader.closed:
+                print('Constable exited: ' + self.reader.read_since(0)[0])
+                return False
+            if time.time() >= deadline:
+                return False
+
+    def read(self, expect=None, timeout=None):
+        """
+        @param expect: Message expected in the output. If Constable prints its log messages to its output, it's
+        waited for until a whole line with it is read, so decisions logged a little later are not left for the next
+        read.
+        @param timeout: Maximum number of seconds to wait for the expected message. SYNC_TIMEOUT from the commons
+        module is used if it's None.
+        @return: Output of Constable that was not read yet. It's available even after Constable is stopped or
+        restarted.
+        """
+        if expect is not None and self.echoes and self.running():
+            self.reader.wait_for(re.compile(re.escape(expect) + '.*\n'),
+                                 commons.SYNC_TIMEOUT if timeout is None else timeout)
+        output = self.unread + (self.reader.read() if self.reader is not None else '')
+        self.unread = ''
+        return output
+
+    def stop(self, timeout=None):
+        """
+        Terminates Constable if it was started and not stopped yet.
+        @param timeout: Maximum number of seconds to wait for its output. SYNC_TIMEOUT from the commons module is used
+        if it's None.
+        """
+        if self.reader is not None and not self.reader.terminated:
+            print('Terminating Constable')
+            self.reader.terminate(commons.SYNC_TIMEOUT if timeout is None else timeout)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,152 @@
+"""@package mte.fixtures
+Prepares the testing folder for tests. Preconditions of all selected tests ('before' actions in the config module)
+are created just once in a template folder. The testing folder is then restored by copying the template before every
+suite, so the cost doesn't grow with the number of executed commands.
+"""
+import fnmatch
+import os
+import shlex
+import shutil
+import subprocess
+
+import commons
+import config
+
+# Files in the testing folder that are not touched by the fixtures (configuration and reports)
+KEEP = ('medusa.conf', 'constable.conf', 'result_details', 'results_*', 'durations_*')
+# Seconds given to a helper process to exit after it's terminated
+HELPER_TIMEOUT = 1
+
+
+class Fixture:
+    def __init__(self, tests, path=None, template=None):
+        """
+        @param tests: List of tests whose preconditions are prepared
+        @param path: Testing folder. TESTING_PATH from the commons module is used if it's None.
+        @param template: Folder for the template. It has to be on the same file system as the testing folder, but
+        outside of it (so it's not in the allowed space). Folder next to the testing one is used if it's None.
+        """
+        self.tests = tests
+        self.path = commons.TESTING_PATH if path is None else path
+        self.template = self.path.rstrip('/') + '.template' if template is None else template
+        self.helpers = []
+
+    def build(self):
+        """
+        Creates the template by executing synchronous 'before' actions of all tests in it. Paths to the testing
+        folder in the actions are replaced with the template.
+        """
+        shutil.rmtree(self.template, ignore_errors=True)
+        os.makedirs(os.path.join(self.template, 'restricted'))
+        for test in self.tests:
+            if not config.tests[test]['before_async']:
+                for cmd in self.actions(test):
+                    subprocess.run(shlex.split(cmd.replace(self.path, self.template)), cwd=self.template,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def restore(self, restricted=True):
+        """
+        Restores the testing folder from the template and starts helper processes of the tests (asynchronous 'before'
+        actions). Restricted preconditions can be restored only when Constable is not running.
+        @param restricted: If false, the restricted folder is left as it is.
+        """
+        self.clear(restricted)
+        self.populate(self.path, restricted)
+        for test in self.tests:
+            if config.tests[test]['before_async']:
+                for cmd in self.actions(test):
+                    self.helpers.append(subprocess.Popen(shlex.split(cmd), cwd=self.path, stdout=subprocess.DEVNULL,
+                                                         start_new_session=True))
+
+    def populate(self, path, restricted=True):
+        """
+        Creates preconditions of the tests in a folder by copying the template into it.
+        @param path: Destination folder. Existing folders (or symbolic links to them) are merged with the template.
+        @param restricted: If false, the restricted folder is skipped.
+        """
+        _copy_tree(self.template, path, () if restricted else ('restricted',))
+
+    def clear(self, restricted=True):
+        """
+        Stops helper processes and removes everything from the testing folder except the files matching KEEP.
+        @param restricted: If false, the restricted folder is kept.
+        """
+        self.stop_helpers()
+        for name in os.listdir(self.path):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in KEEP) or (name == 'restricted' and not restricted):
+                continue
+            entry = os.path.join(self.path, name)
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                shutil.rmtree(entry)
+            else:
+                os.unlink(entry)
+
+    def stop_helpers(self):
+        """
+        Terminates helper processes which are still running and reaps all of them.
+        """
+        for helper in self.helpers:
+            if helper.poll() is None:
+                helper.terminate()
+                try:
+                    helper.wait(HELPER_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    helper.kill()
+                    helper.wait()
+        self.helpers = []
+
+    def restricted_intact(self):
+        """
+        @return: True if the restricted folder contains exactly the restricted preconditions from the template, so it
+        doesn't have to be restored.
+        """
+        return _tree(os.path.join(self.template, 'restricted')) == _tree(os.path.join(self.path, 'restricted'))
+
+    @staticmethod
+    def actions(test):
+        """
+        @param test: Name of the test
+        @return: List of 'before' actions of the test. It can be None, a single string or a list of strings in the
+        config module.
+        """
+        before = config.tests[test]['before']
+        if before is None:
+            return []
+        if type(before) is str:
+            return [before]
+        return before
+
+
+def _copy_tree(source, destination, skip=()):
+    """
+    Recreates a folder tree in the destination. Files are copied, symbolic links are recreated. Files are not hard
+    linked: Medusa assigns virtual spaces to an inode by the path it's first looked up through, so a file sharing its
+    inode with the template (which is outside of the tested spaces) could keep the space of the template.
+    @param source: Source folder
+    @param destination: Destination folder, it's created if it doesn't exist.
+    @param skip: Names of entries in the source folder which are not recreated
+    """
+    os.makedirs(destination, exist_ok=True)
+    for entry in os.scandir(source):
+        if entry.name in skip:
+            continue
+        target = os.path.join(destination, entry.name)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            _copy_tree(entry.path, target)
+        else:
+            shutil.copy2(entry.path, target)
+
+
+def _tree(path):
+    """
+    @param path: Folder
+    @return: Set of paths of all entries in the folder relative to it or None if the folder doesn't exist.
+    """
+    if not os.path.isdir(path):
+        return None
+    entries = set()
+    for root, folders, files in os.walk(path):
+        entries.update(os.path.relpath(os.path.join(root, name), path) for name in folders + files)
+    return entries
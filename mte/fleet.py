@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""@package mte.fleet
+Runs a testing campaign on several virtual machines at once. Selected tests are split between the machines based on
+their previous durations and results of all machines are merged into one report.
+Run this module as a script to check the fleet with a stand-in backend (see the stand_in module). Booting and testing
+of the machines is replaced too, a machine named broken fails:
+>>> import shutil, tempfile, stand_in
+>>> commons.OUTPUT_PATH = tempfile.mkdtemp()
+>>> commons.SNAPSHOT = 'ready'
+>>> def run_tests(args, vm, output_path, backend, has_snapshot):
+...     if vm['name'] == 'broken':
+...         raise RuntimeError('no connection')
+...     os.makedirs(output_path)
+...     for suite in args[1]:
+...         with open(os.path.join(output_path, 'durations_' + suite + '.json'), 'w') as f:
+...             json.dump(dict((test, 1.0) for test in args[0]), f)
+>>> virtual.wait_for_boot = lambda vm: None
+>>> virtual.run_tests = run_tests
+>>> backend = stand_in.Backend(snapshots=[('vm <1>', 'ready')])
+>>> vms = [{'name': name, 'ip': '127.0.0.1', 'port': 22} for name in ('vm <1>', 'vm&2', 'broken')]
+>>> tests = ['mkdir', 'rmdir', 'unlink', 'link']
+>>> main(tests, ['do_tests'], vms, backend)
+vm <1> was reset to the snapshot ready
+vm <1> succesfully started
+vm&2 has no snapshot ready, it will be taken when the machine is ready
+vm&2 succesfully started
+broken has no snapshot ready, it will be taken when the machine is ready
+broken succesfully started
+vm <1> will run mkdir, link
+vm&2 will run rmdir
+broken will run unlink
+broken failed: no connection
+>>> with open(os.path.join(commons.OUTPUT_PATH, 'results_do_tests.html')) as f: report = f.read()
+>>> '<h2>vm &lt;1&gt;</h2><iframe src="vm%20%3C1%3E/results_do_tests.html"' in report
+True
+>>> '<h2>vm&amp;2</h2><iframe src="vm%262/results_do_tests.html"' in report
+True
+>>> '<h2>broken</h2><p>Testing failed' in report
+True
+>>> durations = load_durations(os.path.join(commons.OUTPUT_PATH, 'durations.json'))
+>>> print ', '.join(sorted(durations['do_tests']))
+link, mkdir, rmdir
+>>> shard(tests, ['do_tests'], 2, durations)
+[['unlink'], ['mkdir', 'rmdir', 'link']]
+>>> shutil.rmtree(commons.OUTPUT_PATH)
+"""
+import cgi
+import json
+import os
+import threading
+import urllib
+
+import commons
+import virtual
+from config import inv_testing_suites
+
+# Duration in seconds assumed for a test that was never executed in a suite
+DEFAULT_DURATION = 5.0
+
+
+def main(test_list, suite_list, vms=None, backend=None):
+    """
+    Starts all virtual machines, executes a share of the tests on each of them and merges their results.
+    @param test_list: This list contains names of system calls to be tested.
+    @param suite_list: This list contains names of the testing suites to be run.
+    @param vms: List of dictionaries with name, ip and port of the virtual machines. VMS from the commons module are
+     used if it's None.
+    @param backend: Object used to manage the machines. VirtualBoxBackend is used if it's None.
+    """
+    if vms is None:
+        vms = commons.VMS
+    if backend is None:
+        backend = virtual.VirtualBoxBackend()
+    durations_path = os.path.join(commons.OUTPUT_PATH, 'durations.json')
+    durations = load_durations(durations_path)
+    jobs = [(vm, tests) for vm, tests in zip(vms, shard(test_list, suite_list, len(vms), durations)) if tests]
+    # Machines are reset and started one after another from this thread, booting and testing runs in parallel
+    restored = {}
+    for vm, tests in jobs:
+        restored[vm['name']] = virtual.reset(vm, backend)
+        if backend.start(vm['name'], 'headless'):
+            print vm['name'] + ' succesfully started'
+        else:
+            print vm['name'] + ' is already running'
+    threads = []
+    failed = []
+    for vm, tests in jobs:
+        print vm['name'] + ' will run ' + ', '.join(tests)
+        thread = threading.Thread(target=run_vm, args=(vm, (tests, suite_list), backend, restored[vm['name']], failed),
+                                  name=vm['name'])
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for vm, tests in jobs:
+        if vm['name'] not in failed:
+            update_durations(durations, os.path.join(commons.OUTPUT_PATH, vm['name']), suite_list)
+    save_durations(durations_path, durations)
+    merge_reports([vm for vm, tests in jobs], suite_list, failed)
+
+
+def run_vm(vm, args, backend, has_snapshot, failed):
+    """
+    Waits for a virtual machine to boot and executes tests on it. Used as a target of the thread.
+    @param vm: Dictionary with name, ip and port of the virtual machine.
+    @param args: Tuple of two lists. First list contains names of system calls to be tested and second one contains
+     names of the testing suites to be run.
+    @param backend: Object used to manage the machine.
+    @param has_snapshot: False if the machine was not reset to a snapshot, so a new one is taken before testing.
+    @param failed: List of names of machines that failed. Name of this machine is appended to it on error.
+    """
+    try:
+        virtual.wait_for_boot(vm)
+        virtual.run_tests(args, vm, os.path.join(commons.OUTPUT_PATH, vm['name']), backend, has_snapshot)
+    except (Exception, SystemExit) as e:
+        print vm['name'] + ' failed: ' + str(e)
+        failed.append(vm['name'])
+
+
+def shard(tests, suites, count, durations):
+    """
+    Splits tests into groups with similar total duration. The longest test is always given to the group with the
+    lowest total duration.
+    @param tests: List of names of the tests.
+    @param suites: List of names of the suites that will be run.
+    @param count: Number of groups
+    @param durations: Dictionary of previous durations, see load_durations.
+    @return: List of count lists of tests. Tests keep their original order in each list.
+    """
+    shards = [[] for i in range(count)]
+    loads = [0.0] * count
+    for test in sorted(tests, key=lambda t: test_duration(t, suites, durations), reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(test)
+        loads[i] += test_duration(test, suites, durations)
+    return [sorted(s, key=tests.index) for s in shards]
+
+
+def test_duration(test, suites, durations):
+    """
+    @param test: Name of the test.
+    @param suites: List of names of the suites that will be run.
+    @param durations: Dictionary of previous durations, see load_durations.
+    @return: Expected duration of the test in all suites in seconds.
+    """
+    return sum(durations.get(suite, {}).get(test, DEFAULT_DURATION) for suite in suites)
+
+
+def load_durations(path):
+    """
+    Loads durations of tests from previous runs.
+    @param path: Path to the JSON file with durations
+    @return: Dictionary with names of suites as keys. Values are dictionaries with names of tests as keys and
+     durations in seconds as values. Empty if there are no previous runs.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_durations(durations, path, suites):
+    """
+    Updates durations with values measured on the virtual machine during the last run.
+    @param durations: Dictionary of previous durations, see load_durations.
+    @param path: Folder with downloaded results of a virtual machine.
+    @param suites: List of names of the suites that were run.
+    """
+    for suite in suites:
+        suite_path = os.path.join(path, 'durations_' + suite + '.json')
+        if os.path.exists(suite_path):
+            with open(suite_path) as f:
+                durations.setdefault(suite, {}).update(json.load(f))
+
+
+def save_durations(path, durations):
+    """
+    Saves durations of tests for the next run.
+    @param path: Path to the JSON file with durations
+    @param durations: Dictionary of durations, see load_durations.
+    """
+    with open(path, 'w') as f:
+        json.dump(durations, f, indent=2, sort_keys=True)
+
+
+def merge_reports(vms, suites, failed):
+    """
+    Creates one HTML report for each suite that shows reports of all virtual machines.
+    @param vms: List of dictionaries with name, ip and port of the virtual machines that executed tests.
+    @param suites: List of names of the suites that were run.
+    @param failed: List of names of machines that failed.
+    """
+    for suite in suites:
+        with open(os.path.join(commons.OUTPUT_PATH, 'results_' + suite + '.html'), 'w') as f:
+            f.write("""\
+<!DOCTYPE html>
+<html>
+<head>
+<title>Medusa testing environment report</title>
+<meta charset="utf-8">
+</head>
+<body>
+<h1>""" + inv_testing_suites[suite] + """ results</h1>
+""")
+            for vm in vms:
+                f.write('<h2>' + cgi.escape(vm['name']) + '</h2>')
+                if vm['name'] in failed:
+                    f.write('<p>Testing failed, see the output of the testing environment.</p>')
+                else:
+                    f.write('<iframe src="' + urllib.quote(vm['name']) + '/results_' + suite +
+                            '.html" width="100%" height="400"></iframe>')
+            f.write('</body></html>')
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -3,10 +3,12 @@
 Graphical user interface for Medusa Testing Environment
 """
 import Tkinter as Tk
+import collections
 import sys
 import ttk as ttk
 
 import tpm
+from config import split_name
 from config import testing_suites
 from config import tests
 
@@ -39,6 +41,8 @@ class Mte(Tk.Frame):
         self.calls_frame = ttk.LabelFrame(self.left_frame, text="System calls")
         self.tests_frame = ttk.LabelFrame(self.left_frame, text="Test suites")
         self.checkbuttons = []
+        # Names of tests selected by each checkbutton of tests
+        self.checkbutton_tests = []
         self.checkbuttons_suite = []
         # For some strange reason we have to keep reference on checkbutton variables,
         # otherwise they will show the third state
@@ -69,14 +73,21 @@ class Mte(Tk.Frame):
 
     def create_checkbuttons(self):
         """
-        Creates checkbuttons for each test and suite
+        Creates checkbuttons for each test and suite. Variants of a template share one checkbutton, which is not
+        selected by default, so the whole matrix of variants is run only on request.
         """
+        groups = collections.OrderedDict()
         for test in tests:
+            groups.setdefault(split_name(test)[0], []).append(test)
+        for name, group in groups.items():
+            variants = split_name(group[0])[1] is not None
             var = Tk.IntVar()
-            var.set(1)
-            c = ttk.Checkbutton(self.calls_frame, text=test, variable=var)
+            var.set(0 if variants else 1)
+            text = name + ' (' + str(len(group)) + ' variants)' if variants else name
+            c = ttk.Checkbutton(self.calls_frame, text=text, variable=var)
             self.checkbutton_vars.append(var)
             self.checkbuttons.append(c)
+            self.checkbutton_tests.append(group)
         for suite in testing_suites:
             var = Tk.IntVar()
             var.set(1)
@@ -91,9 +102,9 @@ class Mte(Tk.Frame):
         """
         test_list = []
         suite_list = []
-        for checkbutton in self.checkbuttons:
+        for checkbutton, group in zip(self.checkbuttons, self.checkbutton_tests):
             if checkbutton.state() == ('selected',):
-                test_list.append(checkbutton['text'])
+                test_list.extend(group)
         for checkbutton in self.checkbuttons_suite:
             if checkbutton.state() == ('selected',):
                 suite_list.append(testing_suites[checkbutton['text']])
@@ -0,0 +1,202 @@
+"""@package mte.kernel_log
+Reads kernel log messages from /dev/kmsg. Records are read in a separate thread as soon as they are printed, so
+nothing is lost between tests and the log doesn't have to be cleared.
+"""
+import bisect
+import collections
+import os
+import selectors
+import threading
+import time
+
+# Kernel log record. Timestamp is in microseconds since the boot.
+Record = collections.namedtuple('Record', ['sequence', 'timestamp', 'facility', 'level', 'text'])
+
+
+class KernelLog:
+    r"""
+    Reader of the kernel log. A pipe can be used instead of /dev/kmsg, a record may be split between writes:
+    >>> read, write = os.pipe()
+    >>> log = KernelLog(os.fdopen(read, 'rb', buffering=0))
+    >>> start = log.sequence()
+    >>> _ = os.write(write, b'6,1,1500000,-;first\n SUBSYSTEM=test\n4,2,2000001,-;sec')
+    >>> log.wait_for('first', start, 5)
+    1
+    >>> _ = os.write(write, b'ond\n6,3,2500000,-;mte-sync-0\n6,5,3000000,-;after the gap\n')
+    >>> log.wait_for('after the gap', start, 5)
+    5
+    >>> end = log.wait_for('mte-sync-0', start, 5)
+    >>> print(log.text(start, end), end='')
+    [    1.500000] first
+    [    2.000001] second
+    >>> [(record.sequence, record.facility, record.level) for record in log.slice(start, end)]
+    [(1, 0, 6), (2, 0, 4)]
+    >>> log.missing(start, end), log.missing(start)
+    ([], [(4, 5)])
+    >>> log.discard(end)
+    >>> [record.sequence for record in log.slice(start)], log.missing(start), log.sequence()
+    ([3, 5], [(4, 5)], 6)
+    >>> os.close(write)
+    >>> log.close()
+    """
+    def __init__(self, source='/dev/kmsg', from_start=False):
+        """
+        Opens the kernel log and starts reading it in a separate thread.
+        @param source: Path to a file in the /dev/kmsg format or a file object opened in binary mode (e.g. a pipe used
+        instead of the real kernel log).
+        @param from_start: If true, records already present in the log are read too. Otherwise only new records are
+        read. Used only when source is a path.
+        @return: KernelLog object with running reader thread
+        """
+        if isinstance(source, str):
+            self.file = open(source, 'rb', buffering=0)
+            if not from_start:
+                os.lseek(self.file.fileno(), 0, os.SEEK_END)
+        else:
+            self.file = source
+        os.set_blocking(self.file.fileno(), False)
+        self.records = []
+        self.sequences = []
+        # Sequence number of the last read record, it's kept when the record is discarded
+        self.last = None
+        self.gaps = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.thread = threading.Thread(name='kmsg', target=self.__start)
+        self.thread.start()
+
+    def __start(self):
+        """
+        Function to be started in a separate thread for reading the records in real-time
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.file, selectors.EVENT_READ)
+        selector.register(self.wakeup_read, selectors.EVENT_READ)
+        pending = b''
+        while True:
+            events = selector.select()
+            if any(key.fileobj == self.wakeup_read for key, mask in events):
+                break
+            try:
+                data = os.read(self.file.fileno(), 8192)
+            except BrokenPipeError:
+                # Records were overwritten before they were read, the gap is found from the sequence numbers
+                continue
+            except BlockingIOError:
+                continue
+            if not data:
+                break
+            # /dev/kmsg returns one record per read, other files may return more records or a part of a record
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            with self.condition:
+                for line in lines:
+                    self.__add(line)
+                self.condition.notify_all()
+        selector.close()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __add(self, line):
+        """
+        Parses one line of the log and stores the record.
+        @param line: Line in format 'priority,sequence,timestamp,flags;text'. Continuation lines starting with a space
+        contain additional dictionary of the record and are ignored.
+        """
+        if not line or line.startswith(b' ') or b';' not in line:
+            return
+        prefix, text = line.split(b';', 1)
+        fields = prefix.split(b',')
+        priority, sequence, timestamp = int(fields[0]), int(fields[1]), int(fields[2])
+        if self.last is not None and sequence != self.last + 1:
+            self.gaps.append((self.last + 1, sequence))
+        self.last = sequence
+        self.records.append(Record(sequence, timestamp, priority >> 3, priority & 7,
+                                   text.decode('utf-8', 'replace')))
+        self.sequences.append(sequence)
+
+    def sequence(self):
+        """
+        @return: Sequence number of the next record. It can be used as the beginning of a slice.
+        """
+        with self.condition:
+            return self.last + 1 if self.last is not None else 0
+
+    def slice(self, start, end=None):
+        """
+        @param start: Sequence number of the first record
+        @param end: Sequence number after the last record. None means up to the last read record.
+        @return: List of records between the two sequence numbers
+        """
+        with self.condition:
+            first = bisect.bisect_left(self.sequences, start)
+            last = len(self.sequences) if end is None else bisect.bisect_left(self.sequences, end)
+            return self.records[first:last]
+
+    def text(self, start, end=None):
+        """
+        @param start: Sequence number of the first record
+        @param end: Sequence number after the last record. None means up to the last read record.
+        @return: Records between the two sequence numbers formatted like the output of dmesg
+        """
+        return ''.join('[%5d.%06d] %s\n' % (r.timestamp // 1000000, r.timestamp % 1000000, r.text)
+                       for r in self.slice(start, end))
+
+    def missing(self, start, end=None):
+        """
+        @param start: Sequence number of the first record
+        @param end: Sequence number after the last record. None means up to the last read record.
+        @return: List of tuples with the first and after the last sequence numbers of records that were lost
+        (e.g. overwritten or rate limited) between the two sequence numbers.
+        """
+        with self.condition:
+            return [(max(first, start), last if end is None else min(last, end)) for first, last in self.gaps
+                    if last > start and (end is None or first < end)]
+
+    def discard(self, end):
+        """
+        Drops records that are no longer needed to free memory. Lost records are still reported by missing.
+        @param end: Sequence number after the last dropped record
+        """
+        with self.condition:
+            index = bisect.bisect_left(self.sequences, end)
+            del self.records[:index]
+            del self.sequences[:index]
+
+    def wait_for(self, text, start, timeout=None):
+        """
+        Waits until a record containing the text is read.
+        @param text: Text to wait for
+        @param start: Sequence number of the first record that is searched
+        @param timeout: Maximum number of seconds to wait. None means wait forever.
+        @return: Sequence number of the found record or None if it didn't appear in time.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            index = bisect.bisect_left(self.sequences, start)
+            while True:
+                for i in range(index, len(self.records)):
+                    if text in self.records[i].text:
+                        return self.records[i].sequence
+                index = len(self.records)
+                remaining = None if deadline is None else deadline - time.time()
+                if self.closed or (remaining is not None and remaining <= 0):
+                    return None
+                self.condition.wait(remaining)
+
+    def close(self):
+        """
+        Stops the reader thread and closes the log.
+        """
+        os.write(self.wakeup_write, b'\0')
+        self.thread.join()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        self.file.close()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
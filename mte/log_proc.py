@@ -0,0 +1,144 @@
+"""@package mte.log_proc
+Parses messages printed by the log_proc function of the Constable configuration (see beginning in the config module)
+into records, so decisions of Constable can be attributed to processes that caused them.
+"""
+import collections
+import re
+
+# Message of log_proc, e.g. "denied-mkdir['restricted/test'] pid=42 domain=domain/init uid=0 ... cmdline=mkdir"
+PATTERN = re.compile(r'(?:\[ *(\d+)\.(\d+)\] )?(.*?) pid=(-?\d+) domain=(\S*) uid=(-?\d+) luid=(-?\d+)'
+                     r' euid=(-?\d+) suid=(-?\d+) pcap=(\S*) icap=(\S*) ecap=(\S*) med_sact=(\S*) vs=\[([^\]]*)\]'
+                     r' vsr=\[([^\]]*)\] vsw=\[([^\]]*)\] vss=\[([^\]]*)\] cmdline=(.*)')
+# Message of a decision, e.g. "allowed-symlink['test.txt' --> 'link.ln']" or "getprocess"
+MESSAGE = re.compile(r'(?:(?P<verdict>allowed|denied)-)?(?P<hook>\w+)(?:\[(?P<argument>.*)\])?$')
+
+
+class Record:
+    """
+    One message of log_proc. Numeric attributes are integers, capabilities are kept as printed.
+    """
+    __slots__ = ('line', 'timestamp', 'message', 'verdict', 'hook', 'argument', 'pid', 'domain', 'uid', 'luid',
+                 'euid', 'suid', 'pcap', 'icap', 'ecap', 'med_sact', 'vs', 'vsr', 'vsw', 'vss', 'cmdline')
+
+    def __init__(self, line, fields, decision):
+        """
+        @param line: Number of the line in the log (from 0)
+        @param fields: Groups of a match of PATTERN
+        @param decision: Tuple of the verdict, hook and argument of the message, see parse_message.
+        """
+        self.line = line
+        seconds, micros, self.message, pid, self.domain, uid, luid, euid, suid, self.pcap, self.icap, self.ecap, \
+            self.med_sact, self.vs, self.vsr, self.vsw, self.vss, self.cmdline = fields
+        self.timestamp = int(seconds) * 1000000 + int(micros) if seconds is not None else None
+        self.verdict, self.hook, self.argument = decision
+        self.pid = int(pid)
+        self.uid = int(uid)
+        self.luid = int(luid)
+        self.euid = int(euid)
+        self.suid = int(suid)
+
+    def __repr__(self):
+        return 'Record(%d, %r, pid=%d)' % (self.line, self.message, self.pid)
+
+
+class Records:
+    """
+    Table of log_proc messages of a log indexed by pid, hook and verdict ('allowed', 'denied' or None for other
+    messages, e.g. getprocess). Rows are kept as matched and Record objects are created only for selected rows, so
+    logs with hundreds of thousands of messages are parsed quickly.
+    """
+    def __init__(self, log):
+        """
+        @param log: Text of the log, e.g. system_log of a suite. Lines which are not printed by log_proc are skipped.
+        """
+        self.lines = log.split('\n')
+        # Number of the line and groups of the match for every row
+        self.numbers = []
+        self.rows = []
+        # Lists of numbers of rows
+        self.pids = collections.defaultdict(list)
+        self.hooks = collections.defaultdict(list)
+        self.verdicts = collections.defaultdict(list)
+        # There are only a few distinct messages in a log, each one is parsed once
+        self.decisions = {}
+        match = PATTERN.match
+        for number, line in enumerate(self.lines):
+            # Cheap test first, most of the lines of a busy log may be from other sources
+            if ' cmdline=' not in line:
+                continue
+            m = match(line)
+            if m is None:
+                continue
+            fields = m.groups()
+            decision = self.decisions.get(fields[2])
+            if decision is None:
+                decision = self.decisions[fields[2]] = parse_message(fields[2])
+            row = len(self.rows)
+            self.numbers.append(number)
+            self.rows.append(fields)
+            self.pids[int(fields[3])].append(row)
+            self.hooks[decision[1]].append(row)
+            self.verdicts[decision[0]].append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def record(self, row):
+        """
+        @param row: Number of the row
+        @return: Record of the row
+        """
+        return Record(self.numbers[row], self.rows[row], self.decisions[self.rows[row][2]])
+
+    def find(self, pids=None, hook=None, verdict=''):
+        """
+        @param pids: Iterable of pids of processes. Rows of all processes are selected if it's None.
+        @param hook: Name of the hook (e.g. 'mkdir'). Rows of all hooks are selected if it's None.
+        @param verdict: 'allowed', 'denied' or None. Rows of all verdicts are selected if it's ''.
+        @return: Sorted list of numbers of rows matching all the conditions.
+        """
+        candidates = []
+        if pids is not None:
+            candidates.append([row for pid in set(pids) for row in self.pids.get(pid, ())])
+        if hook is not None:
+            candidates.append(self.hooks.get(hook, []))
+        if verdict != '':
+            candidates.append(self.verdicts.get(verdict, []))
+        if not candidates:
+            return list(range(len(self.rows)))
+        # Only the shortest list is iterated, the others are used as sets
+        candidates.sort(key=len)
+        others = [set(rows) for rows in candidates[1:]]
+        return [row for row in sorted(candidates[0]) if all(row in other for other in others)]
+
+    def select(self, pids=None, hook=None, verdict=''):
+        """
+        Same as find, but returns list of records in the order of the log.
+        """
+        return [self.record(row) for row in self.find(pids, hook, verdict)]
+
+    def message(self, row):
+        """
+        @param row: Number of the row
+        @return: Message given to log_proc
+        """
+        return self.rows[row][2]
+
+    def text(self, rows):
+        """
+        @param rows: List of numbers of rows
+        @return: Lines of the log with the rows
+        """
+        return ''.join(self.lines[self.numbers[row]] + '\n' for row in rows)
+
+
+def parse_message(message):
+    """
+    @param message: Message given to log_proc, e.g. "allowed-symlink['test.txt' --> 'link.ln']"
+    @return: Tuple of the verdict ('allowed', 'denied' or None), name of the hook and its argument (text in brackets
+    or None). Hook is None too if the message doesn't look like a decision.
+    """
+    decision = MESSAGE.match(message)
+    if decision is None:
+        return None, None, None
+    return decision.group('verdict', 'hook', 'argument')
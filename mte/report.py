@@ -2,8 +2,19 @@
 This module creates an HTML report from validated outputs.
 """
 # TODO Make error highlighting in cooperation with validator
+import base64
+import gzip
+import hashlib
+import json
 import os
-from config import inv_testing_suites
+import shutil
+import urllib.parse
+from config import inv_testing_suites, tests
+
+# Size of the buffer of the report file
+BUFFER_SIZE = 1 << 16
+# Compression level of logs in the blob area
+BLOB_COMPRESSION = 1
 
 
 class ResultsDirector(object):
@@ -17,6 +28,10 @@ class ResultsDirector(object):
             generator = SerialGenerator(results, outputs, outputs_denied, suite, path)
         elif suite == 'do_concurrent_tests':
             generator = ConcurrentGenerator(results, outputs, outputs_denied, suite, path)
+        elif suite == 'do_stress_tests':
+            generator = StressGenerator(results, outputs, outputs_denied, suite, path)
+        elif suite == 'do_benchmark_tests':
+            generator = BenchmarkGenerator(results, outputs, outputs_denied, suite, path)
         else:
             return
         generator.generate_results()
@@ -24,8 +39,7 @@ class ResultsDirector(object):
 
 class Generator:
     """ Common generator class for both suites. Creates a new HTML file and prepares the beginning of it.
-    Also provides methods for creating a new sub HTML file (used for detailed info on the output) and closing the HTML
-    file.
+    Also provides methods for linking logs (used for detailed info on the output) and closing the HTML file.
     """
     def __init__(self, results, outputs, outputs_denied, suite, path):
         self.results = results
@@ -34,11 +48,18 @@ class Generator:
         self.suite = suite
         self.path = path
         self.file = None
+        self.blobs = None
+        self.records = None
+        self.shared = None
 
     def create_file(self):
         if not os.path.exists(self.path + '/result_details'):
             os.mkdir(self.path + '/result_details')
-        self.file = open(self.path + '/results_' + self.suite + '.html', 'w')
+        with open(self.path + '/result_details/view.html', 'w') as f:
+            f.write(VIEWER)
+        self.blobs = BlobStore(self.path + '/result_details/blobs')
+        self.file = open(self.path + '/results_' + self.suite + '.html', 'w', buffering=BUFFER_SIZE)
+        self.records = open(self.path + '/results_' + self.suite + '.jsonl', 'w', buffering=BUFFER_SIZE)
 
     def begin_html(self):
         """ Writes a beginning to the HTML file.
@@ -66,40 +87,64 @@ class Generator:
     <ul>
     """)
 
-    @staticmethod
-    def begin_sub_html(file):
-        """ Writes a beginning to a specified HTML sub file.
+    def item(self, valid, label, key=None, title=None):
+        """ Creates a bullet point for a checked log, optionally linked to the log in the viewer.
+        @param valid: True, False or None if the log is not checked.
+        @param label: Text of the bullet point
+        @param key: Key of the log in the blob area. The log is linked if it's not None.
+        @param title: Title of the log in the viewer, label is used if it's None.
+        @return: HTML of the bullet point
         """
-        file.write("""\
-<!DOCTYPE html>
-<html>
-<head>
-<title>Medusa testing environment report</title>
-<meta charset="utf-8">
-</head>
-<body>
-""")
+        attributes = '' if valid is None else ' class="ok"' if valid else ' class="error"'
+        if key is None:
+            return '<li' + attributes + '>' + label + '</li>'
+        return '<li' + attributes + '><a href="result_details/view.html?blob=' + key + '&amp;title=' + \
+               urllib.parse.quote(title or label) + '">' + label + '</a></li>'
+
+    def write_record(self, test, variant, valid, keys, duration, **extra):
+        """ Writes a machine-readable record of a test invocation to results_<suite>.jsonl. The host imports the
+        records into its results store (see the store module).
+        @param test: Name of the test
+        @param variant: 'allowed' or 'denied' (command in the restricted space)
+        @param valid: Dictionary with output, dmesg and constable keys and their validity as values
+        @param keys: Dictionary with output, system_log and constable keys and keys of the logs in the blob area as
+        values
+        @param duration: Duration of the test in seconds
+        @param extra: Additional values stored in the record, e.g. errno. Parameters of variants of templates (see the
+        config module) are stored under the parameters key.
+        """
+        record = {'test': test, 'variant': variant, 'duration': duration, 'logs': keys}
+        if 'parameters' in tests[test]:
+            record['parameters'] = tests[test]['parameters']
+        record.update((log + '_valid', value) for log, value in valid.items())
+        record.update(extra)
+        self.records.write(json.dumps(record, sort_keys=True) + '\n')
 
     def end_html(self):
         self.file.write("</ul></body></html>")
+        self.records.close()
 
 
 class SerialGenerator(Generator):
     """ Reports generator used for creating report out of serial suite tests.
     """
+    # Prefix of the titles of logs
+    prefix = 'serial'
     # def __init__(self, results, outputs, suite, path):
     #     super(SerialGenerator, self).__init__(results, outputs, suite, path)
 
     def generate_results(self):
         """
         Main report generation function for the serial suite. Creates a new HTML file, adds a row for each test
-        and closes the file.
+        and closes the file. Results may be an iterator producing them while the suite runs, every row is written
+        to the file as soon as its result is produced and the result is not kept.
         """
         # Create a subfolder for detailed logs
         self.create_file()
         self.begin_html()
         for test in self.results:
             self.add_row(test)
+            self.file.flush()
         self.end_html()
         self.file.close()
 
@@ -109,71 +154,118 @@ class SerialGenerator(Generator):
         with a checkmark a cross to note if the test was successful.
         @param test: Name of the test, for which the row is created.
         """
-        self.file.write("<li>" + test['test'] + "</li><ul>")
-        # Create output file (not needed if output is none)
-        if test['output_valid']:
-            self.file.write('<li class="ok">output</li>')
-        else:
-            self.file.write('<li class="error"><a href="result_details/serial.' + test['test'] +
-                            '.output.html">output</a></li>')
-            # Create new html
-            self.create_subpage(test, 'output')
-        # Create dmesg file
-        if test['dmesg_valid']:
-            self.file.write('<li class="ok"><a href="result_details/serial.' + test['test'] +
-                            '.system_log.html">dmesg</a></li>')
-        else:
-            self.file.write('<li class="error"><a href="result_details/serial.' + test['test'] +
-                            '.system_log.html">dmesg</a></li>')
-        self.create_subpage(test, 'system_log')
-        # Create constable file
-        if test['constable_valid']:
-            self.file.write('<li class="ok"><a href="result_details/serial.' + test['test'] +
-                            '.constable.html">constable</a></li>')
-        else:
-            self.file.write('<li class="error"><a href="result_details/serial.' + test['test'] +
-                            '.constable.html">constable</a></li>')
-        self.create_subpage(test, 'constable')
-
-        if 'output_denied_valid' in test:
-            # Output from the denied command
-            if test['output_denied_valid']:
-                self.file.write('<li class="ok"><a href="result_details/serial.' + test['test'] +
-                                '.output_denied.html">denied output</a></li>')
-            else:
-                self.file.write('<li class="error"><a href="result_details/serial.' + test['test'] +
-                                '.output_denied.html">denied output</a></li>')
-                # Create new html
-            self.create_subpage(test, 'output_denied')
-            # Create dmesg file for the denied command
-            if test['dmesg_denied_valid']:
-                self.file.write('<li class="ok"><a href="result_details/serial.' + test['test'] +
-                                '.system_log_denied.html">denied dmesg</a></li>')
-            else:
-                self.file.write('<li class="error"><a href="result_details/serial.' + test['test'] +
-                                '.system_log_denied.html">denied dmesg</a></li>')
-            self.create_subpage(test, 'system_log_denied')
-            # Create constable file for the denied command
-            if test['constable_denied_valid']:
-                self.file.write('<li class="ok"><a href="result_details/serial.' + test['test'] +
-                                '.constable_denied.html">denied constable</a></li>')
-            else:
-                self.file.write('<li class="error"><a href="result_details/serial.' + test['test'] +
-                                '.constable_denied.html">denied constable</a></li>')
-            self.create_subpage(test, 'constable_denied')
-        self.file.write("</ul>")
-
-    def create_subpage(self, test, log):
-        """
-        Creates new HTML file for a full output.
-        @param test: Name of the test.
-        @param log: Name of the output that is stored in this file.
-        """
-        file = open(self.path + '/result_details/serial.' + test['test'] + '.' + log + '.html', 'w')
-        self.begin_sub_html(file)
-        file.write('<p>' + test[log].replace('\n', '<br>\n'))
-        file.write('</p></body></html>')
-        file.close()
+        row = ['<li>' + test['test'] + '</li><ul>']
+        for variant, suffix, label in (('allowed', '', ''), ('denied', '_denied', 'denied ')):
+            if 'output' + suffix + '_valid' not in test:
+                continue
+            valid = {log: test[log + suffix + '_valid'] for log in ('output', 'dmesg', 'constable')}
+            keys = {log: self.blobs.put(test[log + suffix]) for log in ('output', 'system_log', 'constable')}
+            # Output of the allowed command is linked only if it's not valid
+            row.append(self.item(valid['output'], label + 'output',
+                                 None if suffix == '' and valid['output'] else keys['output'],
+                                 self.title(test, label + 'output')))
+            row.append(self.item(valid['dmesg'], label + 'dmesg', keys['system_log'], self.title(test, label + 'dmesg')))
+            row.append(self.item(valid['constable'], label + 'constable', keys['constable'],
+                                 self.title(test, label + 'constable')))
+            self.write_record(test['test'], variant, valid, keys, test['duration'], **self.extra(test, suffix))
+        row.append('</ul>')
+        self.file.write(''.join(row))
+
+    def title(self, test, log):
+        """
+        @param test: Result of the test
+        @param log: Name of the log
+        @return: Title of the log in the viewer
+        """
+        return self.prefix + ' ' + test['test'] + ' ' + log
+
+    @staticmethod
+    def extra(test, suffix):
+        """
+        @param test: Result of the test
+        @param suffix: '' for the allowed command, '_denied' for the denied one.
+        @return: Dictionary of suite specific values saved in the record of the command, see write_record.
+        """
+        return {'errno': test.get('errno' + suffix)}
+
+
+class StressGenerator(SerialGenerator):
+    """ Report generator used for creating report out of stress suite tests. Rows of the serial report are extended
+    with throughput and latencies of the operations.
+    """
+    prefix = 'stress'
+
+    @staticmethod
+    def extra(test, suffix):
+        """
+        @return: Statistics of the operation in the record, see SerialGenerator.extra.
+        """
+        return {'stats': test.get('stats' + suffix)}
+
+    def add_row(self, test):
+        """
+        Creates a bullet point in the HTML for the test like the serial report and adds statistics of the operation
+        in the allowed and the restricted space.
+        @param test: Name of the test, for which the row is created.
+        """
+        super().add_row(test)
+        self.file.write('<table><tr><th>space</th><th>operations</th><th>ops/s</th><th>p50 [us]</th>'
+                        '<th>p95 [us]</th><th>p99 [us]</th><th>max [us]</th><th>errors</th></tr>')
+        for space, key in (('allowed', 'stats'), ('restricted', 'stats_denied')):
+            if key in test:
+                self.file.write(('<tr><td>' + space + '</td><td>%(operations)d</td><td>%(throughput).0f</td>'
+                                 '<td>%(p50).1f</td><td>%(p95).1f</td><td>%(p99).1f</td><td>%(max).1f</td>')
+                                % test[key])
+                self.file.write('<td>' + ', '.join(os.strerror(error) + ': ' + str(count) if error else
+                                                   'OK: ' + str(count) for error, count in
+                                                   sorted(test[key]['errors'].items())) + '</td></tr>')
+        self.file.write('</table>')
+
+
+class BenchmarkGenerator(SerialGenerator):
+    """ Report generator used for creating report out of benchmark suite tests. Rows of the serial report are
+    extended with durations of the operations and their overhead under Medusa. Measurements are also saved as JSON
+    next to the HTML report.
+    """
+    prefix = 'benchmark'
+
+    @staticmethod
+    def extra(test, suffix):
+        """
+        @return: Measurements of the operation and its overhead in the record, see SerialGenerator.extra.
+        """
+        condition = 'deny' if suffix else 'allow'
+        return {'benchmark': test['benchmark'].get(condition), 'ratio': test['benchmark'].get(condition + '_ratio')}
+
+    def generate_results(self):
+        """
+        Generates the HTML report like the serial report and saves measurements of all tests as JSON.
+        """
+        # Measurements are collected by add_row, results may be consumed just once
+        self.benchmarks = {}
+        super().generate_results()
+        with open(self.path + '/results_' + self.suite + '.json', 'w') as f:
+            json.dump({'unit': 'ns', 'tests': self.benchmarks}, f, indent=2, sort_keys=True)
+
+    def add_row(self, test):
+        """
+        Creates a bullet point in the HTML for the test like the serial report and adds the mean duration of the
+        operation and its overhead in each condition.
+        @param test: Name of the test, for which the row is created.
+        """
+        super().add_row(test)
+        self.benchmarks[test['test']] = test['benchmark']
+        self.file.write('<table><tr><th>Constable</th><th>mean [ns]</th><th>stdev [ns]</th><th>overhead</th></tr>')
+        for condition, title in (('none', 'not running'), ('allow', 'ALLOW'), ('deny', 'DENY')):
+            if condition in test['benchmark']:
+                self.file.write('<tr><td>' + title + '</td><td>%(mean).0f</td><td>%(stdev).0f</td>'
+                                % test['benchmark'][condition])
+                if condition + '_ratio' in test['benchmark']:
+                    self.file.write('<td>%(ratio).3fx [%(low).3f, %(high).3f]</td></tr>'
+                                    % test['benchmark'][condition + '_ratio'])
+                else:
+                    self.file.write('<td></td></tr>')
+        self.file.write('</table>')
 
 
 class ConcurrentGenerator(Generator):
@@ -188,50 +280,160 @@ class ConcurrentGenerator(Generator):
         # Create a subfolder for detailed logs
         self.create_file()
         self.begin_html()
+        # Logs shared by all commands
+        self.shared = {log: self.blobs.put(self.results[log]) for log in ('system_log', 'constable')}
         for test in self.outputs:
             self.add_row(test)
         for test in self.outputs_denied:
             self.add_row(test, denied=True)
-        self.file.write('<li><a href="result_details/concurrent.system_log.html">dmesg</a></li>')
-        self.file.write('<li><a href="result_details/concurrent.constable.html">constable</a></li>')
-        self.create_subpage(self.results, 'system_log')
-        self.create_subpage(self.results, 'constable')
+        self.file.write(self.item(None, 'dmesg', self.shared['system_log'], 'concurrent dmesg'))
+        self.file.write(self.item(None, 'constable', self.shared['constable'], 'concurrent constable'))
         self.end_html()
         self.file.close()
 
     def add_row(self, test, denied=False):
         """ Creates a new bullet point for a test containing the validated outputs.
         """
-        self.file.write("<li>" + 'denied' if denied else '' + test['test'] + "</li><ul>")
-        # Create output file (not needed if output is none)
-        if test['output_valid']:
-            self.file.write('<li class="ok">output</li>')
-        else:
-            self.file.write('<li class="error"><a href="result_details/concurrent.' + test['test'] +
-                            '.output.html">output</a></li>')
-            # Create new html
-            self.create_subpage(test, 'output', True)
-        # Create dmesg file
-        if test['dmesg_valid']:
-            self.file.write('<li class="ok">dmesg</li>')
-        else:
-            self.file.write('<li class="error">dmesg</li>')
-        # Create constable file
-        if test['constable_valid']:
-            self.file.write('<li class="ok">constable</li>')
-        else:
-            self.file.write('<li class="error">constable</li>')
-        self.file.write("</ul>")
+        row = ['<li>' + ('denied ' if denied else '') + test['test'] + '</li><ul>']
+        # Messages attributed to the processes of the test are used instead of the whole log if there are any
+        keys = {'output': self.blobs.put(test['output']), 'constable': self.shared['constable'],
+                'system_log': self.blobs.put(test['system_log']) if test.get('system_log') else
+                self.shared['system_log']}
+        valid = {'output': test['output_valid'], 'constable': test['constable_valid'],
+                 'dmesg': test['dmesg_valid'] and test.get('dmesg_attributed') is not False}
+        # Output is linked only if it's not valid
+        row.append(self.item(valid['output'], 'output', None if valid['output'] else keys['output'],
+                             'concurrent ' + test['worker'] + ' output'))
+        # Attributed messages are linked if dmesg is not valid
+        row.append(self.item(valid['dmesg'], 'dmesg', None if valid['dmesg'] or not test.get('system_log') else
+                             keys['system_log'], 'concurrent ' + test['worker'] + ' dmesg'))
+        row.append(self.item(valid['constable'], 'constable'))
+        row.append('</ul>')
+        self.file.write(''.join(row))
+        self.write_record(test['test'], 'denied' if denied else 'allowed', valid, keys, test['duration'],
+                          worker=test['worker'], invocations=len(test.get('invocations', ())))
 
-    def create_subpage(self, test, log, output=False):
-        """ Creates HTML sub file for constable or dmesg outputs, since they are separatly grouped together.
-        It can also be used to create subpage for a command output - parameter output has to be set to True
+
+class BlobStore:
+    """
+    Stores logs compressed in files named by hashes of their contents, so every distinct log is stored just once
+    however many tests and suites refer to it. Blobs are JavaScript files passing the compressed log to the mteBlob
+    function of the viewer (result_details/view.html), so they can be loaded even from the local file system.
+    """
+    def __init__(self, path):
         """
-        if output:
-            file = open(self.path + '/result_details/concurrent.' + test['test'] + '.' + log + '.html', 'w')
-        else:
-            file = open(self.path + '/result_details/concurrent.' + log + '.html', 'w')
-        self.begin_sub_html(file)
-        file.write('<p>' + test[log].replace('\n', '<br>\n'))
-        file.write('</p></body></html>')
-        file.close()
+        @param path: Folder of the blobs, it's created if it doesn't exist. Blobs already in it (stored by previous
+        suites of the run, see clear_blobs) are reused.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.keys = set(name[:-len('.js')] for name in os.listdir(path) if name.endswith('.js'))
+
+    def put(self, text):
+        """
+        Stores a log unless it's already stored.
+        @param text: Text of the log
+        @return: Key of the blob
+        """
+        data = text.encode('utf-8')
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if key not in self.keys:
+            with open(os.path.join(self.path, key + '.js'), 'w') as f:
+                f.write("mteBlob('" + key + "', '" + base64.b64encode(gzip.compress(data, BLOB_COMPRESSION))
+                        .decode('ascii') + "');\n")
+            self.keys.add(key)
+        return key
+
+
+def clear_blobs(path):
+    """
+    Removes the blob area of the previous run. Blobs are shared by the suites of a run, so the area is cleared at the
+    start of the run and the host downloads only the logs of the current one.
+    @param path: Folder with the reports
+    """
+    shutil.rmtree(os.path.join(path, 'result_details', 'blobs'), ignore_errors=True)
+
+
+def clear_results(path):
+    """
+    Removes reports, records and durations of the previous run. Otherwise the host would download them as results of
+    a suite which failed to write its own.
+    @param path: Folder with the reports
+    """
+    if not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        if name.startswith(('results_', 'durations_')) and os.path.isfile(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+
+
+# Viewer of logs stored in the blob area. It's opened with the key of the blob and a title in the query string, the
+# blob is decompressed by the browser and shown in pages of lines.
+VIEWER = """\
+<!DOCTYPE html>
+<html>
+<head>
+<title>Medusa testing environment report</title>
+<meta charset="utf-8">
+<style>
+pre {white-space: pre-wrap}
+button {margin-right: 5px}
+</style>
+</head>
+<body>
+<h1 id="title"></h1>
+<p id="navigation"></p>
+<pre id="log">Loading...</pre>
+<script>
+var PAGE_LINES = 1000;
+var parameters = new URLSearchParams(location.search);
+var lines = [];
+document.getElementById('title').textContent = parameters.get('title');
+
+function button(text, page) {
+    var element = document.createElement('button');
+    element.textContent = text;
+    element.onclick = function () { show(page); };
+    return element;
+}
+
+function show(page) {
+    var pages = Math.max(Math.ceil(lines.length / PAGE_LINES), 1);
+    page = Math.min(Math.max(page, 0), pages - 1);
+    var navigation = document.getElementById('navigation');
+    navigation.textContent = '';
+    if (pages > 1) {
+        navigation.appendChild(button('first', 0));
+        navigation.appendChild(button('previous', page - 1));
+        navigation.appendChild(button('next', page + 1));
+        navigation.appendChild(button('last', pages - 1));
+    }
+    navigation.appendChild(document.createTextNode(lines.length ? 'lines ' + (page * PAGE_LINES + 1) + '-' +
+        Math.min((page + 1) * PAGE_LINES, lines.length) + ' of ' + lines.length : 'empty'));
+    document.getElementById('log').textContent = lines.slice(page * PAGE_LINES, (page + 1) * PAGE_LINES).join('\\n');
+}
+
+function mteBlob(key, data) {
+    var bytes = Uint8Array.from(atob(data), function (c) { return c.charCodeAt(0); });
+    if (typeof DecompressionStream === 'undefined') {
+        document.getElementById('log').textContent = 'The browser can not decompress logs';
+        return;
+    }
+    var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+    new Response(stream).text().then(function (text) {
+        lines = text.split('\\n');
+        if (lines[lines.length - 1] === '') {
+            lines.pop();
+        }
+        show(0);
+    });
+}
+
+var script = document.createElement('script');
+script.src = 'blobs/' + encodeURIComponent(parameters.get('blob')) + '.js';
+script.onerror = function () { document.getElementById('log').textContent = 'The log was not found'; };
+document.head.appendChild(script);
+</script>
+</body>
+</html>
+"""
@@ -2,16 +2,48 @@
 """@package mte.shell
 Controls communication with a virtual machine through SSH protocol
 """
+import collections
+import gzip
 import hashlib
+import io
+import json
 import os
 import pickle
+import select
+import socket
 import sys
+import tarfile
+import time
 from socket import error
+from socket import timeout as timeout_error
 
 import paramiko
 from scp import SCPClient
 
 import commons
+from store import ResultsStore
+
+# Maximum number of bytes read from the channel at once
+RECV_SIZE = 32768
+
+# Number of seconds to wait for the virtual machine to boot before giving up
+BOOT_DEADLINE = 300
+# Number of seconds to wait for the virtual machine to go down after a reboot command
+SHUTDOWN_DEADLINE = 60
+# Delays between readiness probes grow from the first to the last value
+PROBE_DELAY_FIRST = 0.25
+PROBE_DELAY_LAST = 5
+
+# Number of last lines of a streamed output that are kept in memory
+TAIL_LINES = 100
+# Longer parts of an output without a newline are split into more lines
+MAX_LINE = 65536
+
+# Name of the file in VM_MTE_PATH describing the last successful kernel build
+BUILD_MANIFEST = 'build_manifest.json'
+
+# Result of a command executed in its own exec channel
+CommandResult = collections.namedtuple('CommandResult', ['stdout', 'stderr', 'exit_status'])
 
 
 class Shell:
@@ -28,92 +60,139 @@ class Shell:
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.ssh.connect(ip, port=port, username=username, password=password)
         self.channel = self.ssh.invoke_shell()
-        channel_data = ""
+        channel_data = self.read_until(('$ ', '# '))
+        # Prompt is the last line, it may be the only one if the machine prints no message of the day
+        self.prompt = channel_data[channel_data.rfind('\n')+1:]
+        self.set_prompt()
+
+    def read_until(self, endings, timeout=None, on_data=None, keep=True):
+        """
+        Reads from the channel until the received data ends with one of the endings. Waiting for the data is done in
+        select, so the host processor is not used while the virtual machine is working on the command.
+        @param endings: String or tuple of strings that mark the end of the output (usually a prompt).
+        @param timeout: Number of seconds to wait for a new piece of data. None means wait forever.
+        @param on_data: Function that is called with every received piece of data.
+        @param keep: If false, only the end of the data needed for the detection of the ending is kept in memory.
+        Output has to be processed by on_data in this case.
+        @return: All received data including the ending. Only the ending if keep is false.
+        """
+        if not isinstance(endings, tuple):
+            endings = (endings,)
+        window = max(len(ending) for ending in endings)
+        channel_data = bytearray()
         while True:
-            if self.channel.recv_ready():
-                channel_data += self.channel.recv(9999)
-            else:
-                continue
-            if channel_data.endswith("$ ") or channel_data.endswith("# "):
-                index = channel_data.rindex('\n')
-                self.prompt = channel_data[index+1:]
-                self.set_prompt()
-                break
+            readable, _, _ = select.select([self.channel], [], [], timeout)
+            if not readable:
+                raise timeout_error('No output from the virtual machine in ' + str(timeout) + ' seconds')
+            new_data = self.channel.recv(RECV_SIZE)
+            if not new_data:
+                raise EOFError('SSH channel was closed by the virtual machine')
+            channel_data.extend(new_data)
+            if on_data is not None:
+                on_data(new_data)
+            if not keep and len(channel_data) > window:
+                del channel_data[:-window]
+            # Only the end of the buffer is checked, so the detection doesn't slow down with long outputs
+            if channel_data.endswith(endings):
+                return bytes(channel_data)
 
     def set_prompt(self):
         """
         Sets the prompt of a running SSH connetion to '[TPM]$ ' for easier recognition of an end of a command.
         """
-        channel_data = ""
-        sent = False
-        while True:
-            if not sent:
-                self.channel.send('PS1="[TPM]\$ "\n')
-                self.prompt = '[TPM]$ '
-                sent = True
-                channel_data = ""
-            if self.channel.recv_ready():
-                channel_data += self.channel.recv(9999)
-            else:
-                continue
-            if channel_data.endswith(self.prompt):
-                break
+        self.channel.send('PS1="[TPM]\$ "\n')
+        self.prompt = '[TPM]$ '
+        self.read_until(self.prompt)
 
-    def exec_cmd(self, command):
+    def exec_cmd(self, command, timeout=None):
         """
         Executes a command on the running SSH shell
         @param command: Command to execute
+        @param timeout: Number of seconds to wait for a new piece of output. None means wait forever.
         @return: Full output of the command
         """
-        channel_data = ""
-        sent = False
-        while True:
-            if not sent:
-                self.channel.send(command + '\n')
-                sent = True
-                channel_data = ""
-            if self.channel.recv_ready():
-                channel_data += self.channel.recv(9999)
-            else:
-                continue
-            if channel_data.endswith(self.prompt):
-                return channel_data[len(command)+2:-len(self.prompt)]
-
-    def instant_cmd(self, command):
+        self.channel.send(command + '\n')
+        channel_data = self.read_until(self.prompt, timeout)
+        return channel_data[len(command)+2:-len(self.prompt)]
+
+    def instant_cmd(self, command, timeout=None):
         """
         Executes command and prints immediate output on the standard output.
         @param command: Command to execute
-        @return: Full output of the command
+        @param timeout: Number of seconds to wait for a new piece of output. None means wait forever.
+        @return: Last TAIL_LINES lines of the output
         """
-        channel_data = ""
-        sent = False
-        # Number of characters that needs to be cut before actual output begins
-        cut = len(command)+2
-        while True:
-            if not sent:
-                self.channel.send(command + '\n')
-                sent = True
-                channel_data = ""
-            if self.channel.recv_ready():
-                new_data = self.channel.recv(9999)
-                if 0 < cut < len(new_data):
-                    # We have enough material to cut
-                    new_data = new_data[cut:]
-                    # print "Cutting " + cut + "characters"
-                    cut = 0
-                elif cut >= len(new_data):
-                    # Cut everything
-                    cut -= len(new_data)
-                    new_data = ''
-                channel_data += new_data
-                # TODO Detect ending prompt and stop it from being shown. For this we will have to wait until a newline
-                # TODO comes and then we can decide if we want to print it or not.
-                if new_data.find('[TPM]$ ') == -1 and new_data != '':
-                    print new_data,
-            else:
-                continue
-            if channel_data.endswith(self.prompt):
-                return channel_data[:-len(self.prompt)]
+        return self.stream_cmd(command, [print_line], timeout=timeout).stdout
+
+    def stream_cmd(self, command, callbacks=(), tail=TAIL_LINES, log_path=None, timeout=None):
+        """
+        Executes command and passes every line of its output to the callbacks as soon as it arrives. Only the last
+        lines are kept in memory, so the memory usage doesn't depend on the length of the output.
+        @param command: Command to execute
+        @param callbacks: List of functions that are called with every line of the output (without the newline).
+        @param tail: Number of last lines to keep for the result
+        @param log_path: If set, full output is also saved to a gzip compressed file at this path.
+        @param timeout: Number of seconds to wait for a new piece of output. None means wait forever.
+        @return: CommandResult with the last lines of the output as stdout and the exit status of the command.
+        """
+        stream = LineStream(callbacks, tail, log_path)
+        printer = EchoPrinter(len(command)+2, len(self.prompt), stream.feed)
+        self.channel.send(command + '\n')
+        try:
+            self.read_until(self.prompt, timeout, printer.feed, keep=False)
+        finally:
+            stream.close()
+        exit_status = self.exec_cmd('echo $?', timeout)
+        return CommandResult(stream.text(), '', int(exit_status.strip()))
+
+    def run(self, command, timeout=None, stdin=None):
+        """
+        Executes a command in a separate exec channel. Unlike exec_cmd, it doesn't depend on the prompt and the state
+        of the interactive shell (e.g. current directory).
+        @param command: Command to execute
+        @param timeout: Number of seconds to wait for a new piece of output. None means wait forever.
+        @param stdin: Data sent to the standard input of the command. Input is closed afterwards.
+        @return: CommandResult with standard output, standard error output and exit status of the command.
+        """
+        return self.run_many({command: command}, timeout, {command: stdin})[command]
+
+    def run_many(self, commands, timeout=None, stdin=None):
+        """
+        Executes several commands at once. Every command gets its own exec channel on the same SSH transport, so they
+        all run in parallel and their outputs are read as they arrive.
+        @param commands: Dictionary of commands to execute. Keys are arbitrary names used in the returned dictionary.
+        @param timeout: Number of seconds to wait for a new piece of output. None means wait forever.
+        @param stdin: Dictionary with data for the standard input of the commands. Keys are the same as in commands.
+        @return: Dictionary of CommandResult objects under the same keys as in commands.
+        """
+        transport = self.ssh.get_transport()
+        running = {}
+        for name, command in commands.items():
+            channel = transport.open_session()
+            channel.exec_command(command)
+            if stdin is not None and stdin.get(name) is not None:
+                channel.sendall(stdin[name])
+            channel.shutdown_write()
+            running[channel] = (name, bytearray(), bytearray())
+        results = {}
+        while running:
+            readable, _, _ = select.select(list(running), [], [], timeout)
+            if not readable:
+                for channel in running:
+                    channel.close()
+                raise timeout_error('No output from the virtual machine in ' + str(timeout) + ' seconds')
+            for channel in readable:
+                name, stdout, stderr = running[channel]
+                if channel.recv_ready():
+                    stdout.extend(channel.recv(RECV_SIZE))
+                elif channel.recv_stderr_ready():
+                    stderr.extend(channel.recv_stderr(RECV_SIZE))
+                else:
+                    # Channel is readable without any data, so the command has ended
+                    results[name] = CommandResult(bytes(stdout), bytes(stderr), channel.recv_exit_status())
+                    channel.close()
+                    del running[channel]
+        return results
 
     def close(self):
         """
@@ -123,27 +202,149 @@ class Shell:
         self.ssh.close()
 
 
-def connect(args):
+class EchoPrinter:
+    """
+    Prints output of a command as it arrives. Echo of the command is cut from the beginning and the ending prompt is
+    never printed.
+    """
+    def __init__(self, cut, prompt_length, write=None):
+        """
+        @param cut: Number of characters that needs to be cut before actual output begins
+        @param prompt_length: Length of the prompt that ends the output
+        @param write: Function that receives the output. Output is written to the standard output if it's None.
+        """
+        self.cut = cut
+        self.prompt_length = prompt_length
+        self.write = write
+        self.pending = bytearray()
+
+    def feed(self, new_data):
+        """
+        Prints a new piece of output. End of the output is held back until more data arrives, because it may be
+        the beginning of the prompt.
+        @param new_data: Data received from the channel
+        """
+        if self.cut:
+            skipped = min(self.cut, len(new_data))
+            new_data = new_data[skipped:]
+            self.cut -= skipped
+        self.pending.extend(new_data)
+        if len(self.pending) > self.prompt_length:
+            split = len(self.pending) - self.prompt_length
+            (self.write or sys.stdout.write)(bytes(self.pending[:split]))
+            del self.pending[:split]
+
+
+class LineStream:
+    """
+    Splits output of a command into lines and passes them to callbacks. Only the last lines are kept in a ring
+    buffer, optionally the whole output is saved into a compressed file.
+    """
+    def __init__(self, callbacks=(), tail=TAIL_LINES, log_path=None):
+        """
+        @param callbacks: List of functions that are called with every line (without the newline).
+        @param tail: Number of last lines to keep
+        @param log_path: If set, all data are also saved to a gzip compressed file at this path.
+        """
+        self.callbacks = callbacks
+        self.tail = collections.deque(maxlen=tail)
+        self.partial = bytearray()
+        self.log = gzip.open(log_path, 'wb') if log_path is not None else None
+
+    def feed(self, data):
+        """
+        Processes a new piece of output. Unfinished line is kept until the rest of it arrives.
+        @param data: Data received from the command
+        """
+        if self.log is not None:
+            self.log.write(data)
+        self.partial.extend(data)
+        end = self.partial.rfind('\n')
+        if end != -1:
+            lines = bytes(self.partial[:end]).split('\n')
+            del self.partial[:end+1]
+            for line in lines:
+                self.line(line)
+        elif len(self.partial) > MAX_LINE:
+            # Very long line without a newline (e.g. a progress bar) is split, so it doesn't fill the memory
+            self.line(bytes(self.partial))
+            del self.partial[:]
+
+    def line(self, line):
+        """
+        Stores a line in the ring buffer and passes it to the callbacks.
+        @param line: Complete line of the output
+        """
+        line = line.rstrip('\r')
+        self.tail.append(line)
+        for callback in self.callbacks:
+            callback(line)
+
+    def close(self):
+        """
+        Processes the last unfinished line and closes the log file.
+        """
+        if self.partial:
+            self.line(bytes(self.partial))
+            del self.partial[:]
+        if self.log is not None:
+            self.log.close()
+
+    def text(self):
+        """
+        @return: Last lines of the output joined by newlines
+        """
+        return '\n'.join(self.tail)
+
+
+def print_line(line):
+    """
+    Prints a line of the output on the standard output.
+    @param line: Line without the newline
+    """
+    sys.stdout.write(line + '\n')
+
+
+def default_vm():
+    """
+    @return: Dictionary with name, ip and port of the virtual machine set up in the commons module.
+    """
+    return {'name': commons.VM_NAME, 'ip': commons.VM_IP, 'port': commons.VM_PORT}
+
+
+def connect(args, vm=None, output_path=None):
     """
     Connects to a virtual machine and performs checks for a new version of Medusa.
     Afterwards it executes the testing batch.
     @param args: Tuple of two lists. First list contains names of system calls to be tested and second one contains
      name of the testing suites to be run.
+    @param vm: Dictionary with name, ip and port of the virtual machine. Machine from the commons module is used if
+     it's None.
+    @param output_path: Folder where to put the results. OUTPUT_PATH from the commons module is used if it's None.
+    @return: 1 if the machine was rebooted to a new kernel and testing has to be started again, 0 otherwise.
+    RuntimeError is raised if the testing fails, results are downloaded but not saved to the results store.
     """
+    if vm is None:
+        vm = default_vm()
+    if output_path is None:
+        output_path = commons.OUTPUT_PATH
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    # Errors are raised instead of exiting, so a fleet can mark the machine as failed and continue with the others
     try:
-        ssh = Shell(commons.VM_IP, commons.VM_PORT, commons.USER_NAME, commons.USER_PASSWORD)
+        ssh = Shell(vm['ip'], vm['port'], commons.USER_NAME, commons.USER_PASSWORD)
     except error as e:
-        print e.args[1]
-        exit(-1)
-        return
+        raise RuntimeError('Connection to ' + vm['name'] + ' failed: ' + str(e.args[-1]))
     except paramiko.ssh_exception.AuthenticationException as e:
-        print e.message
-        exit(-1)
-        return
+        raise RuntimeError('Authentication to ' + vm['name'] + ' failed: ' + e.message)
     # Downloading new version from repository
     print 'Checking for new version of Medusa (this may take a while)'
     ssh.exec_cmd('cd ' + commons.MEDUSA_PATH)
-    git_result = ssh.exec_cmd('git pull')
+    git_pull = 'cd ' + commons.MEDUSA_PATH + ' && git pull'
+    # Independent checks are executed at the same time as the git pull
+    checks = ssh.run_many({'git': git_pull, 'sudo': 'sudo -n true'})
+    sudo_active = checks['sudo'].exit_status == 0
+    git_result = checks['git'].stdout + checks['git'].stderr
     while True:
         if 'Already up-to-date.' in git_result:
             print 'Medusa is up-to-date.'
@@ -151,22 +352,7 @@ def connect(args):
             # continue
         elif 'Updating' in git_result:
             print 'Medusa was updated.'
-            # assume that the newest kernel is automatically the default one
-            compile_command = commons.MEDUSA_PATH + '/build.sh --noreboot'
-            if commons.NO_GRUB:
-                compile_command += ' --nogdb'
-            if is_kernel_same(ssh):
-                compile_command += ' --medusa-only'
-            ssh.instant_cmd(compile_command)
-            print 'Kernel compiled'
-            if is_sudo_active(ssh):
-                ssh.channel.send('sudo reboot\n')
-            else:
-                ssh.channel.send('sudo reboot\n' + commons.USER_PASSWORD + '\n')
-            ssh.close()
-            print 'Rebooting the system'
-            return 1
-            # TODO Don't save the output, it's too much
+            break
         elif 'Please, commmit your changes or stash them before you can merge.' in git_result:
             # TODO Make this selectable at the start of the script
             while True:
@@ -176,9 +362,9 @@ def connect(args):
                 break
             elif choice == '' or 'n' or 'no':
                 ssh.close()
-                exit()
-            ssh.exec_cmd('git reset --hard HEAD')
-            git_result = ssh.exec_cmd('git pull')
+                raise RuntimeError('Update of Medusa was cancelled')
+            git_result = ssh.run('cd ' + commons.MEDUSA_PATH + ' && git reset --hard HEAD && git pull')
+            git_result = git_result.stdout + git_result.stderr
             continue
         elif 'fatal: unable to access' in git_result:
             print "Couldn't connect to git. Continuing with current version."
@@ -186,35 +372,290 @@ def connect(args):
         else:
             raise RuntimeError('Unrecognized git response')
     # TODO add else for no Internet connection
+    # Build is decided by the manifest of the last build, not by the git output
+    state = kernel_state(ssh)
+    manifest = state['manifest']
+    if manifest is not None and manifest['key'] == state['key']:
+        if state['running'] == manifest['release'] and state['boot'] > manifest['built_at']:
+            print 'Running kernel is built from commit ' + state['key']['commit'] + ', build skipped (saved %d s)' % \
+                  manifest['duration']
+        else:
+            print 'Kernel is already built from commit ' + state['key']['commit'] + ', but not running'
+            reboot(ssh, sudo_active)
+            return 1
+    else:
+        build_kernel(ssh, state, output_path)
+        reboot(ssh, sudo_active)
+        return 1
     # Check if testing environment is located on VM. If not, copy it.
     upload_testing_suite(ssh, args)
     print 'Start of testing procedure'
+    started = time.time()
     # TODO Implement a bit safer version with sudo -k, with more attempts than just one and with better output control
-    if is_sudo_active(ssh):
+    if sudo_active:
         print 'Sudo is active, no need to input password'
         # Starting without sudo, need to adjust accordingly
         # TODO Change way of accessing sudo
-        ssh.instant_cmd('sudo python3 ' + commons.VM_MTE_PATH + '/testing.py pickled_tests')
+        testing = ssh.stream_cmd('sudo python3 ' + commons.VM_MTE_PATH + '/testing.py pickled_tests', [print_line])
     else:
         # password = raw_input('Please enter your sudo password to continue: ')
-        ssh.instant_cmd('sudo python3 ' + commons.VM_MTE_PATH + '/testing.py pickled_tests\n' + commons.USER_PASSWORD)
+        testing = ssh.stream_cmd('sudo python3 ' + commons.VM_MTE_PATH + '/testing.py pickled_tests\n' +
+                                 commons.USER_PASSWORD, [print_line])
     print 'End of testing procedure'
-    transport_results(ssh, args[1])
+    transport_results(ssh, args[1], output_path=output_path)
     ssh.close()
+    # Results of a failed run may be incomplete, they are kept for inspection but not added to the history
+    if testing.exit_status != 0:
+        raise RuntimeError('Testing on ' + vm['name'] + ' failed with exit status ' + str(testing.exit_status) +
+                           ', results were not saved to the results store')
+    store = ResultsStore()
+    run = store.import_run(output_path, args[1], vm['name'], state['key']['commit'], state['running'], started)
+    store.close()
+    print 'Results saved to the results store as run ' + str(run)
     return 0
 
 
-def transport_results(ssh, suites):
+def kernel_state(ssh):
+    """
+    Finds out which Medusa version is checked out, which kernel is running and what was built last time.
+    @param ssh: SSH connection
+    @return: Dictionary with these keys:
+     key - dictionary that identifies a build: commit and config (hash of the .config file)
+     medusa_only - True if the kernel version didn't change, so only Medusa needs to be rebuilt. It's not part of the
+     key, it changes when the built kernel is booted.
+     release - release of the kernel in the sources
+     running - release of the running kernel
+     boot - time of the boot of the virtual machine in seconds since the epoch
+     manifest - manifest saved after the last successful build (dictionary with key, medusa_only, release, built_at
+     and duration) or None if there is no manifest
+    """
+    medusa = 'cd ' + commons.MEDUSA_PATH + ' && '
+    state = ssh.run_many({'commit': medusa + 'git rev-parse HEAD',
+                          'config': medusa + 'md5sum .config',
+                          'release': medusa + 'make -s kernelrelease',
+                          'version': medusa + 'make -s kernelversion',
+                          'running': 'uname -r',
+                          'boot': "sed -n 's/^btime //p' /proc/stat",
+                          'manifest': 'cat ' + commons.VM_MTE_PATH + '/' + BUILD_MANIFEST})
+    running = state['running'].stdout.strip()
+    return {'key': {'commit': state['commit'].stdout.strip(),
+                    'config': state['config'].stdout.split(' ')[0]},
+            # Only Medusa is rebuilt if the kernel version didn't change
+            'medusa_only': running.startswith(state['version'].stdout.strip()),
+            'release': state['release'].stdout.strip(),
+            'running': running,
+            'boot': int(state['boot'].stdout.strip() or 0),
+            'manifest': json.loads(state['manifest'].stdout) if state['manifest'].exit_status == 0 else None}
+
+
+def build_kernel(ssh, state, output_path):
+    """
+    Builds the kernel and saves the build manifest on the virtual machine. Manifest is saved only if the build
+    succeeds, so an interrupted build is repeated next time.
+    @param ssh: SSH connection
+    @param state: State of the kernel returned by kernel_state
+    @param output_path: Folder where to save the build log
+    """
+    # assume that the newest kernel is automatically the default one
+    compile_command = commons.MEDUSA_PATH + '/build.sh --noreboot'
+    if commons.NO_GRUB:
+        compile_command += ' --nogdb'
+    if state['medusa_only']:
+        compile_command += ' --medusa-only'
+    if commons.CCACHE:
+        # Debian puts compiler wrappers of the ccache package into this folder
+        compile_command = 'PATH=/usr/lib/ccache:$PATH ' + compile_command
+    start = time.time()
+    build = ssh.stream_cmd(compile_command, [print_line], log_path=os.path.join(output_path, 'build.log.gz'))
+    if build.exit_status != 0:
+        ssh.close()
+        raise RuntimeError('Kernel build failed with exit status ' + str(build.exit_status) + ':\n' + build.stdout)
+    duration = time.time() - start
+    if state['manifest'] is not None:
+        print 'Kernel compiled in %d s (previous build took %d s)' % (duration, state['manifest']['duration'])
+    else:
+        print 'Kernel compiled in %d s' % duration
+    manifest = {'key': state['key'],
+                'medusa_only': state['medusa_only'],
+                'release': ssh.run('cd ' + commons.MEDUSA_PATH + ' && make -s kernelrelease').stdout.strip(),
+                'built_at': int(ssh.run('date +%s').stdout.strip()),
+                'duration': duration}
+    ssh.run('mkdir -p ' + commons.VM_MTE_PATH + ' && cat > ' + commons.VM_MTE_PATH + '/' + BUILD_MANIFEST,
+            stdin=json.dumps(manifest))
+
+
+def reboot(ssh, sudo_active):
+    """
+    Reboots the virtual machine and closes the connection.
+    @param ssh: SSH connection
+    @param sudo_active: True if sudo doesn't ask for password
+    """
+    if sudo_active:
+        ssh.channel.send('sudo reboot\n')
+    else:
+        ssh.channel.send('sudo reboot\n' + commons.USER_PASSWORD + '\n')
+    ssh.close()
+    print 'Rebooting the system'
+
+
+def transport_results(ssh, suites, compressed=True, output_path=None):
     """
     Downloads test results from virtual machine to the host.
     @param ssh: SSH connection to the virtual machine.
     @param suites: List of names of test suites that were executed.
+    @param compressed: If true, results are packed on the virtual machine into one compressed tar stream, which is
+    unpacked on the fly. Otherwise every file is downloaded separately by SCP.
+    @param output_path: Folder where to put the results. OUTPUT_PATH from the commons module is used if it's None.
+    """
+    if output_path is None:
+        output_path = commons.OUTPUT_PATH
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    files = result_files(suites)
+    # Files of a previous run are removed, so a file missing on the virtual machine isn't imported from it
+    for name in files[1:]:
+        if os.path.exists(os.path.join(output_path, name)):
+            os.remove(os.path.join(output_path, name))
+    if not compressed:
+        scp = SCPClient(ssh.ssh.get_transport())
+        scp.get(commons.TESTING_PATH + '/result_details', output_path, recursive=True)
+        for suite in suites:
+            scp.get(commons.TESTING_PATH + '/results_' + suite + '.html', output_path)
+            scp.get(commons.TESTING_PATH + '/durations_' + suite + '.json', output_path)
+            scp.get(commons.TESTING_PATH + '/results_' + suite + '.jsonl', output_path)
+            if suite == 'do_benchmark_tests':
+                scp.get(commons.TESTING_PATH + '/results_' + suite + '.json', output_path)
+        scp.close()
+        return
+    start = time.time()
+    channel = ssh.ssh.get_transport().open_session()
+    # Only some suites save machine-readable results, missing files are skipped
+    channel.exec_command('tar -czf - --ignore-failed-read -C ' + commons.TESTING_PATH + ' ' + ' '.join(files))
+    stream = CountingReader(channel.makefile('rb'))
+    unpacked = 0
+    tar = tarfile.open(fileobj=stream, mode='r|gz')
+    for member in tar:
+        tar.extract(member, output_path)
+        unpacked += member.size
+    tar.close()
+    if channel.recv_exit_status() != 0:
+        raise RuntimeError('Download of the results failed: ' + channel.makefile_stderr('rb').read())
+    channel.close()
+    print 'Results downloaded in %.2f s, %d bytes transferred instead of %d (%d bytes saved)' % \
+          (time.time() - start, stream.count, unpacked, unpacked - stream.count)
+
+
+def result_files(suites):
+    """
+    @param suites: List of names of test suites that were executed.
+    @return: List of names of files with results in the testing folder, the first one is the result_details folder.
+    """
+    return ['result_details'] + ['results_' + suite + '.html' for suite in suites] + \
+           ['results_' + suite + '.json' for suite in suites] + ['results_' + suite + '.jsonl' for suite in suites] + \
+           ['durations_' + suite + '.json' for suite in suites]
+
+
+class CountingReader:
+    """
+    File-like object that counts bytes read from the underlying file.
     """
-    scp = SCPClient(ssh.ssh.get_transport())
-    scp.get(commons.TESTING_PATH + '/result_details', commons.OUTPUT_PATH, recursive=True)
-    for suite in suites:
-        scp.get(commons.TESTING_PATH + '/results_' + suite + '.html', commons.OUTPUT_PATH)
-    scp.close()
+    def __init__(self, file):
+        """
+        @param file: File-like object to read from
+        """
+        self.file = file
+        self.count = 0
+
+    def read(self, size=-1):
+        """
+        Reads data from the underlying file.
+        @param size: Maximum number of bytes to read. Negative number reads everything.
+        @return: Read data
+        """
+        data = self.file.read(size)
+        self.count += len(data)
+        return data
+
+
+def probe_ssh(ip, port, timeout=PROBE_DELAY_LAST):
+    """
+    Checks if an SSH server is listening. Accepted TCP connection is not enough, because forwarded ports of VirtualBox
+    accept connections even if the guest is not running, so the server has to send its banner.
+    @param ip: IP address of the server
+    @param port: Port of the server
+    @param timeout: Number of seconds to wait for the connection and the banner
+    @return: True if the server sent an SSH banner.
+    """
+    try:
+        sock = socket.create_connection((ip, port), timeout)
+        try:
+            sock.settimeout(timeout)
+            banner = sock.recv(256)
+        finally:
+            sock.close()
+    except error:
+        return False
+    return banner.startswith('SSH-')
+
+
+def probe_echo(ip, port, username, password, timeout=PROBE_DELAY_LAST):
+    """
+    Checks if the virtual machine is able to execute commands by running echo over a new SSH connection.
+    @param ip: IP address of the server
+    @param port: Port of the server
+    @param username: Username
+    @param password: Password of the chosen user.
+    @param timeout: Number of seconds to wait for the connection and the output
+    @return: True if the echo returned expected output.
+    """
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(ip, port=port, username=username, password=password, timeout=timeout)
+        stdin, stdout, stderr = client.exec_command('echo mte-ready', timeout=timeout)
+        return 'mte-ready' in stdout.read()
+    except (error, paramiko.SSHException, EOFError):
+        return False
+    finally:
+        client.close()
+
+
+def wait_for_ssh(ip, port, username=None, password=None, deadline=BOOT_DEADLINE):
+    """
+    Waits until the virtual machine accepts SSH connections. Server is probed repeatedly with growing delays
+    between the probes.
+    @param ip: IP address of the server
+    @param port: Port of the server
+    @param username: Username. If it's set, an echo command has to succeed too.
+    @param password: Password of the chosen user.
+    @param deadline: Maximum number of seconds to wait
+    @return: Number of seconds it took the machine to get ready.
+    """
+    start = time.time()
+    delay = PROBE_DELAY_FIRST
+    while True:
+        if probe_ssh(ip, port) and (username is None or probe_echo(ip, port, username, password)):
+            return time.time() - start
+        if time.time() - start + delay > deadline:
+            raise timeout_error('Virtual machine is not ready after ' + str(deadline) + ' seconds')
+        time.sleep(delay)
+        delay = min(delay * 2, PROBE_DELAY_LAST)
+
+
+def wait_for_shutdown(ip, port, deadline=SHUTDOWN_DEADLINE):
+    """
+    Waits until the SSH server of a rebooting virtual machine stops responding.
+    @param ip: IP address of the server
+    @param port: Port of the server
+    @param deadline: Maximum number of seconds to wait
+    @return: True if the server went down, False if it was still responding at the deadline.
+    """
+    start = time.time()
+    while time.time() - start < deadline:
+        if not probe_ssh(ip, port, PROBE_DELAY_FIRST * 4):
+            return True
+        time.sleep(PROBE_DELAY_FIRST)
+    return False
 
 
 def is_sudo_active(ssh):
@@ -223,66 +664,59 @@ def is_sudo_active(ssh):
     @param ssh: SSH connection
     @return: True if sudo works without password. False if sudo asks for password.
     """
-    sudo = ssh.exec_cmd('sudo -n true 2>/dev/null && echo "True" || echo "False"')
-    return 'True' in sudo
-    # if sudo.find('True') != -1:
-    #     return True
-    # else:
-    #     return False
+    return ssh.run('sudo -n true').exit_status == 0
 
 
 def upload_testing_suite(ssh, tests):
     """
     Uploads files needed for testing. These are defined in files set.
     Also uploads pickled tests chosen by user in host system.
+    Hashes of all remote files are fetched with one command and only the changed files are sent together with the
+    pickled tests in one compressed tar stream, so the upload takes two round trips regardless of the number of files.
     @param ssh: SSH connection
     @param tests: Tuple of two lists. First list contains names of system calls to be tested and second one contains
      name of the testing suites to be run.
     """
-    # Set current directory to a folder, where the running script is located
-    # print os.path.realpath(__file__)
-    os.chdir(os.path.dirname(os.path.realpath(__file__)))
-    scp = SCPClient(ssh.ssh.get_transport())
+    # Files are located in the same folder as the running script
+    local_path = os.path.dirname(os.path.realpath(__file__))
     # These files will be copied from host computer to guest
-    files = {'report.py', 'asynchronous_reader.py', 'commons.py', 'testing.py', 'config.py', 'fork', 'validator.py'}
-    path_exists = ssh.exec_cmd('[ -d ' + commons.VM_MTE_PATH + ' ] && echo "True" || echo "False"')
-    if 'False' in path_exists:
-        # create path if it doesn't exist and copy all files without checking diference
-        # TODO What if the path is invalid?
-        ssh.exec_cmd('mkdir -p ' + commons.VM_MTE_PATH)
-        for f in files:
-            scp.put(f, commons.VM_MTE_PATH, preserve_times=True)
-    else:
-        for f in files:
-            file_exists = ssh.exec_cmd('[ -f ' + commons.VM_MTE_PATH + '/' + f + ' ] && echo "True" || echo "False"')
-            if file_exists.find('True') != -1:
-                local_hash = hashlib.md5(open(f, 'rb').read()).digest()
-                remote_hash = ssh.exec_cmd('md5sum ' + commons.VM_MTE_PATH + '/' + f)
-                if remote_hash.find(local_hash) == -1:
-                    scp.put(f, commons.VM_MTE_PATH, preserve_times=True)
-            else:
-                scp.put(f, commons.VM_MTE_PATH, preserve_times=True)
+    files = {'report.py', 'asynchronous_reader.py', 'commons.py', 'testing.py', 'config.py', 'fork', 'validator.py',
+             'kernel_log.py', 'syscalls.py', 'fixtures.py', 'constable_manager.py', 'log_proc.py'}
+    # Files with definitions of tests, see the config module
+    files.update('tests/' + f for f in os.listdir(os.path.join(local_path, 'tests')) if f.endswith('.json'))
+    # Benchmarks are run by hand on the virtual machine
+    files.update('benchmarks/' + f for f in os.listdir(os.path.join(local_path, 'benchmarks')) if f.endswith('.py'))
+    # TODO What if the path is invalid?
+    hashes = ssh.run('mkdir -p ' + commons.VM_MTE_PATH + ' && cd ' + commons.VM_MTE_PATH + ' && md5sum ' +
+                     ' '.join(sorted(files)) + ' 2>/dev/null')
+    remote_hashes = {}
+    for line in hashes.stdout.splitlines():
+        # md5sum prints the hash and the file name, missing files are not listed at all
+        remote_hash, name = line.split(None, 1)
+        remote_hashes[name.lstrip('*')] = remote_hash
+    changed = [f for f in sorted(files)
+               if remote_hashes.get(f) != hashlib.md5(open(os.path.join(local_path, f), 'rb').read()).hexdigest()]
+    print 'Uploading ' + str(len(changed)) + ' changed file(s) of the testing suite'
+    archive = io.BytesIO()
+    tar = tarfile.open(fileobj=archive, mode='w:gz')
+    for f in changed:
+        tar.add(os.path.join(local_path, f), arcname=f)
     # Also upload pickled test names
-    with open('pickled_tests', 'wb') as f:
-        pickle.dump(tests, f)
-    scp.put('pickled_tests', commons.VM_MTE_PATH, preserve_times=True)
-    scp.close()
-
-
-def is_kernel_same(ssh):
-    """
-    Checks if kernel changed during git update.
-    @param ssh: SSH connection
-    @return: True if kernel didn't change. False if kernel changed.
-    """
-    new = ssh.exec_cmd('make kernelversion')
-    running = ssh.exec_cmd('uname -r')
-    return running.startswith(new)
+    pickled_tests = pickle.dumps(tests)
+    info = tarfile.TarInfo('pickled_tests')
+    info.size = len(pickled_tests)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(pickled_tests))
+    tar.close()
+    result = ssh.run('tar -xzf - -C ' + commons.VM_MTE_PATH, stdin=archive.getvalue())
+    if result.exit_status != 0:
+        raise RuntimeError('Upload of the testing suite failed: ' + result.stderr)
 
 
 def setup_virtual_pc():
     """
-    Installs the pexpect module on the virtual machine, for the asynchronous reader to work.
+    Checks the connection to the virtual machine and its Python 3. Scripts executed on the virtual machine use only
+    the standard library, so nothing else has to be installed.
     """
     try:
         ssh = Shell(commons.VM_IP, commons.VM_PORT, commons.USER_NAME, commons.USER_PASSWORD)
@@ -294,7 +728,9 @@ def setup_virtual_pc():
         print e.message
         exit(-1)
         return
-    ssh.instant_cmd('python3 -m pip install pexpect')
+    version = ssh.run('python3 --version')
+    # Older versions print it to the error output
+    print (version.stdout + version.stderr).strip()
     # ssh.exec_cmd('sudo init 0')
     ssh.close()
 
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""@package mte.stand_in
+Local stand-in for the SSH server of a virtual machine. Commands are executed on the host, so the shell module can be
+checked without a virtual machine. The server can start listening after a delay, like a booting machine.
+Run this module as a script to check the shell module against the stand-in, or with the benchmark argument to measure
+host CPU time per command (see benchmark):
+>>> server = StandIn(delay=1)
+>>> boot = shell.wait_for_ssh('127.0.0.1', server.port, USER, PASSWORD, deadline=30)
+>>> 1 <= boot < 5
+True
+>>> ssh = shell.Shell('127.0.0.1', server.port, USER, PASSWORD)
+>>> ssh.run('echo out; echo err >&2; exit 3')
+CommandResult(stdout='out\\n', stderr='err\\n', exit_status=3)
+>>> ssh.run('cat', stdin='data')
+CommandResult(stdout='data', stderr='', exit_status=0)
+>>> start = time.time()
+>>> results = ssh.run_many({'a': 'sleep 1; echo a', 'b': 'sleep 1; echo b; exit 1'})
+>>> time.time() - start < 1.8
+True
+>>> sorted((name, result.stdout, result.exit_status) for name, result in results.items())
+[('a', 'a\\n', 0), ('b', 'b\\n', 1)]
+>>> ssh.run('sleep 5', timeout=0.5)
+Traceback (most recent call last):
+timeout: No output from the virtual machine in 0.5 seconds
+>>> lines = []
+>>> ssh.stream_cmd('seq 3; false', [lines.append])
+CommandResult(stdout='1\\n2\\n3', stderr='', exit_status=1)
+>>> lines
+['1', '2', '3']
+>>> ssh.stream_cmd('true').exit_status
+0
+>>> ssh.exec_cmd('echo hello')
+'hello\\r\\n'
+>>> ssh.close()
+>>> server.stop()
+>>> shell.wait_for_shutdown('127.0.0.1', server.port, 5)
+True
+>>> late = StandIn(delay=10)
+>>> shell.wait_for_ssh('127.0.0.1', late.port, deadline=2)
+Traceback (most recent call last):
+timeout: Virtual machine is not ready after 2 seconds
+>>> late.stop()
+"""
+import fcntl
+import logging
+import os
+import pty
+import socket
+import subprocess
+import sys
+import termios
+import threading
+import time
+
+import paramiko
+
+import shell
+
+# Credentials accepted by the stand-in
+USER = 'mte'
+PASSWORD = 'mte'
+# Number of bytes copied between a channel and a process at once
+COPY_SIZE = 32768
+
+# Probes of the banner disconnect without negotiation, which paramiko logs as errors
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+
+class StandIn:
+    def __init__(self, delay=0, user=USER, password=PASSWORD):
+        """
+        Starts the server in a background thread. It listens on a free port of the loopback interface.
+        @param delay: Number of seconds after which the server starts listening
+        @param user: Accepted username
+        @param password: Accepted password
+        """
+        self.user = user
+        self.password = password
+        self.key = paramiko.RSAKey.generate(2048)
+        # The port is reserved only until the server starts listening, like a port forwarded to a booting machine
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        self.listener = None
+        self.transports = []
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__serve, args=(delay,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __serve(self, delay):
+        """
+        Accepts connections until the server is stopped.
+        @param delay: Number of seconds to wait before listening
+        """
+        if self.stopped.wait(delay):
+            return
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', self.port))
+        self.listener.listen(16)
+        self.listening.set()
+        while not self.stopped.is_set():
+            try:
+                connection, address = self.listener.accept()
+            except socket.error:
+                break
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.key)
+            self.transports.append(transport)
+            try:
+                transport.start_server(server=Session(self))
+            except (paramiko.SSHException, EOFError, socket.error):
+                # Probes of the banner disconnect without negotiation
+                transport.close()
+
+    def stop(self):
+        """
+        Closes the listening socket and all connections.
+        """
+        self.stopped.set()
+        if self.listener is not None:
+            # Shutdown wakes up the accept in the thread
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.listener.close()
+        for transport in self.transports:
+            transport.close()
+        self.thread.join()
+
+
+class Session(paramiko.ServerInterface):
+    """
+    Handles requests of one connection. Interactive shell is bash in a terminal, exec requests are executed by bash
+    with separate standard and error output.
+    """
+    def __init__(self, server):
+        """
+        @param server: StandIn which accepted the connection
+        """
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == self.server.user and password == self.server.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        _start(_shell, channel)
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        _start(_execute, channel, command)
+        return True
+
+
+class Backend:
+    """
+    Stand-in for virtual.VirtualBoxBackend. States of the machines and their snapshots are only recorded, so the fleet
+    module can be checked without VirtualBox.
+    """
+    def __init__(self, snapshots=()):
+        """
+        @param snapshots: Pairs of names of virtual machines and names of their existing snapshots
+        """
+        self.running = set()
+        self.snapshots = set(snapshots)
+
+    def start(self, name, front_end='gui'):
+        """
+        @return: True if the machine was started, False if it was already running.
+        """
+        if name in self.running:
+            return False
+        self.running.add(name)
+        return True
+
+    def restore_snapshot(self, name, snapshot):
+        """
+        @return: True if the snapshot was restored, False if the machine has no snapshot with this name.
+        """
+        if (name, snapshot) not in self.snapshots:
+            return False
+        # Machine is powered off to restore the snapshot
+        self.running.discard(name)
+        return True
+
+    def take_snapshot(self, name, snapshot):
+        self.snapshots.add((name, snapshot))
+
+
+class VirtualBoxManager:
+    """
+    Stand-in for the VirtualBox API (VirtualBoxManager of the vboxapi module) used by virtual.VirtualBoxBackend.
+    Machines are added to vbox.machines, see Machine.
+    """
+    def __init__(self, style=None, params=None):
+        self.vbox = VirtualBox()
+        self.constants = Constants()
+
+    def getSessionObject(self, vbox):
+        return Session()
+
+    def initPerThread(self):
+        pass
+
+
+class Constants:
+    LockType_Shared = 'Shared'
+    LockType_Write = 'Write'
+    # Values of enumerations used by the backend, values are the same as the names
+    ENUMERATIONS = {'MachineState': ('PoweredOff', 'Saved', 'Running'), 'SessionState': ('Unlocked', 'Locked')}
+
+    def all_values(self, enumeration):
+        return dict((name, name) for name in self.ENUMERATIONS[enumeration])
+
+
+class VirtualBox:
+    version = 'stand-in'
+
+    def __init__(self):
+        self.machines = {}
+
+    def findMachine(self, name):
+        return self.machines[name]
+
+
+class Machine(object):
+    """
+    Virtual machine with its state and snapshots. Like a real machine, it keeps its session locked for a while after
+    it's powered off and it can't be locked for writing until then.
+    """
+    def __init__(self, name, state='PoweredOff', unlock_delay=3):
+        """
+        @param name: Name of the machine
+        @param state: Initial state, PoweredOff, Saved or Running
+        @param unlock_delay: Number of checks of the session state after a power off that still find it locked
+        """
+        self.name = name
+        self.state = state
+        self.unlock_delay = unlock_delay
+        self.snapshots = []
+        self.lock = None
+        self.releasing = 0
+        self.next_id = 1
+
+    @property
+    def snapshotCount(self):
+        return len(self.snapshots)
+
+    @property
+    def sessionState(self):
+        if self.releasing:
+            self.releasing -= 1
+            return 'Locked'
+        return 'Unlocked' if self.lock is None else 'Locked'
+
+    def findSnapshot(self, name):
+        for snapshot in self.snapshots:
+            if snapshot.name == name:
+                return snapshot
+        raise RuntimeError('Snapshot ' + name + ' not found')
+
+    def launchVMProcess(self, session, front_end, environment):
+        if self.state not in ('PoweredOff', 'Saved'):
+            raise RuntimeError('Machine ' + self.name + ' is ' + self.state)
+        self.state = 'Running'
+        return Progress()
+
+    def lockMachine(self, session, lock_type):
+        if lock_type == 'Write' and (self.state == 'Running' or self.sessionState != 'Unlocked'):
+            raise RuntimeError('Machine ' + self.name + ' is locked')
+        self.lock = lock_type
+        session.machine = self
+        session.console = Console(self)
+
+    def restoreSnapshot(self, snapshot):
+        self.state = snapshot.state
+        return Progress()
+
+    def takeSnapshot(self, name, description, pause):
+        # Snapshot of a running machine is restored to the saved state
+        snapshot = Snapshot(name, self.next_id, 'Saved' if self.state == 'Running' else self.state)
+        self.next_id += 1
+        self.snapshots.append(snapshot)
+        return Progress(), snapshot.id
+
+    def deleteSnapshot(self, snapshot_id):
+        self.snapshots = [snapshot for snapshot in self.snapshots if snapshot.id != snapshot_id]
+        return Progress()
+
+
+class Snapshot:
+    def __init__(self, name, snapshot_id, state):
+        self.name = name
+        self.id = snapshot_id
+        self.state = state
+
+
+class Session:
+    def __init__(self):
+        self.machine = None
+        self.console = None
+
+    def unlockMachine(self):
+        self.machine.lock = None
+
+
+class Console:
+    def __init__(self, machine):
+        self.machine = machine
+
+    def powerDown(self):
+        self.machine.state = 'PoweredOff'
+        # Process of the machine releases its session later
+        self.machine.releasing = self.machine.unlock_delay
+        return Progress()
+
+
+class Progress:
+    def waitForCompletion(self, timeout):
+        pass
+
+
+def benchmark(command='sleep 0.1; echo x', repetitions=20):
+    """
+    Measures CPU time which the host spends waiting for output of a command. Busy waiting would use all of the
+    duration of the command, a blocking read only a small part of it.
+    @param command: Command executed repeatedly in the shell
+    @param repetitions: Number of executions
+    @return: Tuple of mean wall-clock time and mean CPU time of this process per command in seconds. The CPU time
+    includes the stand-in server, which runs in the same process.
+    """
+    server = StandIn()
+    server.listening.wait()
+    ssh = shell.Shell('127.0.0.1', server.port, USER, PASSWORD)
+    start_time = time.time()
+    start = os.times()
+    for i in range(repetitions):
+        ssh.exec_cmd(command)
+    end = os.times()
+    duration = time.time() - start_time
+    ssh.close()
+    server.stop()
+    cpu = end[0] + end[1] - start[0] - start[1]
+    return duration / repetitions, cpu / repetitions
+
+
+def _start(target, *args):
+    """
+    Runs a function in a daemon thread.
+    """
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def _shell(channel):
+    """
+    Connects an interactive bash in a new terminal to the channel. The terminal echoes the commands and ends lines
+    with \\r\\n like the terminal of the virtual machine.
+    @param channel: Channel of the shell request
+    """
+    master, slave = pty.openpty()
+    environment = dict(os.environ, PS1='$ ', TERM='dumb')
+    process = subprocess.Popen(['bash', '--noprofile', '--norc', '--noediting', '-i'], stdin=slave, stdout=slave,
+                               stderr=slave, env=environment, preexec_fn=_controlling_terminal, close_fds=True)
+    os.close(slave)
+    _start(_copy_input, channel, lambda data: os.write(master, data))
+    while True:
+        try:
+            data = os.read(master, COPY_SIZE)
+        except OSError:
+            # Terminal returns EIO after bash exits
+            data = ''
+        if not data:
+            break
+        channel.sendall(data)
+    process.wait()
+    os.close(master)
+    channel.send_exit_status(process.returncode)
+    channel.close()
+
+
+def _execute(channel, command):
+    """
+    Executes a command of an exec request and sends its outputs and exit status to the channel.
+    @param channel: Channel of the exec request
+    @param command: Command to execute
+    """
+    process = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, close_fds=True)
+    _start(_copy_input, channel, process.stdin.write, process.stdin.close)
+    errors = threading.Thread(target=_copy_output, args=(process.stderr, channel.sendall_stderr))
+    errors.start()
+    _copy_output(process.stdout, channel.sendall)
+    errors.join()
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+def _copy_input(channel, write, close=None):
+    """
+    Copies data received from a channel to a process until the input of the channel is closed.
+    @param channel: Channel
+    @param write: Function which writes the data to the process
+    @param close: Function called at the end of the input
+    """
+    while True:
+        try:
+            data = channel.recv(COPY_SIZE)
+        except socket.error:
+            data = ''
+        if not data:
+            break
+        try:
+            write(data)
+        except (OSError, IOError):
+            break
+    if close is not None:
+        close()
+
+
+def _copy_output(stream, send):
+    """
+    Copies an output of a process to a channel.
+    @param stream: Output of the process
+    @param send: Method of the channel which sends the data
+    """
+    for data in iter(lambda: os.read(stream.fileno(), COPY_SIZE), ''):
+        send(data)
+    stream.close()
+
+
+def _controlling_terminal():
+    """
+    Makes the terminal on the standard input the controlling terminal of a new session, so bash can control jobs.
+    """
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        print('Wall-clock time %.3f s, CPU time %.3f s per command' % benchmark())
+    else:
+        import doctest
+        doctest.testmod()
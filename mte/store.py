@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""@package mte.store
+Keeps machine-readable results of all runs in an SQLite database on the host, so history of the tests can be queried.
+Records are written by the report module on the virtual machine (results_<suite>.jsonl) and imported after they are
+downloaded. Logs stay in the blob area of the downloaded results, records point to them by their keys.
+Run this module as a script with a query (see main), or without arguments to check it against an in-memory database.
+"""
+import base64
+import gzip
+import io
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+
+import commons
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    vm TEXT,
+    medusa_commit TEXT,
+    kernel TEXT,
+    path TEXT
+);
+CREATE TABLE IF NOT EXISTS invocations (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    suite TEXT NOT NULL,
+    test TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    valid INTEGER NOT NULL,
+    output_valid INTEGER,
+    dmesg_valid INTEGER,
+    constable_valid INTEGER,
+    duration REAL,
+    output TEXT,
+    system_log TEXT,
+    constable TEXT,
+    record TEXT
+);
+CREATE INDEX IF NOT EXISTS invocations_by_validity ON invocations (test, variant, valid, run);
+CREATE INDEX IF NOT EXISTS invocations_by_suite ON invocations (test, suite, variant, run, duration);
+"""
+# Logs of an invocation, their keys in the blob area are stored in columns with the same names
+LOGS = ('output', 'system_log', 'constable')
+# Seconds to wait for a lock of the database held by another thread (machines of a fleet import at the same time)
+LOCK_TIMEOUT = 30
+
+
+class ResultsStore:
+    """
+    >>> import shutil, tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> def save(mkdir, rmdir):
+    ...     with open(os.path.join(path, 'results_do_tests.jsonl'), 'w') as f:
+    ...         for test, valid in (('mkdir', mkdir), ('rmdir', rmdir)):
+    ...             f.write(json.dumps({'test': test, 'variant': 'allowed', 'output_valid': True,
+    ...                                 'dmesg_valid': valid, 'constable_valid': True, 'duration': 0.1}) + '\\n')
+    >>> store = ResultsStore(':memory:')
+    >>> save(True, True)
+    >>> store.import_run(path, ['do_tests'], 'vm', 'a1', '5.1', 100)
+    1
+    >>> save(False, True)
+    >>> store.import_run(path, ['do_tests'], 'vm', 'b2', '5.1', 200)
+    2
+    >>> save(True, True)
+    >>> store.import_run(path, ['do_tests'], 'vm', 'c3', '5.1', 300)
+    3
+    >>> save(False, False)
+    >>> store.import_run(path, ['do_tests', 'do_concurrent_tests'], 'vm', 'd4', '5.1', 400)
+    4
+    >>> print(store.first_failure('mkdir')['medusa_commit'])
+    b2
+    >>> print(store.regression('mkdir')['medusa_commit'])
+    d4
+    >>> store.regression('rmdir')['run'], store.first_failure('rmdir', after=4)
+    (4, None)
+    >>> store.regression('unlink') is None
+    True
+    >>> store.durations('mkdir', 'do_tests', runs=2)
+    [0.1, 0.1]
+    >>> store.close()
+    >>> shutil.rmtree(path)
+    """
+    def __init__(self, path=None):
+        """
+        Opens the database and creates its tables if they don't exist.
+        @param path: Path to the database file. RESULTS_DB from the commons module is used if it's None, results.sqlite
+        in OUTPUT_PATH if that's None too.
+        """
+        if path is None:
+            path = commons.RESULTS_DB or os.path.join(commons.OUTPUT_PATH, 'results.sqlite')
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.connection.executescript(SCHEMA)
+
+    def import_run(self, path, suites, vm=None, commit=None, kernel=None, started=None):
+        """
+        Imports records of a run downloaded from a virtual machine in one transaction.
+        @param path: Folder with downloaded results
+        @param suites: List of names of the executed suites. Suites without records are skipped.
+        @param vm: Name of the virtual machine
+        @param commit: Medusa commit the kernel was built from
+        @param kernel: Release of the running kernel
+        @param started: Time of the start of the run in seconds since the epoch. Current time is used if it's None.
+        @return: Id of the run
+        """
+        with self.connection:
+            run = self.connection.execute('INSERT INTO runs (started, vm, medusa_commit, kernel, path) '
+                                          'VALUES (?, ?, ?, ?, ?)',
+                                          (time.time() if started is None else started, vm, commit, kernel,
+                                           os.path.abspath(path))).lastrowid
+            for suite in suites:
+                records_path = os.path.join(path, 'results_' + suite + '.jsonl')
+                if not os.path.exists(records_path):
+                    continue
+                with open(records_path) as f:
+                    self.connection.executemany(
+                        'INSERT INTO invocations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (row(run, suite, line) for line in f if line.strip()))
+        return run
+
+    def first_failure(self, test, variant='allowed', after=None):
+        """
+        Finds the first failed invocation of a test, e.g. to find the commit that broke it.
+        @param test: Name of the test
+        @param variant: 'allowed' or 'denied' (command in the restricted space)
+        @param after: Id of a run. Only later runs are searched. The whole history is searched if it's None.
+        @return: Dictionary with run, suite, medusa_commit, kernel and started keys or None if the test didn't fail.
+        """
+        return self.__one('SELECT i.run, i.suite, r.medusa_commit, r.kernel, r.started FROM invocations i '
+                          'JOIN runs r ON r.id = i.run WHERE i.test = ? AND i.variant = ? AND i.valid = 0 '
+                          'AND i.run > ? ORDER BY i.run LIMIT 1', (test, variant, -1 if after is None else after))
+
+    def regression(self, test, variant='allowed'):
+        """
+        Finds where the current failure of a test started, i.e. the first failure after the last success.
+        @param test: Name of the test
+        @param variant: 'allowed' or 'denied' (command in the restricted space)
+        @return: Same as first_failure, None if the test didn't fail since it last succeeded.
+        """
+        last = self.connection.execute('SELECT MAX(run) FROM invocations WHERE test = ? AND variant = ? AND valid = 1',
+                                       (test, variant)).fetchone()[0]
+        return self.first_failure(test, variant, last)
+
+    def durations(self, test, suite, variant='allowed', runs=50):
+        """
+        @param test: Name of the test
+        @param suite: Name of the suite, durations in different suites are not comparable.
+        @param variant: 'allowed' or 'denied' (command in the restricted space)
+        @param runs: Number of the last runs of the test in the suite
+        @return: List of durations of the test in the last runs in seconds (from the newest)
+        """
+        return [duration for duration, in self.connection.execute(
+            'SELECT duration FROM invocations WHERE test = ? AND suite = ? AND variant = ? AND run >= '
+            '(SELECT MIN(run) FROM (SELECT DISTINCT run FROM invocations WHERE test = ? AND suite = ? AND variant = ? '
+            'ORDER BY run DESC LIMIT ?)) ORDER BY run DESC', (test, suite, variant, test, suite, variant, runs))]
+
+    def percentile(self, test, suite, fraction, variant='allowed', runs=50):
+        """
+        @param test: Name of the test
+        @param suite: Name of the suite
+        @param fraction: Percentile as a fraction, e.g. 0.95 for p95.
+        @param variant: 'allowed' or 'denied' (command in the restricted space)
+        @param runs: Number of the last runs of the test in the suite
+        @return: Nearest-rank percentile of durations in the last runs in seconds or None if the test never ran.
+        """
+        durations = sorted(duration for duration in self.durations(test, suite, variant, runs) if duration is not None)
+        if not durations:
+            return None
+        return durations[max(int(math.ceil(fraction * len(durations))) - 1, 0)]
+
+    def log(self, run, suite, test, variant, log):
+        """
+        Reads a log of an invocation from the downloaded results.
+        @param run: Id of the run
+        @param suite: Name of the suite
+        @param test: Name of the test
+        @param variant: 'allowed' or 'denied'
+        @param log: output, system_log or constable
+        @return: Text of the log or None if the invocation or its log is not available.
+        """
+        if log not in LOGS:
+            raise ValueError('Unknown log ' + log)
+        found = self.__one('SELECT r.path, i.' + log + ' AS blob FROM invocations i JOIN runs r ON r.id = i.run '
+                           'WHERE i.run = ? AND i.suite = ? AND i.test = ? AND i.variant = ?',
+                           (run, suite, test, variant))
+        if found is None or found['blob'] is None:
+            return None
+        path = os.path.join(found['path'], 'result_details', 'blobs', found['blob'] + '.js')
+        return load_blob(path) if os.path.exists(path) else None
+
+    def close(self):
+        self.connection.close()
+
+    def __one(self, query, parameters):
+        """
+        @return: First row of the query as a dictionary or None if there is no row.
+        """
+        cursor = self.connection.execute(query, parameters)
+        found = cursor.fetchone()
+        if found is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], found))
+
+
+def row(run, suite, line):
+    """
+    @param run: Id of the run
+    @param suite: Name of the suite
+    @param line: Line of results_<suite>.jsonl, see write_record in the report module.
+    @return: Tuple of values of a row of the invocations table
+    """
+    record = json.loads(line)
+    checks = [record.get(log + '_valid') for log in ('output', 'dmesg', 'constable')]
+    logs = record.get('logs', {})
+    return (run, suite, record['test'], record['variant'], int(all(checks)), checks[0], checks[1], checks[2],
+            record.get('duration')) + tuple(logs.get(log) for log in LOGS) + (line.strip(),)
+
+
+def load_blob(path):
+    """
+    @param path: Path to a blob created by BlobStore of the report module
+    @return: Text of the log stored in the blob
+    """
+    with open(path) as f:
+        data = f.read().split("'")[3]
+    return gzip.GzipFile(fileobj=io.BytesIO(base64.b64decode(data))).read().decode('utf-8')
+
+
+def main(argv):
+    """
+    Answers queries from the command line:
+     regression <test> [allowed|denied] - run and commit where the current failure of the test started
+     first-failure <test> [allowed|denied] - first run where the test failed
+     percentile <test> <suite> <fraction> [runs] - percentile of durations of the test in the last runs
+    @param argv: Arguments without the name of the script
+    """
+    store = ResultsStore()
+    if argv[0] in ('regression', 'first-failure'):
+        query = store.regression if argv[0] == 'regression' else store.first_failure
+        print(json.dumps(query(argv[1], argv[2] if len(argv) > 2 else 'allowed'), indent=2, sort_keys=True))
+    elif argv[0] == 'percentile':
+        print(store.percentile(argv[1], argv[2], float(argv[3]), runs=int(argv[4]) if len(argv) > 4 else 50))
+    else:
+        raise ValueError('Unknown query ' + argv[0])
+    store.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        main(sys.argv[1:])
+    else:
+        import doctest
+        doctest.testmod()
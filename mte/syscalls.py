@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""@package mte.syscalls
+Executes operations of tests directly from the testing process instead of starting a command for each of them.
+Errors are formatted like the messages of the coreutils commands, so the outputs can be validated with the same
+expectations as outputs of the commands.
+"""
+import collections
+import errno
+import locale
+import os
+
+# Operation performed by a test. Messages are format strings for each locale, {0}, {1}, ... are replaced with the
+# arguments of the operation and {error} with the description of the error.
+Operation = collections.namedtuple('Operation', ['function', 'messages'])
+
+
+def touch(path):
+    """ Creates a file like the touch command does.
+    @param path: Path to the file
+    """
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_NOCTTY | os.O_NONBLOCK, 0o666))
+    os.utime(path)
+
+
+operations = {
+    'symlink': Operation(os.symlink, {
+        'en': "ln: failed to create symbolic link '{1}': {error}",
+        'sk': "ln: failed to create symbolic link '{1}': {error}"}),
+    'link': Operation(os.link, {
+        'en': "ln: failed to create hard link '{1}' => '{0}': {error}",
+        'sk': "ln: failed to create hard link '{1}' => '{0}': {error}"}),
+    'mkdir': Operation(os.mkdir, {
+        'en': "mkdir: cannot create directory ‘{0}’: {error}",
+        'sk': "mkdir: nie je možné vytvoriť adresár `{0}': {error}"}),
+    'rmdir': Operation(os.rmdir, {
+        'en': "rmdir: failed to remove '{0}': {error}",
+        'sk': "rmdir: nepodarilo sa odstrániť '{0}': {error}"}),
+    'unlink': Operation(os.unlink, {
+        'en': "unlink: cannot unlink '{0}': {error}",
+        'sk': "unlink: nie je možné odpojiť (unlink) '{0}': {error}"}),
+    'rename': Operation(os.rename, {
+        'en': "mv: cannot move '{0}' to '{1}': {error}",
+        'sk': "mv: cannot move '{0}' to '{1}': {error}"}),
+    'touch': Operation(touch, {
+        'en': "touch: cannot touch '{0}': {error}",
+        'sk': "touch: nie je možné vykonať touch '{0}': {error}"}),
+    'mkfifo': Operation(os.mkfifo, {
+        'en': "mknod: {0}: {error}",
+        'sk': "mknod: {0}: {error}"}),
+}
+
+# Descriptions of errors are translated by the C library like in the outputs of the commands
+try:
+    locale.setlocale(locale.LC_MESSAGES, '')
+except locale.Error:
+    pass
+
+
+def execute(operation, language='en'):
+    """ Calls the function of an operation in the current working directory.
+    @param operation: Tuple with the name of the operation followed by its arguments, e.g. ('symlink', 'a', 'b').
+    @param language: Locale of the message, 'en' or 'sk'.
+    @return: Tuple of the error number (0 on success) and the output that the matching command would print.
+    >>> execute(('rmdir', 'does/not/exist'))
+    (2, "rmdir: failed to remove 'does/not/exist': No such file or directory\\n")
+    """
+    name, args = operation[0], operation[1:]
+    try:
+        operations[name].function(*args)
+    except OSError as e:
+        error = e.errno if e.errno is not None else errno.EIO
+        message = operations[name].messages[language].format(*args, error=os.strerror(error))
+        return error, message + '\n'
+    return 0, ''
@@ -1,216 +1,746 @@
 """@package mte.testing
 This module executes tests and testing suites
 """
+import collections
+import itertools
+import json
+import math
+import multiprocessing
 import os
 import pickle
+import random
 import shlex
+import statistics
 import subprocess
 import sys
 import threading
 import time
+from queue import Empty
 
 import commons
 import config
-from asynchronous_reader import Reader
-from report import ResultsDirector
+import syscalls
+from constable_manager import ConstableManager
+from fixtures import Fixture
+from kernel_log import KernelLog
+from report import ResultsDirector, clear_blobs, clear_results
 from validator import Validator
 
+# Seconds given to the workers of the concurrent suite to get ready for the release
+BARRIER_TIMEOUT = 30
+# Seconds given to a worker of the concurrent suite for each repetition of its command
+COMMAND_TIMEOUT = 30
+# Latency histogram of the stress suite: the first bucket ends at LATENCY_MIN seconds and every next one is
+# LATENCY_BUCKET_RATIO times longer, the buckets reach about 40 seconds
+LATENCY_MIN = 0.0000001
+LATENCY_BUCKET_RATIO = 1.02
+LATENCY_LOG_RATIO = math.log(LATENCY_BUCKET_RATIO)
+LATENCY_BUCKETS = 1000
+# Seconds between checks whether workers that haven't sent their results are still running
+RESULT_POLL = 1
+# Numbers of injected end markers
+sync_counter = itertools.count()
+# Reader of the kernel log, it's opened for the whole testing in test_director
+kernel_log = None
+# Preconditions of the selected tests, they are built in test_director
+fixture = None
+# Constable kept running across suites, it's created in test_director
+constable_manager = None
+
 
 def test_director(pickle_location):
     """ Unpickles tuple of tests and suites chosen by the user to be executed.
     Based on the selected tests, it creates configuration for Constable.
     @param pickle_location: File name of the pickled test information
     """
+    global kernel_log, fixture, constable_manager
+    # Results of previous runs would be downloaded as results of suites that fail in this one
+    clear_results(commons.TESTING_PATH)
+    kernel_log = KernelLog()
+    constable_manager = ConstableManager(kernel_log=kernel_log)
     # Unpickle test information that was prepared by hosting computer
     (tests, suites) = unpickle_tests(os.path.join(commons.VM_MTE_PATH, pickle_location))
     # We need to create configuration file just once
-    create_configuration(tests)
+    configuration = create_configuration(tests)
+    # Preconditions of all tests are created once and restored before each suite
+    fixture = Fixture(tests)
+    fixture.build()
+    # Logs of previous runs would be downloaded with the results of this one
+    clear_blobs(commons.TESTING_PATH)
     for suite in suites:
-        (results, outputs, outputs_denied) = start_suite(tests, suite)
-        (results, outputs, outputs_denied) = Validator.validate(results, outputs, outputs_denied)
+        (results, outputs, outputs_denied) = start_suite(tests, suite, configuration)
+        durations = []
+        if outputs is None:
+            # Results of serial suites are validated and written to the report one by one while the suite runs
+            results = watch_results(Validator.stream(results, tests), durations)
+        else:
+            (results, outputs, outputs_denied) = Validator.validate(results, outputs, outputs_denied)
+            durations = outputs + outputs_denied
         print('Generating report for ' + suite)
         ResultsDirector.generate_results(results, outputs, outputs_denied, suite, commons.TESTING_PATH)
+        fixture.stop_helpers()
+        save_durations(durations, suite)
+    constable_manager.stop()
+    fixture.clear()
+    kernel_log.close()
 
 
-def start_suite(tests, suite_name):
-    """ Main testing function, starts Constable and executes tests one after the other. When
+def start_suite(tests, suite_name, configuration):
+    """ Main testing function, makes sure Constable is running and executes tests one after the other. When
     all testing is done, results are sent to the validator module to be validated.
     @param tests: List of system calls to be tested and called
-    @param suite_name: Name of the suite. Currently two types of suites are supported: sequential (do_tests)
-    and concurrent (do_concurrent_tests)
-    @return: Tuple of results and outputs. Outputs list is included only in concurrent suite, otherwise it's None.
-    """
-    # clean dmesg before starting Constable
-    dmesg_before = subprocess.run(shlex.split('sudo dmesg -ce'), universal_newlines=True,
-                                  stdout=subprocess.PIPE).stdout
-    # TODO Decide what to do with dmesg_before (maybe filter it for medusa messages?)
-    # execute 'before' part of tests written in config file
-    prepare(tests)
-    # start constable and save its standard output
-    print('Starting Constable')
-    constable = Reader('sudo constable ' + commons.TESTING_PATH + '/constable.conf')
-    # Catch first outputs and save them independently to testing outputs
-    time.sleep(1)
-    print('Reading Constable')
-    constable_start = constable.read()
-    print('Running dmesg')
-    dmesg_start = subprocess.run(shlex.split('sudo dmesg -ce'), universal_newlines=True,
-                                 stdout=subprocess.PIPE).stdout
+    @param suite_name: Name of the suite. Currently four types of suites are supported: sequential (do_tests),
+    concurrent (do_concurrent_tests), stress (do_stress_tests) and benchmark (do_benchmark_tests)
+    @param configuration: Configuration of Constable, see create_configuration. Constable of the previous suite is
+    kept running if the configuration is the same.
+    @return: Tuple of results and outputs. Outputs list is included only in concurrent suite, otherwise it's None
+    and results may be an iterator which executes the tests as it's consumed. Helper processes of the tests are
+    left running, they are stopped by test_director when the results are reported.
+    """
+    # restore preconditions of the tests ('before' part written in config file). Restricted ones can't be created
+    # while Constable is running, it's stopped only if the previous suite changed them. Stress suite creates new ones.
+    if suite_name == 'do_stress_tests' or not fixture.restricted_intact():
+        constable_manager.stop()
+        fixture.restore()
+    else:
+        fixture.restore(restricted=False)
+    if suite_name == 'do_stress_tests':
+        prepare_stress()
+    if not constable_manager.start(configuration):
+        print('Constable is already running with the same configuration')
+    constable_start = constable_manager.read()
     # start testing
     print('Starting test batch')
-    (results, outputs, outputs_denied) = getattr(sys.modules[__name__], suite_name)(tests, constable)
-    # end constable
-    print('Terminating Constable')
-    constable.terminate()
-    time.sleep(1)
-    constable_end = constable.read()
-    dmesg_end = subprocess.run(shlex.split('sudo dmesg -ce'), universal_newlines=True,
-                               stdout=subprocess.PIPE).stdout
-    # TODO Make room for additional information (dmesg_before, dmesg_start and both ends) in the report file
-    do_cleanup(tests)
-    return (results, outputs, outputs_denied)
+    return getattr(sys.modules[__name__], suite_name)(tests, constable_manager)
+
+
+def watch_results(results, durations):
+    """ Passes results of a serial suite through and prints failed tests right away, so they are seen on the host
+    before the suite ends.
+    @param results: Iterable of validated results
+    @param durations: List to which the test and duration keys of every result are appended, see save_durations.
+    @return: Generator of the results
+    """
+    for result in results:
+        durations.append({'test': result['test'], 'duration': result['duration']})
+        failed = [key[:-len('_valid')] for key in result if key.endswith('_valid') and not result[key]]
+        if failed:
+            print('Test ' + result['test'] + ' failed: ' + ', '.join(failed), flush=True)
+        yield result
 
 
 def create_configuration(tests):
-    """ Creates and saves configuration file based on chosen system calls.
+    """ Creates configuration based on chosen system calls. It's written by ConstableManager when Constable is
+    started.
     @param tests: List of system calls to be executed during testing.
+    @return: Contents of the configuration file
     """
-    # create configuration file and save it
-    configuration = config.make_config(tests)
     if not os.path.exists(commons.TESTING_PATH + '/restricted'):
         os.makedirs(commons.TESTING_PATH + '/restricted')
     # TODO Check if you can write into it
     print('Creating configuration')
-    config_file = open(commons.TESTING_PATH + '/medusa.conf', 'w')
-    config_file.write(configuration)
-    config_file.close()
-    # create constable configuration file that refers to medusa.conf
-    config_file = open(commons.TESTING_PATH + '/constable.conf', 'w')
-    config_file.write(config.constable_config)
-    config_file.close()
+    return config.make_config(tests)
 
 
 def do_concurrent_tests(tests, constable):
-    """ Executes system calls enumerated in list concurrently (almost at the same time).
+    """ Executes system calls enumerated in list concurrently. Every command runs in its own worker process. Workers
+    are forked in advance and released together by a barrier when all of them are ready.
+    Each worker repeats its command CONCURRENT_REPETITIONS times (set in the commons module) to stress locking in
+    Medusa. Allowed commands are repeated only if the test defines an undo which reverts their effect (command_undo,
+    or operation_undo if DIRECT_SYSCALLS is set). A worker that fails before the release breaks the barrier, so the
+    others are released at once and report the error instead of waiting. Workers which don't send their results
+    within BARRIER_TIMEOUT and COMMAND_TIMEOUT seconds for each repetition are terminated and reported as failed.
     @param tests: List of system calls to be executed.
-    @param constable: Reader object of constable output.
+    @param constable: ConstableManager of the running Constable.
     @return: Tuple of results and outputs. Results is a dictionary containing dmesg and constable outputs.
     Outputs is a list of dictionaries containing outputs of executed system calls.
     These outputs should be ideally empty except for the fork system call.
     """
-    # We should create a thread for each test command and lock it. After all tests are ready and constable is started,
-    # we release them. Now, there is a change in catching output from constable
-    outputs = []
-    outputs_denied = []
-    threads = []
-    # create a lock
-    lock = threading.Lock()
-    lock.acquire()
-    os.chdir(commons.TESTING_PATH)
-
-    def testing_thread(test):
-        lock.acquire()
-        lock.release()
-        os.chdir(commons.TESTING_PATH)
-        outputs.append({'test': test, 'output': execute_cmd(config.tests[test]['command'])})
-
-    def testing_thread_denied(test):
-        lock.acquire()
-        lock.release()
-        os.chdir(commons.TESTING_PATH)
-        outputs_denied.append({'test': test, 'output': execute_cmd(config.tests[test]['command_denied'])})
-
+    jobs = []
     for test in tests:
-        new_thread = threading.Thread(name=test, target=testing_thread, args=[test])
-        if 'command_denied' in test:
-            denied_thread = threading.Thread(name=test, target=testing_thread_denied, args=[test])
-            threads.append(denied_thread)
-            denied_thread.start()
-        threads.append(new_thread)
-        new_thread.start()
-
-    lock.release()
+        jobs.append((test, ''))
+        if 'command_denied' in config.tests[test]:
+            jobs.append((test, '_denied'))
+    barrier = multiprocessing.Barrier(len(jobs) + 1, timeout=BARRIER_TIMEOUT)
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(name=test + suffix, target=concurrent_worker,
+                                       args=(test, suffix, barrier, queue)) for test, suffix in jobs]
+    for worker in workers:
+        worker.start()
 
-    for t in threads:
-        t.join()
+    start = kernel_log.sequence()
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        print('Workers were not released together, a worker failed or timed out')
+    released = time.monotonic()
 
-    system_log = subprocess.run(shlex.split('sudo dmesg -ce'), universal_newlines=True,
-                                stdout=subprocess.PIPE).stdout
+    invocations = collect_results(queue, workers,
+                                  BARRIER_TIMEOUT + COMMAND_TIMEOUT * commons.CONCURRENT_REPETITIONS)
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+    received = set(output['worker'] for output in invocations)
+    for test, suffix in jobs:
+        if test + suffix not in received:
+            print('Worker ' + test + suffix + ' did not send its result')
+            invocations.append({'test': test, 'worker': test + suffix,
+                                'output': 'mte: worker did not send its result\n', 'start': released,
+                                'end': released, 'duration': 0.0, 'invocations': [], 'pids': []})
+    system_log = read_system_log(start)
     constable_out = constable.read()
+
+    starts = [output['start'] for output in invocations]
+    print('Workers started within %.3f ms after the release' % ((max(starts) - released) * 1000))
+    invocations.sort(key=lambda output: (tests.index(output['test']), output['worker']))
+    outputs = [output for output in invocations if output['worker'] == output['test']]
+    outputs_denied = [output for output in invocations if output['worker'] != output['test']]
     results = {'output': 'Concurrent logs', 'system_log': system_log, 'constable': constable_out}
     return results, outputs, outputs_denied
 
 
+def concurrent_worker(test, suffix, barrier, queue):
+    """ Executes the command of a test repeatedly in a worker process of the concurrent suite.
+    @param test: Name of the test
+    @param suffix: Suffix of the command, '' or '_denied'.
+    @param barrier: Barrier that releases all workers at once.
+    @param queue: Queue for the results. A dictionary is put to it with test, worker (name of the test with the
+    suffix), output (distinct outputs of all repetitions), start and end (monotonic time of the first and the last
+    invocation), duration, invocations (list of start, end and error number of every invocation) and pids (pids of
+    processes which executed the command, including the undo commands) keys. Exceptions are reported in the output.
+    """
+    invocations = []
+    outputs = []
+    pids = []
+    start = end = time.monotonic()
+    try:
+        os.chdir(commons.TESTING_PATH)
+        definition = config.tests[test]
+        repeatable = suffix == '_denied' or 'command_undo' in definition or \
+            (commons.DIRECT_SYSCALLS and 'operation_undo' in definition)
+        repetitions = commons.CONCURRENT_REPETITIONS if repeatable else 1
+        barrier.wait()
+        start = end = time.monotonic()
+        for repetition in range(repetitions):
+            invocation_start = time.monotonic()
+            error, output = run_command(test, suffix, pids)
+            end = time.monotonic()
+            invocations.append((invocation_start, end, error))
+            if output not in outputs:
+                outputs.append(output)
+            if suffix == '' and repetition + 1 < repetitions:
+                run_command(test, '_undo', pids)
+    except Exception as e:
+        # Workers waiting for the release are not left waiting for this one (abort doesn't harm after the release)
+        barrier.abort()
+        # The result has to be sent anyway, the suite waits for all workers
+        outputs.append('mte: ' + repr(e) + '\n')
+    if invocations:
+        start = invocations[0][0]
+    queue.put({'test': test, 'worker': test + suffix, 'output': ''.join(outputs), 'start': start, 'end': end,
+               'duration': end - start, 'invocations': invocations, 'pids': pids})
+
+
 def do_tests(tests, constable):
     """ Executes commands in the list sequentially and returns their output with kernel log messages
     @param tests: List of tests to be executed
     @param constable: Handle of running Constable process
-    @return: List of dictionaries with two members: output and log
+    @return: Iterator of dictionaries with two members: output and log, see run_tests.
+    """
+    return run_tests(tests, constable), None, None
+
+
+def run_tests(tests, constable):
+    """ Executes commands of the tests one by one as results are requested. Kernel log of a test is dropped from
+    memory when its result is produced.
+    @param tests: List of tests to be executed
+    @param constable: Handle of running Constable process
+    @return: Generator of results of the tests
     """
-    results = []
     os.chdir(commons.TESTING_PATH)
     for test in tests:
         print('Executing test ' + test)
         result = {}
+        start = time.time()
 
-        cmd = config.tests[test]['command']
-        output = execute_cmd(cmd)
-        time.sleep(1)
-        system_log = subprocess.run(shlex.split('sudo dmesg -ce'), universal_newlines=True,
-                                    stdout=subprocess.PIPE).stdout
-        constable_out = constable.read()
+        log_start = kernel_log.sequence()
+        error, output = run_command(test)
+        system_log = read_system_log(log_start, config.tests[test]['dmesg_expect'])
+        constable_out = constable.read(config.tests[test]['dmesg_expect'])
         result['test'] = test
         result['output'] = output
+        result['errno'] = error
         result['system_log'] = system_log
         result['constable'] = constable_out
 
         if 'command_denied' in config.tests[test]:
-            cmd = config.tests[test]['command_denied']
-            output_denied = execute_cmd(cmd)
-            time.sleep(1)
-            system_log_denied = subprocess.run(shlex.split('sudo dmesg -ce'), universal_newlines=True,
-                                        stdout=subprocess.PIPE).stdout
-            constable_out_denied = constable.read()
+            log_start = kernel_log.sequence()
+            error_denied, output_denied = run_command(test, '_denied')
+            system_log_denied = read_system_log(log_start, config.tests[test]['dmesg_expect_denied'])
+            constable_out_denied = constable.read(config.tests[test]['dmesg_expect_denied'])
             result['output_denied'] = output_denied
+            result['errno_denied'] = error_denied
             result['system_log_denied'] = system_log_denied
             result['constable_denied'] = constable_out_denied
 
-        results.append(result)
+        result['duration'] = time.time() - start
+        print('Test ' + test + ' took %.3f s' % result['duration'])
+        kernel_log.discard(kernel_log.sequence())
+        yield result
+
+
+def do_stress_tests(tests, constable):
+    """ Calls operations of the tests in a tight loop from a worker process on every core, first in the allowed
+    and then in the restricted space. Every worker has its own folder prepared by prepare_stress, so the workers don't
+    interfere with each other. Allowed operations are reverted by their operation_undo after each call, time of the
+    undo is not measured. Tests without operation and operation_undo are skipped.
+    @param tests: List of tests to be executed
+    @param constable: ConstableManager of the running Constable.
+    @return: Results in the same format as the sequential suite returns. Output is made of distinct outputs of all
+    calls and the system log contains only a summary. Statistics are added under stats (and stats_denied) keys,
+    see stress_statistics.
+    """
+    return run_stress(tests, constable), None, None
+
+
+def run_stress(tests, constable):
+    """ Stresses operations of the tests one by one as results are requested, see do_stress_tests.
+    @param tests: List of tests to be executed
+    @param constable: ConstableManager of the running Constable.
+    @return: Generator of results of the tests
+    """
+    for test in operation_tests(tests):
+        print('Stressing test ' + test)
+        start = time.time()
+        result = {'test': test}
+        for suffix in ('', '_denied'):
+            if 'operation' + suffix not in config.tests[test]:
+                continue
+            log_start = kernel_log.sequence()
+            calls = run_stress_workers(test, suffix)
+            result['output' + suffix] = ''.join(sorted(set(itertools.chain.from_iterable(
+                call['outputs'] for call in calls))))
+            result['system_log' + suffix] = summarize_system_log(log_start, config.tests[test]['dmesg_expect' + suffix])
+            result['constable' + suffix] = constable.read(config.tests[test]['dmesg_expect' + suffix])
+            result['stats' + suffix] = stress_statistics(calls)
+            print(('  restricted' if suffix else '  allowed') + ': %(operations)d operations, %(throughput).0f ops/s, '
+                  'p50 %(p50).1f us, p95 %(p95).1f us, p99 %(p99).1f us, max %(max).1f us' % result['stats' + suffix])
+        result['duration'] = time.time() - start
+        yield result
+
+
+def stress_worker(test, suffix, path, barrier, queue):
+    """ Calls the operation of a test in a loop for STRESS_DURATION seconds (set in the commons module).
+    @param test: Name of the test
+    @param suffix: Suffix of the operation, '' or '_denied'.
+    @param path: Folder of the worker, see prepare_stress.
+    @param barrier: Barrier that releases all workers at once.
+    @param queue: Queue for the results. A dictionary is put to it with histogram (counts of durations of the calls,
+    see latency_bucket), max (duration of the longest call in seconds), errors (dictionary of error numbers and their
+    counts) and outputs (set of distinct outputs) keys.
+    """
+    # Durations are counted instead of kept, so the memory and the result don't grow with the number of calls
+    histogram = [0] * LATENCY_BUCKETS
+    longest = 0.0
+    errors = collections.Counter()
+    outputs = set()
+    try:
+        os.chdir(path)
+        operation = config.tests[test]['operation' + suffix]
+        undo = config.tests[test]['operation_undo'] if suffix == '' else None
+        barrier.wait()
+        end = time.perf_counter() + commons.STRESS_DURATION
+        while True:
+            start = time.perf_counter()
+            if start >= end:
+                break
+            error, output = syscalls.execute(operation, config.current_locale())
+            latency = time.perf_counter() - start
+            histogram[latency_bucket(latency)] += 1
+            longest = max(longest, latency)
+            errors[error] += 1
+            outputs.add(output)
+            if undo is not None and error == 0:
+                syscalls.execute(undo)
+    except Exception as e:
+        # Workers waiting for the release are not left waiting for this one (abort doesn't harm after the release)
+        barrier.abort()
+        # The result has to be sent anyway, the suite waits for all workers
+        outputs.add('mte: ' + repr(e) + '\n')
+    queue.put({'histogram': histogram, 'max': longest, 'errors': dict(errors), 'outputs': outputs})
+
+
+def run_stress_workers(test, suffix):
+    """ Starts a stress worker for each folder created by prepare_stress and waits for their results. A worker that
+    fails before the release breaks the barrier, so the others report the error instead of waiting. Workers that exit
+    without a result or don't send it within STRESS_DURATION and BARRIER_TIMEOUT seconds are reported and terminated.
+    @param test: Name of the test
+    @param suffix: Suffix of the operation, '' or '_denied'.
+    @return: List of results of the workers, see stress_worker.
+    """
+    paths = stress_paths()
+    barrier = multiprocessing.Barrier(len(paths), timeout=BARRIER_TIMEOUT)
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(name=test + suffix, target=stress_worker,
+                                       args=(test, suffix, path, barrier, queue)) for path in paths]
+    for worker in workers:
+        worker.start()
+    calls = collect_results(queue, workers, commons.STRESS_DURATION + BARRIER_TIMEOUT)
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+    missing = len(workers) - len(calls)
+    if missing:
+        print(str(missing) + ' stress workers did not send their results')
+        calls.append({'histogram': [0] * LATENCY_BUCKETS, 'max': 0.0, 'errors': {},
+                      'outputs': {'mte: ' + str(missing) + ' workers did not send their results\n'}})
+    return calls
+
+
+def collect_results(queue, workers, timeout):
+    """ Gets a result of every worker from the queue. Waiting ends early if all workers have exited, a worker that
+    died without putting its result isn't waited for.
+    @param queue: multiprocessing.Queue to which the workers put their results
+    @param workers: List of the worker processes
+    @param timeout: Maximum number of seconds to wait for all results
+    @return: List of the received results, it's shorter than the list of workers if some results are missing.
+    """
+    results = []
+    deadline = time.monotonic() + timeout
+    while len(results) < len(workers):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            results.append(queue.get(timeout=min(remaining, RESULT_POLL)))
+        except Empty:
+            if not any(worker.is_alive() for worker in workers):
+                # Results of exited workers are already in the queue, anything left there is taken
+                while len(results) < len(workers):
+                    try:
+                        results.append(queue.get(timeout=RESULT_POLL))
+                    except Empty:
+                        break
+                break
+    return results
+
+
+def stress_statistics(calls):
+    """ Computes throughput and latency percentiles of a stressed operation. Histograms of the workers are merged,
+    percentiles are upper bounds of their buckets (at most LATENCY_BUCKET_RATIO times the exact value) and max is
+    exact.
+    @param calls: List of results of the workers, see stress_worker.
+    @return: Dictionary with operations (number of calls), throughput (calls per second), p50, p95, p99 and max
+    (latencies in microseconds) and errors (dictionary of error numbers and their counts) keys.
+    """
+    histogram = [sum(counts) for counts in zip(*(call['histogram'] for call in calls))]
+    longest = max(call['max'] for call in calls) if calls else 0.0
+    operations = sum(histogram)
+    errors = collections.Counter()
+    for call in calls:
+        errors.update(call['errors'])
+    stats = {'operations': operations, 'throughput': operations / commons.STRESS_DURATION, 'errors': dict(errors),
+             'max': longest * 1000000}
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        # Nearest-rank percentile
+        rank = max(int(math.ceil(fraction * operations)), 1)
+        counted = 0
+        stats[name] = 0.0
+        for bucket, count in enumerate(histogram):
+            counted += count
+            if counted >= rank:
+                stats[name] = min(LATENCY_MIN * LATENCY_BUCKET_RATIO ** (bucket + 1), longest) * 1000000
+                break
+    return stats
+
+
+def latency_bucket(latency):
+    """
+    @param latency: Duration of a call in seconds
+    @return: Index of the bucket of the latency histogram. Bucket i counts durations up to
+    LATENCY_MIN * LATENCY_BUCKET_RATIO ** (i + 1), the last one counts all longer durations.
+    """
+    if latency <= LATENCY_MIN:
+        return 0
+    return min(int(math.log(latency / LATENCY_MIN) / LATENCY_LOG_RATIO), LATENCY_BUCKETS - 1)
+
+
+def summarize_system_log(start, expect):
+    """ Summarizes the kernel log of a stressed operation, which is too long to be reported whole. Records before
+    the end of the summarized log are dropped from memory.
+    @param start: Sequence number of the first record
+    @param expect: Message expected in the log
+    @return: Number of records and of those containing the expected message, the first of them and lost records.
+    """
+    end = wait_for_end(start)
+    records = kernel_log.slice(start, end)
+    matching = [record for record in records if expect in record.text]
+    summary = 'mte: ' + str(len(records)) + ' kernel log records, ' + str(len(matching)) + \
+              ' of them contain the expected message\n'
+    if matching:
+        summary += matching[0].text + '\n'
+    summary += lost_records(start, end)
+    kernel_log.discard(kernel_log.sequence() if end is None else end)
+    return summary
+
+
+def operation_tests(tests):
+    """
+    @param tests: List of tests to be executed
+    @return: Tests that can be executed by the stress and benchmark suites, they need operation and operation_undo.
+    """
+    return [test for test in tests if 'operation' in config.tests[test] and 'operation_undo' in config.tests[test]]
+
+
+def stress_paths():
+    """
+    @return: List of folders of the stress workers, one for each core (or STRESS_WORKERS from the commons module).
+    """
+    count = commons.STRESS_WORKERS or os.cpu_count()
+    return [os.path.join(commons.TESTING_PATH, 'stress', str(i)) for i in range(count)]
+
+
+def prepare_stress():
+    """
+    Creates a folder for every stress worker and copies preconditions of the tests into it. Restricted folder
+    of a worker is a symbolic link to its own folder in the restricted space. It has to be called before Constable
+    is started, restricted preconditions couldn't be created later.
+    """
+    for i, path in enumerate(stress_paths()):
+        restricted = os.path.join(commons.TESTING_PATH, 'restricted', 'stress', str(i))
+        os.makedirs(path, exist_ok=True)
+        os.makedirs(restricted, exist_ok=True)
+        if not os.path.lexists(os.path.join(path, 'restricted')):
+            os.symlink(restricted, os.path.join(path, 'restricted'))
+        fixture.populate(path)
+
+
+def do_benchmark_tests(tests, constable):
+    """ Measures how long the operations of the tests take when Medusa allows them, when it denies them and when
+    Constable is not running. Operations are called from this process (see benchmark_operation) in the allowed space
+    with the ALLOW handler, in the restricted space with the DENY handler and in the allowed space after Constable is
+    terminated. Drift of the machine and warm-up of caches would favour the conditions measured later, so half of
+    the runs with Constable is measured before the baseline and half after it in the reverse order. Tests without
+    operation and operation_undo are skipped.
+    @param tests: List of tests to be executed
+    @param constable: ConstableManager of the running Constable. Constable is stopped for the baseline and started
+    again afterwards.
+    @return: Results in the same format as the sequential suite returns. Output is made of distinct outputs of all
+    calls and the system log contains only a summary. Measurements are added under the benchmark key, see
+    benchmark_statistics.
+    """
+    results = [{'test': test, 'benchmark': {}, 'duration': 0.0} for test in operation_tests(tests)]
+    outputs = collections.defaultdict(set)
+    first = (commons.BENCHMARK_RUNS + 1) // 2
+    benchmark_with_constable(results, outputs, constable, ('', '_denied'), first)
+    print('Stopping Constable for the baseline')
+    constable.stop()
+    for result in results:
+        start = time.time()
+        result['benchmark']['none'] = benchmark_operation(result['test'], '', commons.BENCHMARK_RUNS)[0]
+        result['duration'] += time.time() - start
+    constable.start(constable.configuration)
+    benchmark_with_constable(results, outputs, constable, ('_denied', ''), commons.BENCHMARK_RUNS - first)
+    for result in results:
+        for suffix in ('', '_denied'):
+            if (result['test'], suffix) in outputs:
+                result['output' + suffix] = ''.join(sorted(outputs[result['test'], suffix]))
+        result['benchmark'] = benchmark_statistics(result['benchmark'])
+        print(result['test'] + ': ' + ', '.join(
+            condition + ' %(mean).0f ns' % result['benchmark'][condition] for condition in ('none', 'allow', 'deny')
+            if condition in result['benchmark']) +
+            ', allow %(ratio).3fx [%(low).3f, %(high).3f]' % result['benchmark']['allow_ratio'])
     return results, None, None
 
 
-def prepare(tests):
+def benchmark_with_constable(results, outputs, constable, suffixes, runs):
+    """ Measures operations of the tests while Constable is running and adds the runs to the results. Summaries of
+    the system log and output of Constable are appended to the results.
+    @param results: List of results of the benchmark suite, see do_benchmark_tests.
+    @param outputs: Dictionary of sets of distinct outputs of the calls with tuples of the test and the suffix as keys
+    @param constable: ConstableManager of the running Constable.
+    @param suffixes: Suffixes of the operations in the order of measuring, '' for the allowed and '_denied' for
+    the restricted space.
+    @param runs: Number of measured runs of each operation. Nothing is done if it's 0.
     """
-    Prepares testing folder according to 'before' action defined in the config module.
-    Before action can be None, a single string or a list of strings.
-    @param tests: List of tests to be executed.
+    if runs == 0:
+        return
+    for result in results:
+        test = result['test']
+        print('Benchmarking test ' + test)
+        start = time.time()
+        for suffix in suffixes:
+            if 'operation' + suffix not in config.tests[test]:
+                continue
+            log_start = kernel_log.sequence()
+            measured, outputs[test, suffix] = benchmark_operation(test, suffix, runs, outputs[test, suffix])
+            result['benchmark'].setdefault('deny' if suffix else 'allow', []).extend(measured)
+            expect = config.tests[test]['dmesg_expect' + suffix]
+            result['system_log' + suffix] = result.get('system_log' + suffix, '') + \
+                summarize_system_log(log_start, expect)
+            result['constable' + suffix] = result.get('constable' + suffix, '') + constable.read(expect)
+        result['duration'] += time.time() - start
+
+
+def benchmark_operation(test, suffix, runs, outputs=None):
+    """ Calls the operation of a test BENCHMARK_WARMUP times without measuring and then runs times BENCHMARK_CALLS
+    times (both set in the commons module). Successful allowed calls are reverted by operation_undo, time of the undo
+    is not measured.
+    @param test: Name of the test
+    @param suffix: Suffix of the operation, '' or '_denied'.
+    @param runs: Number of measured runs
+    @param outputs: Set to which distinct outputs of the calls are added. A new one is created if it's None.
+    @return: Tuple of the list of mean durations of a call in each run in nanoseconds and the set of distinct
+    outputs of the calls.
     """
-    os.chdir(commons.TESTING_PATH)
-    for test in tests:
-        if config.tests[test]['before'] is not None:
-            # TODO insert to list
-            if type(config.tests[test]['before']) is str:
-                execute_cmd(config.tests[test]['before'], config.tests[test]['before_async'])
-            elif type(config.tests[test]['before']) is list:
-                for cmd in config.tests[test]['before']:
-                    execute_cmd(cmd, config.tests[test]['before_async'])
+    operation = config.tests[test]['operation' + suffix]
+    undo = config.tests[test]['operation_undo'] if suffix == '' else None
+    if outputs is None:
+        outputs = set()
+
+    def call():
+        start = time.perf_counter()
+        error, output = syscalls.execute(operation, config.current_locale())
+        duration = time.perf_counter() - start
+        outputs.add(output)
+        if undo is not None and error == 0:
+            syscalls.execute(undo)
+        return duration
+
+    for i in range(commons.BENCHMARK_WARMUP):
+        call()
+    measured = [sum(call() for i in range(commons.BENCHMARK_CALLS)) / commons.BENCHMARK_CALLS * 1000000000
+                for run in range(runs)]
+    return measured, outputs
 
 
-def do_cleanup(tests):
+def benchmark_statistics(conditions):
+    """ Summarizes runs of an operation and computes its overhead under Medusa.
+    @param conditions: Dictionary with lists of mean durations of runs (see benchmark_operation) under allow, deny
+    and none (Constable not running) keys.
+    @return: Dictionary with a dictionary of runs, mean and stdev (in nanoseconds) for each condition. Ratio of
+    allow to none is under the allow_ratio key as a dictionary with ratio and low and high bounds of its confidence
+    interval (BENCHMARK_CONFIDENCE from the commons module). Denied operations are called on other paths than the
+    baseline and fail early, so only their absolute durations are reported.
     """
-    Executed the 'after' action defined in the config module.
-    Action is usually set to remove files created by tests
-    @param tests: Tests that were executed
+    stats = {'calls': commons.BENCHMARK_CALLS, 'warmup': commons.BENCHMARK_WARMUP}
+    for condition, runs in conditions.items():
+        stats[condition] = {'runs': runs, 'mean': statistics.mean(runs),
+                            'stdev': statistics.stdev(runs) if len(runs) > 1 else 0.0}
+    low, high = bootstrap_ratio(conditions['allow'], conditions['none'])
+    stats['allow_ratio'] = {'ratio': stats['allow']['mean'] / stats['none']['mean'], 'low': low, 'high': high}
+    return stats
+
+
+def bootstrap_ratio(values, baseline, resamples=2000):
+    """ Estimates the confidence interval of the ratio of two means by resampling the runs.
+    @param values: List of measured values
+    @param baseline: List of baseline values
+    @param resamples: Number of resamples
+    @return: Tuple of the low and the high bound of the interval with BENCHMARK_CONFIDENCE (set in the commons module)
     """
-    for test in tests:
-        if config.tests[test]['after'] is not None:
-            execute_cmd(config.tests[test]['after'])
+    generator = random.Random(0)
+    ratios = sorted(statistics.mean(generator.choices(values, k=len(values))) /
+                    statistics.mean(generator.choices(baseline, k=len(baseline))) for i in range(resamples))
+    tail = (1 - commons.BENCHMARK_CONFIDENCE) / 2
+    return ratios[int(tail * (resamples - 1))], ratios[int(math.ceil((1 - tail) * (resamples - 1)))]
+
+
+def read_system_log(start, expect=None, inject=True, timeout=None):
+    """ Waits until an injected end marker or the expected message is read from the kernel log. Medusa logs its
+    decision before the system call returns, so everything caused by a finished command is already in the log when
+    the marker is written after it. Lost records are reported at the end of the returned log.
+    @param start: Sequence number of the first record of the returned log
+    @param expect: Message expected in the log. It's waited for only if the end marker can't be written.
+    @param inject: If true, the end marker is written to the kernel log.
+    @param timeout: Maximum number of seconds to wait. SYNC_TIMEOUT from the commons module is used if it's None.
+    @return: Kernel log from the start to the end marker (not included)
+    """
+    end = wait_for_end(start, expect, inject, timeout)
+    return kernel_log.text(start, end) + lost_records(start, end)
+
+
+def wait_for_end(start, expect=None, inject=True, timeout=None):
+    """ Waits until an injected end marker or the expected message is read from the kernel log.
+    @param start: Sequence number of the first searched record
+    @param expect: Message expected in the log. It's waited for only if the end marker can't be written.
+    @param inject: If true, the end marker is written to the kernel log.
+    @param timeout: Maximum number of seconds to wait. SYNC_TIMEOUT from the commons module is used if it's None.
+    @return: Sequence number of the end marker or None if there is no marker.
+    """
+    if timeout is None:
+        timeout = commons.SYNC_TIMEOUT
+    marker = inject_marker() if inject else None
+    wanted = marker if marker is not None else expect
+    found = kernel_log.wait_for(wanted, start, timeout) if wanted is not None else None
+    return found if marker is not None else None
+
+
+def lost_records(start, end=None):
+    """ Reports records that were lost from the kernel log, e.g. because they were overwritten before reading.
+    @param start: Sequence number of the first record
+    @param end: Sequence number after the last record. None means up to the last read record.
+    @return: One line for each range of lost records
+    """
+    report = ''
+    for first, last in kernel_log.missing(start, end):
+        message = 'mte: ' + str(last - first) + ' kernel log records were lost (' + str(first) + '-' + \
+                  str(last - 1) + ')'
+        print(message)
+        report += message + '\n'
+    return report
+
+
+def inject_marker():
+    """ Writes a unique marker to the kernel log.
+    @return: Text of the marker or None if the kernel log is not writable.
+    """
+    marker = 'mte-sync-' + str(next(sync_counter))
+    try:
+        with open('/dev/kmsg', 'w') as kmsg:
+            kmsg.write(marker + '\n')
+    except OSError:
+        return None
+    return marker
+
+
+def save_durations(results, suite):
+    """ Saves durations of executed tests. Host uses them to balance tests between virtual machines.
+    @param results: List of dictionaries containing test and duration keys.
+    @param suite: Name of the executed suite.
+    """
+    durations = {}
+    for result in results:
+        durations[result['test']] = durations.get(result['test'], 0) + result['duration']
+    with open(os.path.join(commons.TESTING_PATH, 'durations_' + suite + '.json'), 'w') as f:
+        json.dump(durations, f)
+
+
+def run_command(test, suffix='', pids=None):
+    """ Executes a command of a test. If DIRECT_SYSCALLS is set in the commons module and the test describes the
+    command as an operation, the operation is called directly from this process without starting a new one.
+    @param test: Name of the test
+    @param suffix: Suffix of the command and operation keys in the config module: '' for the allowed command,
+    '_denied' for the command in the restricted space and '_undo' for reverting the allowed command.
+    @param pids: If it's a list, pid of the process which executed the command is appended to it.
+    @return: Tuple of the error number and the output. Error number is None if a command was executed.
+    """
+    if commons.DIRECT_SYSCALLS and 'operation' + suffix in config.tests[test]:
+        if pids is not None:
+            pids.append(os.getpid())
+        return syscalls.execute(config.tests[test]['operation' + suffix], config.current_locale())
+    if config.tests[test]['command' + suffix] is None:
+        return None, ''
+    return None, execute_cmd(config.tests[test]['command' + suffix], pids=pids)
 
 
-def execute_cmd(cmd, async=False):
+def execute_cmd(cmd, async=False, pids=None):
     """ Executes command on the system and returns output
     @param cmd: Command to be executed
     @param async: If true, command will be executed asynchronously (function will not wait for it to end)
+    @param pids: If it's a list, pid of the executed command is appended to it.
     @return: Standard output of the executed command if executed synchronously, nothing if async=True
     >>> execute_cmd('echo This is a test')
     'This is a test\\n'
@@ -218,9 +748,11 @@ def execute_cmd(cmd, async=False):
     if (async):
         execute_cmd_async(cmd)
         return
-    process = subprocess.run(shlex.split(cmd), universal_newlines=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-    return process.stdout
+    process = subprocess.Popen(shlex.split(cmd), universal_newlines=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    if pids is not None:
+        pids.append(process.pid)
+    return process.communicate()[0]
 
 
 def execute_cmd_async(cmd):
@@ -3,18 +3,24 @@
 Prepares new thread for starting the virtual machine
 """
 import threading
+
+import commons
+import fleet
 import virtual
 
 
 def main(test_list, suite_list):
     """
-    Creates a new thread for module used to communicate with VirtualBox
+    Creates a new thread for module used to communicate with VirtualBox. If there are more virtual machines
+    defined in the commons module, tests are split between them.
     @param test_list: This list contains names of system calls to be tested.
     @param suite_list: This list contains names of the testing suites to be run.
     Names of tests and suites that can be chosen are listed in the config module.
     @return: None
     """
-    thread = threading.Thread(target=virtual.main, args=(test_list, suite_list), name='vbox')
+    # Configurations older than the fleet don't have VMS, they define a single machine
+    target = fleet.main if len(getattr(commons, 'VMS', ())) > 1 else virtual.main
+    thread = threading.Thread(target=target, args=(test_list, suite_list), name='vbox')
     thread.start()
 
 
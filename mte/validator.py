@@ -1,7 +1,10 @@
 """@package mte.validator
 Validates outputs of executed test suites.
 """
+import collections
+
 import config
+from log_proc import Records
 
 
 class Validator:
@@ -19,113 +22,181 @@ class Validator:
         @return: Tuple of results and outputs.
         """
         if outputs is None:
-            results = cls.__validate_results(results)
+            matcher = cls.matcher(test['test'] for test in results)
+            results = [cls.__validate_result(test, matcher) for test in results]
         else:
-            outputs, outputs_denied = cls.__validate_concurrent_results(results, outputs, outputs_denied)
+            matcher = cls.matcher(out['test'] for out in outputs + outputs_denied)
+            outputs, outputs_denied = cls.__validate_concurrent_results(results, outputs, outputs_denied, matcher)
         return results, outputs, outputs_denied
 
+    @classmethod
+    def stream(cls, results, tests):
+        """ Validates results of a serial suite one by one as they are produced, so the next result is not
+        requested before the previous one is consumed.
+        @param results: Iterable of results of a serial suite, see __validate_result.
+        @param tests: List of tests whose results can be produced
+        @return: Generator of validated results
+        """
+        matcher = cls.matcher(tests)
+        for test in results:
+            yield cls.__validate_result(test, matcher)
+
     @staticmethod
-    def __validate_results(results):
+    def matcher(tests):
         """
-        Validates results from serial test suite. It uses just results list.
-        @param results: List of dictionaries containing test, output, system_log and constable information.
-        @return: Validated results. Adds new fields to dictionaries: output_valid, dmesg_valid and constable_valid.
-        These can be True or False.
+        @param tests: Iterable of names of tests
+        @return: LogMatcher of expected messages of the tests
+        """
+        return LogMatcher(config.tests[test][key] for test in set(tests)
+                          for key in ('dmesg_expect', 'dmesg_expect_denied') if key in config.tests[test])
+
+    @staticmethod
+    def __validate_result(test, matcher):
+        """
+        Validates a result from serial test suite.
+        @param test: Dictionary containing test, output, system_log and constable information.
+        @param matcher: LogMatcher of expected messages of the tests
+        @return: Validated result. Adds new fields to the dictionary: output_valid, dmesg_valid and constable_valid.
+        These can be True or False. Lines of the system log with the expected message are added as dmesg_lines.
+        Denied commands are validated the same way, their fields have _denied after output, dmesg and constable.
         """
         # We are checking output for nothing except the fork
         # Dmesg for name of the test, or maybe an expectation words
         # Constable for runtime errors
-        for test in results:
+        definition = config.tests[test['test']]
+        suffixes = ('', '_denied') if 'command_denied' in definition else ('',)
+        for suffix in suffixes:
             # Checking the output of commands
-            if config.tests[test['test']]['output_expect'] is None:
-                test['output_valid'] = test['output'] == ''
-            elif type(config.tests[test['test']]['output_expect']) is str:
-                test['output_valid'] = config.tests[test['test']]['output_expect'] in test['output'] if \
-                                       config.tests[test['test']]['output_expect'] != '***' else bool(test['output'])
-            elif type(config.tests[test['test']]['output_expect']) is list:
-                for s in config.tests[test['test']]['output_expect']:
-                    if s not in test['output']:
-                        test['output_valid'] = False
-                        break
-                else:
-                    test['output_valid'] = True
-
-            if 'command_denied' in config.tests[test['test']]:
-                if config.tests[test['test']]['output_expect_denied'] is None:
-                    test['output_denied_valid'] = test['output_denied'] == ''
-                elif type(config.tests[test['test']]['output_expect_denied']) is str:
-                    test['output_denied_valid'] = config.tests[test['test']]['output_expect_denied'] in test['output_denied'] if \
-                                                  config.tests[test['test']]['output_expect_denied'] != '***' else bool(test['output_denied'])
-                elif type(config.tests[test['test']]['output_expect_denied']) is list:
-                    for s in config.tests[test['test']]['output_expect_denied']:
-                        if s not in test['output_denied']:
-                            test['output_denied_valid'] = False
-                            break
-                    else:
-                        test['output_denied_valid'] = True
-
-                test['dmesg_denied_valid'] = config.tests[test['test']]['dmesg_expect_denied'] in test['system_log_denied']
-
-                test['constable_denied_valid'] = 'error' not in test['constable_denied']
-
+            test['output' + suffix + '_valid'] = check_output(definition['output_expect' + suffix],
+                                                              test['output' + suffix])
             # Checking the dmesg
-            test['dmesg_valid'] = config.tests[test['test']]['dmesg_expect'] in test['system_log']
-
+            lines = matcher.index(test['system_log' + suffix]).get(definition['dmesg_expect' + suffix], [])
+            test['dmesg' + suffix + '_lines'] = lines
+            test['dmesg' + suffix + '_valid'] = bool(lines)
             # Checking constable
             # TODO case insensitive
-            test['constable_valid'] = 'error' not in test['constable']
-
-        return results
+            test['constable' + suffix + '_valid'] = 'error' not in test['constable' + suffix]
+        return test
 
     @staticmethod
-    def __validate_concurrent_results(results, outputs, outputs_denied):
+    def __validate_concurrent_results(results, outputs, outputs_denied, matcher):
         """ Used when validating concurrent results. Searches for system call names in dmesg and errors in constable.
         @param results: Dictionary containing dmesg and constable outputs.
         @param outputs: List of dictionaries containing outputs of executed system calls.
+        @param outputs_denied: List of dictionaries containing outputs of system calls in the restricted space.
+        @param matcher: LogMatcher of expected messages of the tests
         @return: List of dictionaries, that contain boolean keys: output_valid, dmesg_valid and constable_valid.
+        Lines of the system log with the expected message are added as dmesg_lines. Messages of log_proc printed for
+        processes of the output (its pids key) are added as system_log and dmesg_attributed tells whether the
+        expected message is among them (None if no message was attributed to the output, e.g. for tests which
+        don't use log_proc).
         """
         # Check outputs similarly to serial tests
-        # Check full dmesg for name of the tests
+        # Full dmesg is scanned only once for messages of all tests
+        # Decisions are attributed to outputs by pids of the processes which executed the commands
         # Full Constable for errors, but won't be able to locate exact cause of the error
-        for out in outputs:
-            # Checking the output of commands
-            if config.tests[out['test']]['output_expect'] is None:
-                out['output_valid'] = out['output'] == ''
-            elif type(config.tests[out['test']]['output_expect']) is str:
-                out['output_valid'] = config.tests[out['test']]['output_expect'] in out['output'] if \
-                                      config.tests[out['test']]['output_expect'] != '***' else bool(out['output'])
-            elif type(config.tests[out['test']]['output_expect']) is list:
-                for s in config.tests[out['test']]['output_expect']:
-                    if s not in out['output']:
-                        out['output_valid'] = False
-                        break
-                else:
-                    out['output_valid'] = True
+        index = matcher.index(results['system_log'])
+        records = Records(results['system_log'])
+        constable_valid = 'error' not in results['constable']
+        for suffix, outs in (('', outputs), ('_denied', outputs_denied)):
+            for out in outs:
+                definition = config.tests[out['test']]
+                # Checking the output of commands
+                out['output_valid'] = check_output(definition['output_expect' + suffix], out['output'])
+                # Checking the dmesg
+                out['dmesg_lines'] = index.get(definition['dmesg_expect' + suffix], [])
+                out['dmesg_valid'] = bool(out['dmesg_lines'])
+                own = records.find(out.get('pids', ()))
+                out['system_log'] = records.text(own)
+                expect = definition['dmesg_expect' + suffix]
+                out['dmesg_attributed'] = any(expect in records.message(row) for row in own) if own else None
+                # Checking constable
+                # TODO case insensitive
+                out['constable_valid'] = constable_valid
+        return outputs, outputs_denied
 
-            # Checking the dmesg
-            out['dmesg_valid'] = config.tests[out['test']]['dmesg_expect'] in results['system_log']
-            # Checking constable
-            # TODO case insensitive
-            out['constable_valid'] = 'error' not in results['constable']
 
-        for out in outputs_denied:
-            # Checking the output of commands
-            if config.tests[out['test']]['output_expect'] is None:
-                out['output_valid'] = out['output'] == ''
-            elif type(config.tests[out['test']]['output_expect']) is str:
-                out['output_valid'] = config.tests[out['test']]['output_expect'] in out['output'] if \
-                                      config.tests[out['test']]['output_expect'] != '***' else bool(out['output'])
-            elif type(config.tests[out['test']]['output_expect']) is list:
-                for s in config.tests[out['test']]['output_expect']:
-                    if s not in out['output']:
-                        out['output_valid'] = False
-                        break
-                else:
-                    out['output_valid'] = True
+def check_output(expect, output):
+    """ Checks output of a command.
+    @param expect: Expected output from the config module. None means no output, '***' means any output, a string has
+    to be in the output and all strings of a list have to be in the output.
+    @param output: Output of the command
+    @return: True if the output is valid
+    """
+    if expect is None:
+        return output == ''
+    if type(expect) is str:
+        return expect in output if expect != '***' else bool(output)
+    return all(s in output for s in expect)
 
-            # Checking the dmesg
-            out['dmesg_valid'] = config.tests[out['test']]['dmesg_expect'] in results['system_log']
-            # Checking constable
-            # TODO case insensitive
-            out['constable_valid'] = 'error' not in results['constable']
-        return outputs, outputs_denied
+
+class LogMatcher:
+    """
+    Finds lines with expected messages in a log. Messages are grouped by short anchors they share (e.g. "['" of the
+    messages logged by log_proc), so the log is searched once for each anchor instead of once for each message and
+    only the lines with an anchor are checked for the messages. Messages contained in other messages (e.g. "link[...]"
+    in "denied-link[...]") are found too.
+    """
+    def __init__(self, markers):
+        """
+        Compiles the messages into groups by anchors. Each anchor is a pair of characters with at least one
+        punctuation character, which is rare in ordinary text. The anchor shared by the most messages is chosen first.
+        Messages without punctuation are their own anchors.
+        @param markers: Messages expected in logs, they should be on a single line.
+        """
+        uncovered = set(marker for marker in markers if marker)
+        self.multiline = [marker for marker in uncovered if '\n' in marker]
+        uncovered.difference_update(self.multiline)
+        self.anchors = {}
+        while uncovered:
+            counts = collections.Counter(anchor for marker in uncovered for anchor in _anchors(marker))
+            if not counts:
+                break
+            anchor = max(counts, key=lambda a: (counts[a], a))
+            self.anchors[anchor] = [marker for marker in uncovered if anchor in marker]
+            uncovered.difference_update(self.anchors[anchor])
+        for marker in uncovered:
+            self.anchors[marker] = [marker]
+
+    def index(self, log):
+        """
+        Scans the log for all messages.
+        @param log: Text of the log
+        @return: Dictionary with found messages as keys and sorted lists of numbers of lines (from 0) containing them
+        as values.
+        """
+        starts = collections.defaultdict(set)
+        for anchor, markers in self.anchors.items():
+            position = log.find(anchor)
+            while position != -1:
+                start = log.rfind('\n', 0, position) + 1
+                end = log.find('\n', position)
+                if end == -1:
+                    end = len(log)
+                line = log[start:end]
+                for marker in markers:
+                    if marker in line:
+                        starts[marker].add(start)
+                position = log.find(anchor, end)
+        for marker in self.multiline:
+            position = log.find(marker)
+            if position != -1:
+                starts[marker].add(log.rfind('\n', 0, position) + 1)
+        # Offsets of the lines are converted to line numbers in one pass over the log
+        numbers = {}
+        line = 0
+        last = 0
+        for offset in sorted(set().union(*starts.values())):
+            line += log.count('\n', last, offset)
+            last = offset
+            numbers[offset] = line
+        return {marker: sorted(numbers[offset] for offset in offsets) for marker, offsets in starts.items()}
+
+
+def _anchors(marker):
+    """
+    @param marker: Expected message
+    @return: Set of pairs of characters of the message which contain a punctuation character
+    """
+    return set(marker[i:i + 2] for i in range(len(marker) - 1)
+               if any(not c.isalnum() and not c.isspace() for c in marker[i:i + 2]))
@@ -2,38 +2,263 @@
 """@package mte.virtual
 Controls Virtual machine execution
 """
+import threading
 import time
-from vboxapi import VirtualBoxManager
 
 import commons
 import shell
 
+# Seconds to wait for the process of a powered off virtual machine to release its session
+UNLOCK_TIMEOUT = 30
+# Seconds between checks of the session state
+UNLOCK_POLL_DELAY = 0.1
 
-def start_machine():
+
+class VirtualBoxBackend:
     """
-    Starts the virtual machine. If it was not running before, it waits 50 seconds for the system to boot up.
+    Starts virtual machines and manages their snapshots through the VirtualBox API. Other backends (e.g. a local
+    stand-in used when VirtualBox is not available) have to provide the same start, restore_snapshot and
+    take_snapshot methods.
+    Run this module as a script to check it with a stand-in VirtualBox API (see the stand_in module). Connections to
+    the machine are replaced too, the first one builds a new kernel:
+    >>> import sys, stand_in
+    >>> sys.modules['vboxapi'] = stand_in
+    >>> backend = VirtualBoxBackend()
+    Running VirtualBox version stand-in
+    >>> machine = backend.vbox.machines['vm'] = stand_in.Machine('vm')
+    >>> vm = {'name': 'vm', 'ip': '127.0.0.1', 'port': 22}
+    >>> commons.SNAPSHOT = 'ready'
+    >>> reset(vm, backend)
+    vm has no snapshot ready, it will be taken when the machine is ready
+    False
+    >>> backend.start('vm', 'headless'), backend.start('vm', 'headless')
+    (True, False)
+    >>> connections = [1, 0]
+    >>> shell.connect = lambda args, vm, output_path: connections.pop(0)
+    >>> shell.wait_for_shutdown = lambda ip, port: True
+    >>> shell.wait_for_ssh = lambda ip, port, username, password: 1.0
+    >>> run_tests((['mkdir'], ['do_tests']), vm, None, backend, has_snapshot=False)
+    Taking snapshot ready of vm
+    Starting SSH conection
+    vm is ready after 1.0 seconds
+    Taking snapshot ready of vm
+    >>> print [(snapshot.name, snapshot.id, snapshot.state) for snapshot in machine.snapshots]
+    [('ready', 2, 'Saved')]
+    >>> reset(vm, backend)
+    vm was reset to the snapshot ready
+    True
+    >>> print machine.state, machine.sessionState
+    Saved Unlocked
+    >>> backend.start('vm', 'headless')
+    True
     """
-    mgr = VirtualBoxManager(None, None)
-    vbox = mgr.vbox
-    print "Running VirtualBox version %s" % vbox.version
-    machine = vbox.findMachine(commons.VM_NAME)
-    session = mgr.getSessionObject(vbox)
-    if machine.state == mgr.constants.all_values('MachineState')['Running']:
-        print 'VM is already running'
-        pass
-    elif machine.state == mgr.constants.all_values('MachineState')['PoweredOff'] or \
-         machine.state == mgr.constants.all_values('MachineState')['Saved']:
-        # TODO split this condition
-        progress = machine.launchVMProcess(session, 'gui', '')
-        progress.waitForCompletion(-1)
+    def __init__(self):
+        """
+        Connects to the VirtualBox. API is imported here, so the module can be used without VirtualBox installed.
+        """
+        from vboxapi import VirtualBoxManager
+        self.mgr = VirtualBoxManager(None, None)
+        self.vbox = self.mgr.vbox
+        self.thread = threading.current_thread()
+        self.initialized = threading.local()
+        print "Running VirtualBox version %s" % self.vbox.version
+
+    def init_thread(self):
+        """
+        Initializes the VirtualBox API for the current thread. API has to be initialized in every thread that uses it
+        except the one that created the backend.
+        """
+        if threading.current_thread() is not self.thread and not getattr(self.initialized, 'done', False):
+            self.mgr.initPerThread()
+            self.initialized.done = True
+
+    def start(self, name, front_end='gui'):
+        """
+        Starts the virtual machine if it's not running.
+        @param name: Name of the virtual machine
+        @param front_end: Type of the VirtualBox front end, e.g. 'gui' or 'headless'
+        @return: True if the machine was started, False if it was already running.
+        """
+        self.init_thread()
+        machine = self.vbox.findMachine(name)
+        session = self.mgr.getSessionObject(self.vbox)
+        if machine.state == self.mgr.constants.all_values('MachineState')['Running']:
+            return False
+        elif machine.state == self.mgr.constants.all_values('MachineState')['PoweredOff'] or \
+             machine.state == self.mgr.constants.all_values('MachineState')['Saved']:
+            # TODO split this condition
+            progress = machine.launchVMProcess(session, front_end, '')
+            progress.waitForCompletion(-1)
+            return True
+        else:
+            raise RuntimeError('Unexpected virtual machine state ' + str(machine.state))
+            # TODO nicer message for the user
+
+    def restore_snapshot(self, name, snapshot):
+        """
+        Powers off the virtual machine if it's running and restores its snapshot. Snapshot of a running machine is
+        restored to the saved state, so the machine continues from it right after the start.
+        @param name: Name of the virtual machine
+        @param snapshot: Name of the snapshot
+        @return: True if the snapshot was restored, False if the machine has no snapshot with this name.
+        """
+        self.init_thread()
+        machine = self.vbox.findMachine(name)
+        snapshot = self.find_snapshot(machine, snapshot)
+        if snapshot is None:
+            return False
+        session = self.mgr.getSessionObject(self.vbox)
+        if machine.state == self.mgr.constants.all_values('MachineState')['Running']:
+            machine.lockMachine(session, self.mgr.constants.LockType_Shared)
+            try:
+                session.console.powerDown().waitForCompletion(-1)
+            finally:
+                session.unlockMachine()
+            # Progress of the power down completes before the machine process releases its session
+            self.wait_for_unlock(machine)
+        machine.lockMachine(session, self.mgr.constants.LockType_Write)
+        try:
+            session.machine.restoreSnapshot(snapshot).waitForCompletion(-1)
+        finally:
+            session.unlockMachine()
+        return True
+
+    def take_snapshot(self, name, snapshot):
+        """
+        Takes a snapshot of a running virtual machine. Older snapshots with the same name are deleted afterwards.
+        @param name: Name of the virtual machine
+        @param snapshot: Name of the snapshot
+        """
+        self.init_thread()
+        machine = self.vbox.findMachine(name)
+        old_snapshot = self.find_snapshot(machine, snapshot)
+        session = self.mgr.getSessionObject(self.vbox)
+        machine.lockMachine(session, self.mgr.constants.LockType_Shared)
+        try:
+            progress, snapshot_id = session.machine.takeSnapshot(snapshot, 'Booted machine ready for testing', False)
+            progress.waitForCompletion(-1)
+            if old_snapshot is not None:
+                session.machine.deleteSnapshot(old_snapshot.id).waitForCompletion(-1)
+        finally:
+            session.unlockMachine()
+
+    def wait_for_unlock(self, machine, timeout=UNLOCK_TIMEOUT):
+        """
+        Waits until no session holds a lock of the virtual machine, so it can be locked for writing.
+        @param machine: Virtual machine object
+        @param timeout: Maximum number of seconds to wait
+        """
+        unlocked = self.mgr.constants.all_values('SessionState')['Unlocked']
+        start = time.time()
+        while machine.sessionState != unlocked:
+            if time.time() - start > timeout:
+                raise RuntimeError('Virtual machine ' + machine.name + ' is still locked after ' + str(timeout) +
+                                   ' seconds')
+            time.sleep(UNLOCK_POLL_DELAY)
+
+    @staticmethod
+    def find_snapshot(machine, snapshot):
+        """
+        @param machine: Virtual machine object
+        @param snapshot: Name of the snapshot
+        @return: Snapshot object or None if the machine has no snapshot with this name.
+        """
+        if machine.snapshotCount == 0:
+            return None
+        try:
+            return machine.findSnapshot(snapshot)
+        except Exception:
+            return None
+
+
+def start_machine(vm=None, backend=None, front_end='gui'):
+    """
+    Starts the virtual machine. If it was not running before, it waits until the system boots up and accepts SSH
+    connections. If SNAPSHOT is set in the commons module, the machine is reset to the snapshot first.
+    @param vm: Dictionary with name, ip and port of the virtual machine. Machine from the commons module is used if
+     it's None.
+    @param backend: Object used to start the machine. VirtualBoxBackend is used if it's None.
+    @param front_end: Type of the VirtualBox front end, e.g. 'gui' or 'headless'
+    @return: True if the machine was reset to the snapshot.
+    """
+    if vm is None:
+        vm = shell.default_vm()
+    if backend is None:
+        backend = VirtualBoxBackend()
+    restored = reset(vm, backend)
+    if backend.start(vm['name'], front_end):
         print 'VM succesfully started'
         print 'Waiting for boot'
-        # Waiting till virtual machine is ready to accept SSH connection
-        time.sleep(50)
-        # TODO try ping
+        wait_for_boot(vm)
     else:
-        raise RuntimeError('Unexpected virtual machine state ' + str(machine.state))
-        # TODO nicer message for the user
+        print 'VM is already running'
+    return restored
+
+
+def reset(vm, backend):
+    """
+    Restores the virtual machine to the snapshot set in the commons module. Nothing is done if SNAPSHOT is None.
+    @param vm: Dictionary with name, ip and port of the virtual machine.
+    @param backend: Object used to manage the machine.
+    @return: True if the snapshot was restored.
+    """
+    if commons.SNAPSHOT is None:
+        return False
+    if backend.restore_snapshot(vm['name'], commons.SNAPSHOT):
+        print vm['name'] + ' was reset to the snapshot ' + commons.SNAPSHOT
+        return True
+    print vm['name'] + ' has no snapshot ' + commons.SNAPSHOT + ', it will be taken when the machine is ready'
+    return False
+
+
+def snapshot(vm, backend):
+    """
+    Takes a new snapshot of the ready virtual machine. Nothing is done if SNAPSHOT in the commons module is None.
+    @param vm: Dictionary with name, ip and port of the virtual machine.
+    @param backend: Object used to manage the machine.
+    """
+    if commons.SNAPSHOT is not None:
+        print 'Taking snapshot ' + commons.SNAPSHOT + ' of ' + vm['name']
+        backend.take_snapshot(vm['name'], commons.SNAPSHOT)
+
+
+def wait_for_boot(vm=None):
+    """
+    Waits till virtual machine is ready to accept SSH connection and execute commands.
+    @param vm: Dictionary with name, ip and port of the virtual machine. Machine from the commons module is used if
+     it's None.
+    """
+    if vm is None:
+        vm = shell.default_vm()
+    boot_time = shell.wait_for_ssh(vm['ip'], vm['port'], commons.USER_NAME, commons.USER_PASSWORD)
+    print vm['name'] + ' is ready after %.1f seconds' % boot_time
+
+
+def run_tests(args, vm=None, output_path=None, backend=None, has_snapshot=True):
+    """
+    Executes tests on a running virtual machine. If the kernel was rebuilt, it waits for the reboot, takes a new
+    snapshot of the machine and connects again.
+    @param args: Tuple of two lists. First list contains names of system calls to be tested and second one contains
+     names of the testing suites to be run.
+    @param vm: Dictionary with name, ip and port of the virtual machine. Machine from the commons module is used if
+     it's None.
+    @param output_path: Folder where to put the results. OUTPUT_PATH from the commons module is used if it's None.
+    @param backend: Object used to manage the machine. VirtualBoxBackend is used if it's None.
+    @param has_snapshot: False if the machine was not reset to a snapshot, so a new one is taken before testing.
+    """
+    if vm is None:
+        vm = shell.default_vm()
+    if backend is None:
+        backend = VirtualBoxBackend()
+    if not has_snapshot:
+        snapshot(vm, backend)
+    print 'Starting SSH conection'
+    if (shell.connect(args, vm, output_path) == 1):
+        if not shell.wait_for_shutdown(vm['ip'], vm['port']):
+            print 'VM is still responding, continuing anyway'
+        wait_for_boot(vm)
+        snapshot(vm, backend)
+        shell.connect(args, vm, output_path)
 
 
 def main(*argv):
@@ -42,11 +267,9 @@ def main(*argv):
     @param argv: Tuple of two lists. First list contains names of system calls to be tested and second one contains
      names of the testing suites to be run.
     """
-    start_machine()
-    print 'Starting SSH conection'
-    if (shell.connect(argv) == 1):
-        time.sleep(60)
-        shell.connect(argv)
+    backend = VirtualBoxBackend()
+    has_snapshot = start_machine(backend=backend)
+    run_tests(argv, backend=backend, has_snapshot=has_snapshot)
 
 
 def setup_virtual_pc():
@@ -56,3 +279,8 @@ def setup_virtual_pc():
     start_machine()
     print 'Starting SSH conection'
     shell.setup_virtual_pc()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
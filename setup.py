@@ -33,6 +33,7 @@ setup(name='mte',
       author_email='roderik.ploszek@gmail.com',
       license='MIT',
       packages=['mte'],
+      package_data={'mte': ['tests/*.json']},
       install_requires=['paramiko==1.16.0', 'scp==0.10.2'],
       zip_safe=True,
       include_package_data=True,